@@ -1,5 +1,6 @@
 import json
 from neo4j import GraphDatabase
+from import_utils import content_hash, new_counts, add_counts, format_counts
 
 # ================= CẤU HÌNH KẾT NỐI NEO4J =================
 # URI = "neo4j://20.249.211.169:7687" 
@@ -9,6 +10,8 @@ from neo4j import GraphDatabase
 URI = "neo4j://127.0.0.1:7687" 
 AUTH = ("neo4j", "neo4j123") 
 FILE_PATH = "../../data/icd10_data.json" 
+# Import lại chỉ ghi các node thay đổi; bật cờ này nếu muốn xóa sạch DB trước khi import
+CLEAR_DATABASE = False
 
 class ICDImporter:
     def __init__(self, uri, auth):
@@ -37,7 +40,7 @@ class ICDImporter:
             print("✅ Đã tạo các ràng buộc (Constraints) thành công.")
 
     def import_data(self, file_path):
-        """Đọc file JSON và import vào Neo4j"""
+        """Đọc file JSON và import vào Neo4j (chỉ ghi các node có nội dung thay đổi)"""
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
                 data = json.load(f)
@@ -45,6 +48,7 @@ class ICDImporter:
             print(f"❌ Không tìm thấy file: {file_path}")
             return
 
+        counts = {label: new_counts() for label in ("Chapter", "Group", "Disease")}
         with self.driver.session() as session:
             # Duyệt qua từng chương trong file JSON
             # start=1 để ID chương bắt đầu từ 1 thay vì 0
@@ -56,73 +60,165 @@ class ICDImporter:
                 print(f"⏳ Đang import Chương {chapter_id}: {chapter_data.get('name')}...")
                 
                 # Gọi hàm thực thi Cypher cho từng Chương (Batching theo chương)
-                session.execute_write(self._create_chapter_structure, chapter_data, chapter_id)
-                
-            print("🎉 Hoàn tất import dữ liệu!")
+                rows = self.flatten_chapter(chapter_data, chapter_id)
+                result = session.execute_write(self._upsert_chapter_structure, rows)
+                for label, records in result.items():
+                    add_counts(counts[label], records)
+
+        for label, label_counts in counts.items():
+            print(f"   - {label}: {format_counts(label_counts)}")
+        print("🎉 Hoàn tất import dữ liệu!")
 
     @staticmethod
-    def _create_chapter_structure(tx, chapter_data, chapter_id):
+    def flatten_chapter(chapter_data, chapter_id):
         """
-        Câu lệnh Cypher phức hợp để tạo Chương -> Nhóm -> Bệnh -> Bệnh con
-        trong cùng một transaction để đảm bảo tính toàn vẹn.
+        Làm phẳng cây Chương -> Nhóm -> Bệnh -> Bệnh con thành các dòng theo nhãn.
+        Mỗi dòng mang content_hash của các thuộc tính + node cha, để so sánh với DB.
         """
-        query = """
-        // 1. Tạo Node Chương (Chapter)
-        MERGE (c:Chapter {ID: $chapter_id})
-        SET c.name = $c_name,
-            c.description = $c_desc,
-            c.name_vector = [], 
-            c.desc_vector = []
-
-        // 2. Xử lý các Nhóm bệnh (Group) con của Chương này
-        WITH c
-        UNWIND $groups AS group_data
-        MERGE (g:Group {ID: group_data.code})
-        SET g.name = group_data.name,
-            g.description = group_data.description,
-            g.name_vector = [],
-            g.code_vector = [] // Đã sửa dấu # thành // tại đây
-        MERGE (g)-[:BELONGS_TO]->(c)
-
-        // 3. Xử lý Bệnh chính (Disease) con của Nhóm
-        WITH g, group_data
-        UNWIND group_data.children AS disease_data
-        // Chỉ lọc lấy những node là bệnh chính (đề phòng dữ liệu lạ)
-        WITH g, disease_data WHERE disease_data.type = 'disease'
-        MERGE (d:Disease {ID: disease_data.code})
-        SET d.name = disease_data.name,
-            d.description = disease_data.description,
-            d.type = 'disease',
-            d.synonym = "",         // Để trống
-            d.desc_vector = []      // Để trống
-        MERGE (d)-[:BELONGS_TO]->(g)
-
-        // 4. Xử lý Bệnh con (Sub_disease) con của Bệnh chính
-        WITH d, disease_data
-        UNWIND disease_data.children AS sub_data
-        WITH d, sub_data WHERE sub_data.type = 'sub_disease'
-        MERGE (sd:Disease {ID: sub_data.code})
-        SET sd.name = sub_data.name,
-            sd.description = sub_data.description,
-            sd.type = 'sub_disease',
-            sd.synonym = "",
-            sd.desc_vector = []
-        MERGE (sd)-[:IS_A]->(d)
+        c_name = chapter_data.get('name', '')
+        c_desc = chapter_data.get('description', '')
+        rows = {
+            "chapters": [{
+                "id": chapter_id, "name": c_name, "description": c_desc,
+                "content_hash": content_hash(c_name, c_desc)
+            }],
+            "groups": [],
+            "diseases": [],
+            "sub_diseases": []
+        }
+
+        for group_data in chapter_data.get('children', []):
+            g_id = group_data.get('code')
+            g_name = group_data.get('name')
+            g_desc = group_data.get('description')
+            rows["groups"].append({
+                "id": g_id, "name": g_name, "description": g_desc, "parent": chapter_id,
+                "content_hash": content_hash(g_name, g_desc, chapter_id)
+            })
+
+            # Chỉ lọc lấy những node là bệnh chính (đề phòng dữ liệu lạ)
+            for disease_data in group_data.get('children', []):
+                if disease_data.get('type') != 'disease':
+                    continue
+                d_id = disease_data.get('code')
+                d_name = disease_data.get('name')
+                d_desc = disease_data.get('description')
+                rows["diseases"].append({
+                    "id": d_id, "name": d_name, "description": d_desc, "parent": g_id,
+                    "content_hash": content_hash(d_name, d_desc, 'disease', g_id)
+                })
+
+                for sub_data in disease_data.get('children', []):
+                    if sub_data.get('type') != 'sub_disease':
+                        continue
+                    sd_name = sub_data.get('name')
+                    sd_desc = sub_data.get('description')
+                    rows["sub_diseases"].append({
+                        "id": sub_data.get('code'), "name": sd_name, "description": sd_desc, "parent": d_id,
+                        "content_hash": content_hash(sd_name, sd_desc, 'sub_disease', d_id)
+                    })
+        return rows
+
+    @staticmethod
+    def _upsert_chapter_structure(tx, rows):
         """
-        
-        # Truyền tham số vào câu lệnh Cypher
-        tx.run(query, 
-               chapter_id=chapter_id,
-               c_name=chapter_data.get('name', ''),
-               c_desc=chapter_data.get('description', ''),
-               groups=chapter_data.get('children', []) 
-        )
+        Upsert Chương -> Nhóm -> Bệnh -> Bệnh con trong cùng một transaction.
+        Node có content_hash trùng với DB được bỏ qua (không SET lại, không MERGE quan hệ),
+        node thay đổi được xóa quan hệ cha cũ trước khi MERGE lại (không để sót cạnh tới cha cũ),
+        vector chỉ được khởi tạo rỗng khi tạo mới nên không xóa vector đã upload trước đó.
+        """
+        # 1. Node Chương (Chapter)
+        chapter_query = """
+        UNWIND $rows AS row
+        OPTIONAL MATCH (old:Chapter {ID: row.id})
+        WITH row, CASE WHEN old IS NULL THEN 'created'
+                       WHEN old.content_hash = row.content_hash THEN 'unchanged'
+                       ELSE 'updated' END AS status
+        CALL {
+            WITH row, status
+            WITH row WHERE status <> 'unchanged'
+            MERGE (c:Chapter {ID: row.id})
+            ON CREATE SET c.name_vector = [],
+                          c.desc_vector = []
+            SET c.name = row.name,
+                c.description = row.description,
+                c.content_hash = row.content_hash
+        }
+        RETURN status, count(*) AS total
+        """
+
+        # 2. Nhóm bệnh (Group) con của Chương
+        group_query = """
+        UNWIND $rows AS row
+        OPTIONAL MATCH (old:Group {ID: row.id})
+        WITH row, CASE WHEN old IS NULL THEN 'created'
+                       WHEN old.content_hash = row.content_hash THEN 'unchanged'
+                       ELSE 'updated' END AS status
+        CALL {
+            WITH row, status
+            WITH row, status WHERE status <> 'unchanged'
+            MERGE (g:Group {ID: row.id})
+            ON CREATE SET g.name_vector = [],
+                          g.code_vector = []
+            SET g.name = row.name,
+                g.description = row.description,
+                g.content_hash = row.content_hash
+            WITH g, row, status
+            // Node thay đổi: xóa quan hệ cha cũ (có thể đã đổi chương) rồi MERGE lại theo dữ liệu mới
+            OPTIONAL MATCH (g)-[old_rel:BELONGS_TO]->(:Chapter)
+            WHERE status = 'updated'
+            DELETE old_rel
+            WITH DISTINCT g, row
+            MATCH (c:Chapter {ID: row.parent})
+            MERGE (g)-[:BELONGS_TO]->(c)
+        }
+        RETURN status, count(*) AS total
+        """
+
+        # 3. Bệnh chính (Disease) con của Nhóm / 4. Bệnh con (Sub_disease) con của Bệnh chính
+        disease_query = """
+        UNWIND $rows AS row
+        OPTIONAL MATCH (old:Disease {ID: row.id})
+        WITH row, CASE WHEN old IS NULL THEN 'created'
+                       WHEN old.content_hash = row.content_hash THEN 'unchanged'
+                       ELSE 'updated' END AS status
+        CALL {
+            WITH row, status
+            WITH row, status WHERE status <> 'unchanged'
+            MERGE (d:Disease {ID: row.id})
+            ON CREATE SET d.synonym = "",       // Để trống
+                          d.desc_vector = []    // Để trống
+            SET d.name = row.name,
+                d.description = row.description,
+                d.type = $type,
+                d.content_hash = row.content_hash
+            WITH d, row, status
+            // Xóa cả BELONGS_TO lẫn IS_A cũ: bệnh có thể đổi nhóm hoặc đổi loại (bệnh chính <-> bệnh con)
+            OPTIONAL MATCH (d)-[old_rel:BELONGS_TO|IS_A]->()
+            WHERE status = 'updated'
+            DELETE old_rel
+            WITH DISTINCT d, row
+            MATCH (p:%s {ID: row.parent})
+            MERGE (d)-[:%s]->(p)
+        }
+        RETURN status, count(*) AS total
+        """
+
+        return {
+            "Chapter": tx.run(chapter_query, rows=rows["chapters"]).data(),
+            "Group": tx.run(group_query, rows=rows["groups"]).data(),
+            "Disease": (
+                tx.run(disease_query % ("Group", "BELONGS_TO"), rows=rows["diseases"], type='disease').data()
+                + tx.run(disease_query % ("Disease", "IS_A"), rows=rows["sub_diseases"], type='sub_disease').data()
+            )
+        }
 
 if __name__ == "__main__":
     # Khởi tạo và chạy import
     importer = ICDImporter(URI, AUTH)
     try:
-        importer.clear_database()
+        if CLEAR_DATABASE:
+            importer.clear_database()
         
         importer.create_constraints()
         importer.import_data(FILE_PATH)
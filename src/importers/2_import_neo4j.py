@@ -1,17 +1,103 @@
 import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from neo4j import GraphDatabase
+from import_utils import (
+    content_hash, new_counts, format_counts, run_write, partition_of, iter_batches, iter_jsonl_batches,
+    DiseaseIndex, DanglingReport
+)
 
 # ================= CẤU HÌNH =================
-URI = "neo4j://127.0.0.1:7687" 
-AUTH = ("neo4j", "neo4j123") 
+URI = "neo4j://127.0.0.1:7687"
+AUTH = ("neo4j", "neo4j123")
 DRUG_FILE = "../../data/drug_data_grouped_translated.json"
 SYMPTOM_FILE = "../../data/symptoms_extracted_data_translated.json"
+# Preflight: tập mã bệnh hợp lệ lấy từ file ICD (None -> lấy bằng 1 truy vấn từ Neo4j)
+ICD_FILE = "../../data/icd10_data.json"
+DANGLING_REPORT_FILE = "../../data/dangling_disease_refs.csv"
+BATCH_SIZE = 1000
+WORKERS = 4                 # Số luồng ghi song song
+MAX_RETRY_TIME = 60         # Thời gian tối đa (giây) để execute_write retry lỗi tạm thời
+
+# ================= CYPHER =================
+# Pha 1: upsert node. Node có content_hash trùng với DB thì bỏ qua (không SET lại), node thay đổi
+# bị xóa quan hệ cũ cùng loại (pha 2 tạo lại đầy đủ, không sót cạnh tới bệnh đã bỏ khỏi danh sách);
+# vector chỉ khởi tạo rỗng khi tạo mới để không xóa vector do 4_import_vector.py upload
+DRUG_NODE_QUERY = """
+UNWIND $batch AS item
+OPTIONAL MATCH (old:Drug {ID: item.id})
+WITH item, CASE WHEN old IS NULL THEN 'created'
+                WHEN old.content_hash = item.content_hash THEN 'unchanged'
+                ELSE 'updated' END AS status
+CALL {
+    WITH item, status
+    WITH item, status WHERE status <> 'unchanged'
+    MERGE (d:Drug {ID: item.id})
+    ON CREATE SET d.name_vector = [],
+                  d.desc_vector = []
+    SET d.code = item.code,
+        d.name = item.name,
+        d.scientific_name = item.scientific_name,
+        d.description = item.description,
+        d.content_hash = item.content_hash
+    // Node thay đổi: xóa quan hệ TREATS cũ, pha 2 tạo lại theo danh sách bệnh mới
+    WITH d, status WHERE status = 'updated'
+    MATCH (d)-[old_rel:TREATS]->(:Disease)
+    DELETE old_rel
+}
+RETURN item.id AS id, status
+"""
+
+SYMPTOM_NODE_QUERY = """
+UNWIND $batch AS item
+OPTIONAL MATCH (old:Symptom {ID: item.id})
+WITH item, CASE WHEN old IS NULL THEN 'created'
+                WHEN old.content_hash = item.content_hash THEN 'unchanged'
+                ELSE 'updated' END AS status
+CALL {
+    WITH item, status
+    WITH item, status WHERE status <> 'unchanged'
+    MERGE (s:Symptom {ID: item.id})
+    ON CREATE SET s.name_vector = [],
+                  s.desc_vector = []
+    SET s.code = "",          // Dữ liệu trống theo yêu cầu
+        s.name = item.name,
+        s.description = "",   // Dữ liệu trống theo yêu cầu
+        s.content_hash = item.content_hash
+    WITH s, status WHERE status = 'updated'
+    MATCH (:Disease)-[old_rel:HAS_SYMPTOM]->(s)
+    DELETE old_rel
+}
+RETURN item.id AS id, status
+"""
+
+# Pha 2: tạo quan hệ (chỉ cho node mới/đã thay đổi). Danh sách bệnh đã được lọc ở preflight,
+# MATCH vẫn giữ để chỉ nối với các bệnh ĐÃ CÓ trong DB
+TREATS_QUERY = """
+UNWIND $pairs AS pair
+MATCH (dis:Disease {ID: pair.disease})
+MATCH (d:Drug {ID: pair.id})
+MERGE (d)-[:TREATS]->(dis)
+"""
+
+HAS_SYMPTOM_QUERY = """
+UNWIND $pairs AS pair
+MATCH (dis:Disease {ID: pair.disease})
+MATCH (s:Symptom {ID: pair.id})
+MERGE (dis)-[:HAS_SYMPTOM]->(s)
+"""
 
 class DetailImporter:
-    def __init__(self, uri, auth):
-        self.driver = GraphDatabase.driver(uri, auth=auth)
+    def __init__(self, uri, auth, workers=WORKERS):
+        self.driver = GraphDatabase.driver(uri, auth=auth, max_transaction_retry_time=MAX_RETRY_TIME)
+        self.workers = workers
+        self.disease_index = None
+        self.report = None
 
     def close(self):
+        if self.report is not None:
+            self.report.close()
         self.driver.close()
 
     def create_constraints(self):
@@ -25,104 +111,155 @@ class DetailImporter:
                 session.run(q)
             print("✅ Đã tạo Constraints cho Drug và Symptom.")
 
+    def preflight(self, icd_file=ICD_FILE, report_file=DANGLING_REPORT_FILE):
+        """Nạp tập mã bệnh hợp lệ một lần và mở file báo cáo mã bệnh không tồn tại"""
+        if icd_file and os.path.exists(icd_file):
+            self.disease_index = DiseaseIndex.from_icd_file(icd_file)
+            source = icd_file
+        else:
+            self.disease_index = DiseaseIndex.from_database(self.driver)
+            source = "Neo4j"
+        print(f"📇 Đã nạp {len(self.disease_index)} mã bệnh hợp lệ từ {source}")
+        self.report = DanglingReport(report_file)
+
+    def resolve_diseases(self, label, node_id, name, codes):
+        """Bỏ các mã bệnh không tồn tại trước khi gửi lên server và ghi lại vào báo cáo"""
+        if self.disease_index is None:
+            return codes
+        valid, unresolved = self.disease_index.split(codes)
+        if self.report is not None:
+            self.report.add(label, node_id, name, unresolved)
+        return valid
+
+    def drug_row(self, item):
+        # Map các trường JSON sang cấu trúc Python dict chuẩn
+        row = {
+            "id": item.get("id"),
+            "code": item.get("mã thuốc", ""),
+            "name": item.get("tên thuốc", ""),
+            "scientific_name": item.get("tên y sinh", ""),
+            "description": item.get("mô tả", "")
+        }
+        # Hash tính trên danh sách đã lọc: khi mã bệnh xuất hiện trong ICD, node được coi là
+        # thay đổi và quan hệ còn thiếu sẽ được tạo ở lần import sau
+        row["diseases"] = self.resolve_diseases("Drug", row["id"], row["name"], item.get("danh sách bệnh", []))
+        row["content_hash"] = content_hash(
+            row["code"], row["name"], row["scientific_name"], row["description"], row["diseases"]
+        )
+        return row
+
+    def symptom_row(self, item):
+        row = {
+            "id": item.get("id"),
+            "name": item.get("tên", "")
+        }
+        row["diseases"] = self.resolve_diseases("Symptom", row["id"], row["name"], item.get("bệnh", []))
+        row["content_hash"] = content_hash(row["name"], row["diseases"])
+        return row
+
+    def load_two_phase(self, batches, node_query, edge_query, name):
+        """
+        Pha 1: upsert node theo các batch song song (batch đọc theo luồng, tối đa
+        2 x WORKERS batch nằm trong bộ nhớ). Cặp (node, bệnh) của các node mới/thay đổi
+        được ghi tạm ra file theo partition của ID thuốc / triệu chứng.
+        Pha 2: tạo quan hệ theo từng partition -> mọi quan hệ của một Drug/Symptom nằm
+        trong cùng một luồng, không bao giờ tranh khóa node đó giữa các luồng.
+        Phía Disease vẫn dùng chung giữa các partition (một bệnh có nhiều thuốc/triệu chứng ở
+        các partition khác nhau): Neo4j khóa theo nhóm quan hệ trên node dày nên xung đột
+        ít hơn, phần còn lại được execute_write tự retry và in ra theo từng partition.
+        """
+        counts = new_counts()
+        retries = 0
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            part_paths = [os.path.join(tmp_dir, f"part_{p}.jsonl") for p in range(self.workers)]
+            part_files = [open(path, 'w', encoding='utf-8') for path in part_paths]
+
+            def collect(future, batch):
+                nonlocal retries
+                records, n_retry = future.result()
+                retries += n_retry
+                status_of = {record["id"]: record["status"] for record in records}
+                for record in records:
+                    counts[record["status"]] += 1
+                for row in batch:
+                    if status_of.get(row["id"]) == "unchanged":
+                        continue
+                    part_file = part_files[partition_of(row["id"], self.workers)]
+                    for disease_code in row["diseases"]:
+                        pair = {"id": row["id"], "disease": disease_code}
+                        part_file.write(json.dumps(pair, ensure_ascii=False) + "\n")
+
+            # ----- Pha 1: Node -----
+            try:
+                with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                    pending = {}
+                    for index, batch in enumerate(batches, start=1):
+                        future = pool.submit(run_write, self.driver, node_query, batch=batch)
+                        pending[future] = batch
+                        print(f"   ↳ Đang upsert batch {name} #{index}...")
+                        if len(pending) >= self.workers * 2:
+                            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                            for future in done:
+                                collect(future, pending.pop(future))
+                    for future in list(pending):
+                        collect(future, pending.pop(future))
+            finally:
+                for f in part_files:
+                    f.close()
+            print(f"   {format_counts(counts)}")
+
+            # ----- Pha 2: Quan hệ, mỗi luồng một partition ID thuốc / triệu chứng -----
+            def load_partition(path):
+                n_pairs, n_retry = 0, 0
+                for pairs in iter_jsonl_batches(path, BATCH_SIZE):
+                    # Sắp xếp để các transaction lấy khóa theo cùng một thứ tự
+                    pairs.sort(key=lambda p: (str(p["id"]), str(p["disease"])))
+                    _, r = run_write(self.driver, edge_query, pairs=pairs)
+                    n_pairs += len(pairs)
+                    n_retry += r
+                return n_pairs, n_retry
+
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for index, (n_pairs, n_retry) in enumerate(pool.map(load_partition, part_paths)):
+                    retries += n_retry
+                    print(f"   ↳ Đã xử lý partition quan hệ {name} #{index}: {n_pairs} cặp, {n_retry} lần retry")
+
+        print(f"   🔁 Số lần retry do lỗi tạm thời: {retries}")
+        return counts
+
     def import_drugs(self, file_path):
-        print(f"💊 Đang đọc file thuốc: {file_path}...")
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        except FileNotFoundError:
+        print(f"💊 Đang đọc file thuốc (streaming): {file_path}...")
+        if not os.path.exists(file_path):
             print(f"❌ Không tìm thấy file: {file_path}")
             return
 
-        query = """
-        UNWIND $batch AS item
-        // 1. Tạo Node Thuốc
-        MERGE (d:Drug {ID: item.id})
-        SET d.code = item.code,
-            d.name = item.name,
-            d.scientific_name = item.scientific_name,
-            d.description = item.description,
-            d.name_vector = [],
-            d.desc_vector = []
-        
-        // 2. Tạo quan hệ với Bệnh (Lookup các bệnh trong danh sách)
-        WITH d, item
-        UNWIND item.diseases AS disease_code
-        // MATCH để chỉ nối với các bệnh ĐÃ CÓ trong DB
-        MATCH (dis:Disease {ID: disease_code})
-        MERGE (d)-[:TREATS]->(dis)
-        """
-
-        # Batching: Xử lý từng nhóm 1000 item để không quá tải
-        batch_size = 1000
-        with self.driver.session() as session:
-            total = len(data)
-            for i in range(0, total, batch_size):
-                batch = []
-                for item in data[i:i+batch_size]:
-                    # Map các trường JSON sang cấu trúc Python dict chuẩn
-                    batch.append({
-                        "id": item.get("id"),
-                        "code": item.get("mã thuốc", ""),
-                        "name": item.get("tên thuốc", ""),
-                        "scientific_name": item.get("tên y sinh", ""),
-                        "description": item.get("mô tả", ""),
-                        "diseases": item.get("danh sách bệnh", [])
-                    })
-                
-                print(f"   ↳ Đang import batch thuốc {i} - {min(i+batch_size, total)}...")
-                session.run(query, batch=batch)
+        batches = iter_batches(file_path, self.drug_row, BATCH_SIZE)
+        self.load_two_phase(batches, DRUG_NODE_QUERY, TREATS_QUERY, "thuốc")
+        if self.report is not None:
+            print(f"   {self.report.summary('Drug')}")
         print("✅ Hoàn tất import Thuốc!")
 
     def import_symptoms(self, file_path):
-        print(f"🌡️ Đang đọc file triệu chứng: {file_path}...")
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        except FileNotFoundError:
+        print(f"🌡️ Đang đọc file triệu chứng (streaming): {file_path}...")
+        if not os.path.exists(file_path):
             print(f"❌ Không tìm thấy file: {file_path}")
             return
 
-        query = """
-        UNWIND $batch AS item
-        // 1. Tạo Node Triệu chứng
-        MERGE (s:Symptom {ID: item.id})
-        SET s.code = "",          // Dữ liệu trống theo yêu cầu
-            s.name = item.name,
-            s.description = "",   // Dữ liệu trống theo yêu cầu
-            s.name_vector = [],
-            s.desc_vector = []
-        
-        // 2. Tạo quan hệ Bệnh -> Có Triệu chứng
-        WITH s, item
-        UNWIND item.diseases AS disease_code
-        MATCH (dis:Disease {ID: disease_code})
-        MERGE (dis)-[:HAS_SYMPTOM]->(s)
-        """
-
-        batch_size = 1000
-        with self.driver.session() as session:
-            total = len(data)
-            for i in range(0, total, batch_size):
-                batch = []
-                for item in data[i:i+batch_size]:
-                    batch.append({
-                        "id": item.get("id"),
-                        "name": item.get("tên", ""),
-                        "diseases": item.get("bệnh", [])
-                    })
-                
-                print(f"   ↳ Đang import batch triệu chứng {i} - {min(i+batch_size, total)}...")
-                session.run(query, batch=batch)
+        batches = iter_batches(file_path, self.symptom_row, BATCH_SIZE)
+        self.load_two_phase(batches, SYMPTOM_NODE_QUERY, HAS_SYMPTOM_QUERY, "triệu chứng")
+        if self.report is not None:
+            print(f"   {self.report.summary('Symptom')}")
         print("✅ Hoàn tất import Triệu chứng!")
 
 if __name__ == "__main__":
     importer = DetailImporter(URI, AUTH)
     try:
         importer.create_constraints()
-        # Chạy lần lượt
+        importer.preflight()
+        # Chạy lần lượt (bên trong mỗi bước đã song song theo WORKERS)
         importer.import_drugs(DRUG_FILE)
         print("-" * 30)
         importer.import_symptoms(SYMPTOM_FILE)
     finally:
-        importer.close()
\ No newline at end of file
+        importer.close()
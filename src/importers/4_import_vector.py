@@ -1,133 +1,236 @@
-import ijson
 import os
+import queue
+import sys
+import threading
+import time
+from itertools import chain
 from neo4j import GraphDatabase
+from import_utils import run_write
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from vector_artifacts import VectorArtifact
+from vector_search import create_vector_indexes, native_vector_query
 
 # ================= CẤU HÌNH =================
 URI = "neo4j://127.0.0.1:7687"
 AUTH = ("neo4j", "neo4j123")
-FILES = {
-    "icd10": "../../data/icd10_embedded.json",
-    "drugs": "../../data/drugs_embedded.json",
-    "symptoms": "../../data/symptoms_embedded.json"
+# Thư mục vector do 3_embeding.py xuất ra (ma trận .npy + ids.json + meta.json)
+VECTOR_DIRS = {
+    "icd10": "../../data/vectors/icd10",
+    "drugs": "../../data/vectors/drugs",
+    "symptoms": "../../data/vectors/symptoms"
 }
 BATCH_SIZE = 500 
+# Chỉ đẩy các node có vector_hash trên DB khác với artifact (node mới, đổi text, đổi model, DB mới/đã xóa).
+# DB chưa có vector nào -> tự đẩy toàn bộ. Node còn vector_hash nhưng đã bị bỏ khỏi artifact -> xóa vector.
+ONLY_CHANGED = True
+# Ghi vector bằng db.create.setNodeVectorProperty và tạo vector index cosine (Neo4j 5.13+),
+# xem src/utils/vector_search.py. Tắt nếu Neo4j cũ hơn.
+NATIVE_VECTORS = True
+# Pipeline upload: 1 luồng đọc/gom batch từ artifact -> hàng đợi giới hạn -> WORKERS session ghi song song
+WORKERS = 4
+QUEUE_SIZE = 8              # Số batch tối đa chờ trong hàng đợi (backpressure cho luồng đọc)
+MAX_RETRY_TIME = 60         # Thời gian tối đa (giây) để execute_write retry lỗi tạm thời
+PROGRESS_EVERY = 20         # In tiến độ sau mỗi N batch
+
+# Các trường vector theo nhãn (Group có thêm code_vector)
+ICD_LABEL_FIELDS = {
+    "Chapter": ["name_vector", "desc_vector"],
+    "Group": ["name_vector", "desc_vector", "code_vector"],
+    "Disease": ["name_vector", "desc_vector"]
+}
+FLAT_FIELDS = ["name_vector", "desc_vector"]
+
+
+def vector_query(label, fields):
+    """UNWIND $batch + MATCH theo nhãn và ID (dùng index của ràng buộc ID thay vì quét toàn bộ node)"""
+    sets = ",\n    ".join(f"n.{field} = row.{field}" for field in fields + ["vector_hash"])
+    return f"""
+UNWIND $batch AS row
+MATCH (n:{label} {{ID: row.id}})
+SET {sets}
+"""
+
+
+def clear_query(label, fields):
+    """Xóa vector (về [] như node mới tạo) và vector_hash của các node không còn trong artifact"""
+    sets = ",\n    ".join(f"n.{field} = []" for field in fields)
+    return f"""
+UNWIND $batch AS row
+MATCH (n:{label} {{ID: row.id}})
+SET {sets}
+REMOVE n.vector_hash
+"""
+
+
+HASH_QUERY = """
+MATCH (n:%s)
+WHERE n.vector_hash IS NOT NULL
+RETURN n.ID AS id, n.vector_hash AS hash
+"""
+
+class UploadMetrics:
+    """Số liệu upload dùng chung giữa các luồng ghi: batch đang ghi, node/giây, số lần retry"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.in_flight = 0
+        self.batches = 0
+        self.rows = 0
+        self.retries = 0
+        self.by_label = {}
+
+    def begin(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def end(self, label, rows, retries):
+        with self.lock:
+            self.in_flight -= 1
+            self.batches += 1
+            self.rows += rows
+            self.retries += retries
+            self.by_label[label] = self.by_label.get(label, 0) + rows
+            return self.batches
+
+    def rows_per_sec(self):
+        return self.rows / max(time.perf_counter() - self.started, 1e-9)
+
+    def line(self, queued):
+        return (f"   ...{self.rows} node | {self.rows_per_sec():.0f} node/s | {self.in_flight} batch đang ghi | "
+                f"{queued} batch chờ | 🔁 {self.retries} retry")
+
 
 class VectorImporterStream:
-    def __init__(self, uri, auth):
-        self.driver = GraphDatabase.driver(uri, auth=auth)
+    def __init__(self, uri, auth, only_changed=ONLY_CHANGED, workers=WORKERS):
+        self.driver = GraphDatabase.driver(uri, auth=auth, max_transaction_retry_time=MAX_RETRY_TIME)
+        self.only_changed = only_changed
+        self.workers = workers
 
     def close(self):
         self.driver.close()
 
-    # Hàm hỗ trợ chuyển Decimal -> float
-    def to_float_list(self, vector):
-        if not vector:
-            return []
-        # Ép kiểu từng phần tử trong mảng sang float
-        return [float(x) for x in vector]
-
-    def update_icd10_vectors(self, file_path):
-        print(f"🔄 Đang xử lý file {file_path} theo luồng...")
-        
-        query_normal = """
-        MATCH (n) WHERE n.ID = $id
-        SET n.name_vector = $nv, n.desc_vector = $dv
+    def db_hashes(self, label):
+        """{ID: vector_hash} của các node nhãn label đã có vector trên DB (chỉ ID + hash, không tải vector)"""
+        with self.driver.session() as session:
+            return {record["id"]: record["hash"] for record in session.run(HASH_QUERY % label)}
+
+    def selected_rows(self, artifact, label):
         """
-        query_group = """
-        MATCH (n:Group) WHERE n.ID = $id
-        SET n.name_vector = $nv, n.desc_vector = $dv, n.code_vector = $cv
+        (các dòng cần đẩy lên hoặc None = tất cả, các ID cần xóa vector) của một nhãn:
+        so vector_hash của từng dòng artifact với vector_hash đang lưu trên node.
         """
+        if not self.only_changed:
+            return None, []
+        if artifact.hashes is None:
+            print(f"   ⚠️ Artifact không có hash, đẩy toàn bộ vector {label}")
+            return None, []
+        stored = self.db_hashes(label)
+        if not stored:
+            print(f"   ↳ DB chưa có vector {label}, đẩy toàn bộ")
+            return None, []
+        rows, current = set(), set()
+        for row, (node_id, lb) in enumerate(zip(artifact.ids, artifact.labels)):
+            if lb != label:
+                continue
+            current.add(node_id)
+            if stored.get(node_id) != artifact.vector_hash(row):
+                rows.add(row)
+        removed = [node_id for node_id in stored if node_id not in current]
+        print(f"   ↳ {label}: đẩy {len(rows)}/{len(current)} node mới/thay đổi, xóa vector {len(removed)} node đã bỏ")
+        return rows, removed
 
-        def process_node_recursive(item, session, index=None):
-            node_type = item.get('type')
-            node_id = item.get('code')
-            
-            if node_type == 'chapter' and index is not None:
-                node_id = str(index)
-
-            # --- SỬA LỖI TẠI ĐÂY: Ép kiểu sang float ---
-            nv = self.to_float_list(item.get('name_vector', []))
-            dv = self.to_float_list(item.get('desc_vector', []))
-            
-            params = {
-                "id": node_id,
-                "nv": nv,
-                "dv": dv
-            }
-
-            if node_type == 'group':
-                # Ép kiểu code_vector
-                cv = self.to_float_list(item.get('code_vector', []))
-                params["cv"] = cv
-                session.run(query_group, **params)
-            else:
-                session.run(query_normal, **params)
-
-            if 'children' in item:
-                for child in item['children']:
-                    process_node_recursive(child, session)
+    def label_jobs(self, artifact, label, fields):
+        """Sinh các batch (nhãn, câu lệnh, batch) của một nhãn: UNWIND + MATCH có nhãn (dùng index của ràng buộc ID)"""
+        selected, removed = self.selected_rows(artifact, label)
+        for start in range(0, len(removed), BATCH_SIZE):
+            yield label, clear_query(label, fields), [{"id": node_id} for node_id in removed[start:start + BATCH_SIZE]]
+        query = native_vector_query(label, fields) if NATIVE_VECTORS else vector_query(label, fields)
+        for batch in artifact.iter_batches(fields, BATCH_SIZE, labels={label}, rows=selected):
+            yield label, query, batch
 
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                with self.driver.session() as session:
-                    chapters = ijson.items(f, 'item')
-                    for i, chapter in enumerate(chapters, start=1):
-                        print(f"   ↳ Đang update Chapter {i}...")
-                        process_node_recursive(chapter, session, index=i)
-            print("✅ Xong ICD-10.")
-        except FileNotFoundError:
-            print(f"⚠️ Không tìm thấy file {file_path}")
-
-    def update_flat_vectors(self, file_path, label):
-        print(f"🔄 Đang xử lý file {file_path} cho nhãn {label}...")
-        
-        query = f"""
-        UNWIND $batch as row
-        MATCH (n:{label} {{ID: row.id}})
-        SET n.name_vector = row.name_vector,
-            n.desc_vector = row.desc_vector
+    def icd10_jobs(self, vector_dir):
+        print(f"🔄 Đang xử lý vector ICD-10 từ {vector_dir}...")
+        artifact = VectorArtifact(vector_dir)
+        # Cây ICD đã được làm phẳng trong artifact (mỗi dòng có nhãn) -> đẩy theo từng nhãn
+        for label, fields in ICD_LABEL_FIELDS.items():
+            yield from self.label_jobs(artifact, label, fields)
+
+    def flat_jobs(self, vector_dir, label):
+        print(f"🔄 Đang xử lý vector {vector_dir} cho nhãn {label}...")
+        artifact = VectorArtifact(vector_dir)
+        yield from self.label_jobs(artifact, label, FLAT_FIELDS)
+
+    def upload(self, jobs):
+        """
+        Luồng hiện tại đọc artifact và gom batch, đẩy vào hàng đợi giới hạn QUEUE_SIZE
+        (đầy thì chờ -> không đọc trước quá xa). WORKERS luồng ghi lấy batch ra và ghi bằng
+        execute_write (tự retry lỗi tạm thời) -> đọc phía client chồng lên ghi phía server.
         """
-        
+        metrics = UploadMetrics()
+        jobs_queue = queue.Queue(maxsize=QUEUE_SIZE)
+        errors = []
+
+        def writer():
+            while True:
+                job = jobs_queue.get()
+                if job is None:
+                    return
+                if errors:
+                    continue  # Đã có lỗi: chỉ xả hàng đợi để luồng đọc không bị chặn
+                label, query, batch = job
+                metrics.begin()
+                try:
+                    _, retries = run_write(self.driver, query, batch=batch)
+                except Exception as e:
+                    errors.append(e)
+                    metrics.end(label, 0, 0)
+                    continue
+                if metrics.end(label, len(batch), retries) % PROGRESS_EVERY == 0:
+                    print(metrics.line(jobs_queue.qsize()))
+
+        threads = [threading.Thread(target=writer, daemon=True) for _ in range(self.workers)]
+        for t in threads:
+            t.start()
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                with self.driver.session() as session:
-                    items = ijson.items(f, 'item')
-                    batch = []
-                    count = 0
-                    for item in items:
-                        # --- SỬA LỖI TẠI ĐÂY: Ép kiểu sang float ---
-                        nv = self.to_float_list(item.get('name_vector', []))
-                        dv = self.to_float_list(item.get('desc_vector', []))
-
-                        batch.append({
-                            "id": item.get('id'),
-                            "name_vector": nv,
-                            "desc_vector": dv
-                        })
-                        
-                        if len(batch) >= BATCH_SIZE:
-                            session.run(query, batch=batch)
-                            count += len(batch)
-                            print(f"   ...Đã update {count} node {label}")
-                            batch = [] 
-                    
-                    if batch:
-                        session.run(query, batch=batch)
-                        print(f"   ...Đã update {count + len(batch)} node {label}")
-                        
-            print(f"✅ Xong {label}.")
-        except FileNotFoundError:
-            print(f"⚠️ Không tìm thấy file {file_path}")
+            for job in jobs:
+                if errors:
+                    break
+                jobs_queue.put(job)
+        finally:
+            for _ in threads:
+                jobs_queue.put(None)
+            for t in threads:
+                t.join()
+        if errors:
+            raise errors[0]
+
+        print(metrics.line(0))
+        for label, rows in metrics.by_label.items():
+            print(f"✅ Xong {label}: {rows} node.")
+        return metrics
+
+    def update_icd10_vectors(self, vector_dir):
+        self.upload(self.icd10_jobs(vector_dir))
+
+    def update_flat_vectors(self, vector_dir, label):
+        self.upload(self.flat_jobs(vector_dir, label))
 
     def run(self):
-        if os.path.exists(FILES['icd10']):
-            self.update_icd10_vectors(FILES['icd10'])
-        
-        if os.path.exists(FILES['drugs']):
-            self.update_flat_vectors(FILES['drugs'], "Drug")
-            
-        if os.path.exists(FILES['symptoms']):
-            self.update_flat_vectors(FILES['symptoms'], "Symptom")
+        dims = [VectorArtifact(path).dim for path in VECTOR_DIRS.values() if VectorArtifact.exists(path)]
+
+        # Gộp cả 3 bộ dữ liệu vào một pipeline để luồng ghi không phải chờ giữa các bộ
+        jobs = []
+        for key, label in (("icd10", None), ("drugs", "Drug"), ("symptoms", "Symptom")):
+            if not VectorArtifact.exists(VECTOR_DIRS[key]):
+                print(f"⚠️ Không tìm thấy vector {VECTOR_DIRS[key]}")
+                continue
+            jobs.append(self.icd10_jobs(VECTOR_DIRS[key]) if label is None else self.flat_jobs(VECTOR_DIRS[key], label))
+        self.upload(chain.from_iterable(jobs))
+
+        if NATIVE_VECTORS and dims:
+            create_vector_indexes(self.driver, dims[0])
 
 if __name__ == "__main__":
     importer = VectorImporterStream(URI, AUTH)
@@ -0,0 +1,245 @@
+import csv
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from vector_artifacts import VectorArtifact
+from import_utils import content_hash
+
+# ================= CẤU HÌNH =================
+# Xuất dữ liệu ra CSV theo định dạng của `neo4j-admin database import`
+# (nhanh hơn rất nhiều so với MERGE từng batch trong 1_import_neo4j.py / 2_import_neo4j.py)
+ICD_FILE = "../../data/icd10_data.json"
+DRUG_FILE = "../../data/drug_data_grouped_translated.json"
+SYMPTOM_FILE = "../../data/symptoms_extracted_data_translated.json"
+
+# Khi bật, ghi kèm vector từ các thư mục vector (đầu ra của 3_embeding.py)
+INCLUDE_VECTORS = False
+VECTOR_DIRS = {
+    "icd10": "../../data/vectors/icd10",
+    "drugs": "../../data/vectors/drugs",
+    "symptoms": "../../data/vectors/symptoms"
+}
+
+OUTPUT_DIR = "../../data/neo4j_import"
+DATABASE_NAME = "neo4j"
+ARRAY_DELIMITER = ";"
+
+# Header cho từng file node / relationship (ID space = tên nhãn)
+# content_hash tính giống hệt 1_import_neo4j.py / 2_import_neo4j.py để lần import tăng dần
+# đầu tiên sau bulk load thấy node "không đổi" thay vì xóa và MERGE lại toàn bộ quan hệ
+NODE_HEADERS = {
+    "Chapter": ["ID:ID(Chapter)", "name", "description", "content_hash:string"],
+    "Group": ["ID:ID(Group)", "name", "description", "content_hash:string"],
+    "Disease": ["ID:ID(Disease)", "name", "description", "type", "synonym", "content_hash:string"],
+    "Drug": ["ID:ID(Drug)", "code", "name", "scientific_name", "description", "content_hash:string"],
+    "Symptom": ["ID:ID(Symptom)", "code", "name", "description", "content_hash:string"]
+}
+VECTOR_FIELDS = {
+    "Chapter": ["name_vector", "desc_vector"],
+    "Group": ["name_vector", "desc_vector", "code_vector"],
+    "Disease": ["name_vector", "desc_vector"],
+    "Drug": ["name_vector", "desc_vector"],
+    "Symptom": ["name_vector", "desc_vector"]
+}
+RELATIONSHIPS = {
+    # tên file: (loại quan hệ, ID space đầu, ID space cuối)
+    "group_belongs_to_chapter": ("BELONGS_TO", "Group", "Chapter"),
+    "disease_belongs_to_group": ("BELONGS_TO", "Disease", "Group"),
+    "disease_is_a_disease": ("IS_A", "Disease", "Disease"),
+    "drug_treats_disease": ("TREATS", "Drug", "Disease"),
+    "disease_has_symptom": ("HAS_SYMPTOM", "Disease", "Symptom")
+}
+
+
+class BulkCSVExporter:
+    def __init__(self, output_dir, include_vectors=False, vector_dirs=VECTOR_DIRS):
+        self.output_dir = output_dir
+        self.include_vectors = include_vectors
+        # Nhãn -> thư mục vector chứa nhãn đó
+        self.artifacts = {}
+        if include_vectors:
+            for key, labels in (("icd10", ("Chapter", "Group", "Disease")), ("drugs", ("Drug",)),
+                                ("symptoms", ("Symptom",))):
+                if VectorArtifact.exists(vector_dirs[key]):
+                    artifact = VectorArtifact(vector_dirs[key])
+                    self.artifacts.update({label: artifact for label in labels})
+                else:
+                    print(f"⚠️ Không tìm thấy vector {vector_dirs[key]}, bỏ trống các cột vector")
+        # {label: {ID: row}} -> trùng ID thì bản ghi sau ghi đè (giống MERGE + SET)
+        self.nodes = {label: {} for label in NODE_HEADERS}
+        # {tên file: set((start, end))} -> loại bỏ quan hệ trùng (giống MERGE)
+        self.rels = {name: set() for name in RELATIONSHIPS}
+        self.dangling = {"drug_treats_disease": 0, "disease_has_symptom": 0}
+
+    # ================= ĐỌC DỮ LIỆU =================
+
+    @staticmethod
+    def load_json(file_path):
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            print(f"❌ Không tìm thấy file: {file_path}")
+            return []
+
+    def vector_values(self, node_id, label):
+        """
+        Lấy các cột vector của node + vector_hash (chỉ khi bật INCLUDE_VECTORS).
+        vector_hash giống 4_import_vector.py ghi nên lần chạy sau không đẩy lại vector đã có.
+        """
+        if not self.include_vectors:
+            return []
+        artifact = self.artifacts.get(label)
+        row = artifact.row_of(label, node_id) if artifact is not None else None
+        if row is None:
+            return [[] for _ in VECTOR_FIELDS[label]] + [None]
+        return [artifact.vector(field, row) for field in VECTOR_FIELDS[label]] + [artifact.vector_hash(row)]
+
+    def collect_icd10(self, data):
+        """Làm phẳng cây Chương -> Nhóm -> Bệnh -> Bệnh con (cùng quy ước ID với 1_import_neo4j.py)"""
+        for index, chapter_data in enumerate(data, start=1):
+            chapter_id = str(index)
+            c_name = chapter_data.get('name', '')
+            c_desc = chapter_data.get('description', '')
+            self.nodes["Chapter"][chapter_id] = [
+                chapter_id, c_name, c_desc, content_hash(c_name, c_desc)
+            ] + self.vector_values(chapter_id, "Chapter")
+
+            for group_data in chapter_data.get('children', []):
+                group_id = group_data.get('code')
+                g_name = group_data.get('name')
+                g_desc = group_data.get('description')
+                self.nodes["Group"][group_id] = [
+                    group_id, g_name or '', g_desc or '', content_hash(g_name, g_desc, chapter_id)
+                ] + self.vector_values(group_id, "Group")
+                self.rels["group_belongs_to_chapter"].add((group_id, chapter_id))
+
+                for disease_data in group_data.get('children', []):
+                    if disease_data.get('type') != 'disease':
+                        continue
+                    disease_id = disease_data.get('code')
+                    d_name = disease_data.get('name')
+                    d_desc = disease_data.get('description')
+                    self.nodes["Disease"][disease_id] = [
+                        disease_id, d_name or '', d_desc or '', 'disease', "",
+                        content_hash(d_name, d_desc, 'disease', group_id)
+                    ] + self.vector_values(disease_id, "Disease")
+                    self.rels["disease_belongs_to_group"].add((disease_id, group_id))
+
+                    for sub_data in disease_data.get('children', []):
+                        if sub_data.get('type') != 'sub_disease':
+                            continue
+                        sub_id = sub_data.get('code')
+                        sd_name = sub_data.get('name')
+                        sd_desc = sub_data.get('description')
+                        self.nodes["Disease"][sub_id] = [
+                            sub_id, sd_name or '', sd_desc or '', 'sub_disease', "",
+                            content_hash(sd_name, sd_desc, 'sub_disease', disease_id)
+                        ] + self.vector_values(sub_id, "Disease")
+                        self.rels["disease_is_a_disease"].add((sub_id, disease_id))
+
+    def link_diseases(self, rel_name, node_id, disease_codes, reverse=False):
+        """
+        Chỉ nối với các bệnh có trong cây ICD-10 (tương đương MATCH trong Cypher).
+        Trả về danh sách mã hợp lệ, giữ nguyên thứ tự (giống DiseaseIndex.split) để tính content_hash.
+        """
+        valid = []
+        for code in disease_codes:
+            if code not in self.nodes["Disease"]:
+                self.dangling[rel_name] += 1
+                continue
+            valid.append(code)
+            pair = (code, node_id) if reverse else (node_id, code)
+            self.rels[rel_name].add(pair)
+        return valid
+
+    def collect_drugs(self, data):
+        for item in data:
+            drug_id = item.get("id")
+            values = [item.get("mã thuốc", ""), item.get("tên thuốc", ""), item.get("tên y sinh", ""),
+                      item.get("mô tả", "")]
+            diseases = self.link_diseases("drug_treats_disease", drug_id, item.get("danh sách bệnh", []))
+            # Cùng thứ tự tham số với drug_row() của 2_import_neo4j.py
+            self.nodes["Drug"][drug_id] = (
+                [drug_id] + values + [content_hash(*values, diseases)] + self.vector_values(drug_id, "Drug")
+            )
+
+    def collect_symptoms(self, data):
+        for item in data:
+            symptom_id = item.get("id")
+            name = item.get("tên", "")
+            diseases = self.link_diseases("disease_has_symptom", symptom_id, item.get("bệnh", []), reverse=True)
+            self.nodes["Symptom"][symptom_id] = [
+                symptom_id, "", name, "", content_hash(name, diseases)
+            ] + self.vector_values(symptom_id, "Symptom")
+
+    # ================= GHI FILE CSV =================
+
+    def format_value(self, value):
+        if isinstance(value, list):
+            return ARRAY_DELIMITER.join(str(float(x)) for x in value)
+        return "" if value is None else value
+
+    def write_nodes(self):
+        for label, rows in self.nodes.items():
+            header = list(NODE_HEADERS[label])
+            if self.include_vectors:
+                header += [f"{field}:float[]" for field in VECTOR_FIELDS[label]] + ["vector_hash:string"]
+
+            path = os.path.join(self.output_dir, f"nodes_{label.lower()}.csv")
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(header)
+                for row in rows.values():
+                    writer.writerow([self.format_value(v) for v in row])
+            print(f"   ↳ {label}: {len(rows)} node -> {path}")
+
+    def write_relationships(self):
+        for name, (rel_type, start_space, end_space) in RELATIONSHIPS.items():
+            path = os.path.join(self.output_dir, f"rels_{name}.csv")
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow([f":START_ID({start_space})", f":END_ID({end_space})"])
+                writer.writerows(sorted(self.rels[name], key=lambda p: (str(p[0]), str(p[1]))))
+            print(f"   ↳ {rel_type} ({start_space} -> {end_space}): {len(self.rels[name])} quan hệ -> {path}")
+
+    def import_command(self):
+        """Câu lệnh neo4j-admin tương ứng với các file đã xuất"""
+        parts = ["neo4j-admin database import full", DATABASE_NAME, "--overwrite-destination",
+                 "--multiline-fields=true", f"--array-delimiter='{ARRAY_DELIMITER}'"]
+        for label in NODE_HEADERS:
+            parts.append(f"--nodes={label}=nodes_{label.lower()}.csv")
+        for name, (rel_type, _, _) in RELATIONSHIPS.items():
+            parts.append(f"--relationships={rel_type}=rels_{name}.csv")
+        return " \\\n    ".join(parts)
+
+    def run(self, icd_file, drug_file, symptom_file):
+        start_time = time.time()
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        print(f"📥 Đang đọc cây ICD-10: {icd_file}...")
+        self.collect_icd10(self.load_json(icd_file))
+        print(f"💊 Đang đọc file thuốc: {drug_file}...")
+        self.collect_drugs(self.load_json(drug_file))
+        print(f"🌡️ Đang đọc file triệu chứng: {symptom_file}...")
+        self.collect_symptoms(self.load_json(symptom_file))
+
+        print(f"\n💾 Đang ghi CSV vào {self.output_dir}...")
+        self.write_nodes()
+        self.write_relationships()
+
+        print("\n⚠️ Mã bệnh không tồn tại (đã bỏ qua):")
+        print(f"   - TREATS: {self.dangling['drug_treats_disease']}")
+        print(f"   - HAS_SYMPTOM: {self.dangling['disease_has_symptom']}")
+        print(f"\n✅ Hoàn tất sau {round(time.time() - start_time, 2)} giây.")
+        print("▶️ Dừng Neo4j rồi chạy (trong thư mục chứa các file CSV):")
+        print(self.import_command())
+        print("ℹ️ Sau khi import xong, chạy create_constraints() của 1_import_neo4j.py và 2_import_neo4j.py.")
+
+
+if __name__ == "__main__":
+    exporter = BulkCSVExporter(OUTPUT_DIR, include_vectors=INCLUDE_VECTORS)
+    exporter.run(ICD_FILE, DRUG_FILE, SYMPTOM_FILE)
@@ -0,0 +1,152 @@
+import csv
+import hashlib
+import json
+import zlib
+import ijson
+
+
+def content_hash(*values):
+    """Hash ổn định cho nội dung của một node (thứ tự tham số phải cố định)"""
+    payload = json.dumps(values, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def new_counts():
+    return {"created": 0, "updated": 0, "unchanged": 0}
+
+
+def add_counts(counts, records):
+    """Cộng dồn các dòng {status, total} trả về từ câu lệnh upsert"""
+    for record in records:
+        counts[record["status"]] += record["total"]
+    return counts
+
+
+def format_counts(counts):
+    return (f"🆕 {counts['created']} mới | ✏️ {counts['updated']} cập nhật | "
+            f"⏭️ {counts['unchanged']} không đổi")
+
+
+def iter_batches(file_path, mapper, batch_size, prefix='item'):
+    """
+    Đọc mảng JSON theo luồng bằng ijson và gom thành từng batch đã được map,
+    bộ nhớ chỉ giữ một batch dù file lớn đến đâu.
+    """
+    with open(file_path, 'rb') as f:
+        batch = []
+        for item in ijson.items(f, prefix, use_float=True):
+            batch.append(mapper(item))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def iter_jsonl_batches(file_path, batch_size):
+    """Đọc file JSONL (mỗi dòng một object) theo từng batch"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        batch = []
+        for line in f:
+            if not line.strip():
+                continue
+            batch.append(json.loads(line))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def run_write(driver, query, **params):
+    """
+    Chạy một câu lệnh ghi trong managed transaction (execute_write).
+    Driver tự retry khi gặp lỗi tạm thời (deadlock, leader switch...), trả về (records, số lần retry).
+    Mỗi lần gọi mở session riêng nên có thể dùng song song từ nhiều thread.
+    """
+    attempts = []
+
+    def work(tx):
+        attempts.append(1)
+        return tx.run(query, **params).data()
+
+    with driver.session() as session:
+        records = session.execute_write(work)
+    return records, len(attempts) - 1
+
+
+def partition_of(key, num_partitions):
+    """Chia key vào partition cố định (ổn định giữa các lần chạy, không phụ thuộc PYTHONHASHSEED)"""
+    return zlib.crc32(str(key).encode('utf-8')) % num_partitions
+
+
+class DiseaseIndex:
+    """
+    Tập mã bệnh hợp lệ (Disease.ID) nạp một lần ở bước preflight, dùng để lọc
+    danh sách bệnh của thuốc/triệu chứng trước khi gửi lên server.
+    """
+    def __init__(self, codes):
+        self.codes = frozenset(code for code in codes if code)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, code):
+        return code in self.codes
+
+    @classmethod
+    def from_icd_file(cls, file_path):
+        """Đọc cây ICD-10 theo luồng, lấy mã của Bệnh và Bệnh con (cùng quy tắc lọc với 1_import_neo4j.py)"""
+        def iter_codes():
+            with open(file_path, 'rb') as f:
+                for chapter in ijson.items(f, 'item'):
+                    for group in chapter.get('children', []):
+                        for disease in group.get('children', []):
+                            if disease.get('type') != 'disease':
+                                continue
+                            yield disease.get('code')
+                            for sub in disease.get('children', []):
+                                if sub.get('type') == 'sub_disease':
+                                    yield sub.get('code')
+        return cls(iter_codes())
+
+    @classmethod
+    def from_database(cls, driver):
+        """Lấy toàn bộ ID bệnh bằng một câu truy vấn duy nhất"""
+        with driver.session() as session:
+            result = session.run("MATCH (d:Disease) RETURN d.ID AS id")
+            return cls(record["id"] for record in result)
+
+    def split(self, codes):
+        """Tách danh sách mã thành (mã hợp lệ, mã không tồn tại), giữ nguyên thứ tự"""
+        valid, unresolved = [], []
+        for code in codes:
+            (valid if code in self.codes else unresolved).append(code)
+        return valid, unresolved
+
+
+class DanglingReport:
+    """Ghi báo cáo CSV các mã bệnh không tồn tại theo từng thuốc / triệu chứng"""
+    HEADER = ["label", "id", "name", "unresolved_count", "unresolved_codes"]
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(file_path, 'w', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.HEADER)
+        self.nodes = {}
+        self.codes = {}
+
+    def add(self, label, node_id, name, unresolved):
+        if not unresolved:
+            return
+        self.writer.writerow([label, node_id, name, len(unresolved), ";".join(map(str, unresolved))])
+        self.nodes[label] = self.nodes.get(label, 0) + 1
+        self.codes[label] = self.codes.get(label, 0) + len(unresolved)
+
+    def summary(self, label):
+        return (f"⚠️ {label}: {self.codes.get(label, 0)} mã bệnh không tồn tại "
+                f"ở {self.nodes.get(label, 0)} node (xem {self.file_path})")
+
+    def close(self):
+        self.file.close()
@@ -1,13 +1,31 @@
+import hashlib
 import json
+import ijson
+import shutil
+import sys
 import torch
 import os
-from transformers import AutoTokenizer, AutoModel
+from transformers import AutoTokenizer
 from tqdm import tqdm # Thư viện tạo thanh tiến độ (pip install tqdm)
+from embedding_cache import EmbeddingCache
+from embedding_backends import load_backend, encode_texts
+from sharded_embedding import ShardedEncoder
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from vector_artifacts import VectorArtifact, VectorArtifactWriter
 
 # ================= CẤU HÌNH =================
 MODEL_PATH = "../../models/vietnamese-embedding" # Đường dẫn model local
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 BATCH_SIZE = 32
+MAX_LENGTH = 256  # Giới hạn token (256 thay vì 512 để an toàn hơn)
+# Backend chạy model: "torch" | "onnx" | "onnx-int8" (ONNX Runtime, phù hợp máy chỉ có CPU)
+BACKEND = "torch"
+NUM_THREADS = None  # Số luồng intra-op cho backend (None = mặc định)
+# Số tiến trình embedding trên CPU (1 = chạy trong tiến trình hiện tại, >1 = chia shard, xem sharded_embedding.py)
+WORKERS = 1
+# Cache vector trên đĩa (theo model + pooling + max_length + hash text), None để tắt
+CACHE_DIR = "../../data/embedding_cache"
 
 # File đầu vào
 INPUT_FILES = {
@@ -16,126 +34,340 @@ INPUT_FILES = {
     "symptoms": "../../data/symptoms_extracted_data_translated.json"
 }
 
-# File đầu ra
-OUTPUT_FILES = {
-    "icd10": "../../data/icd10_embedded.json",
-    "drugs": "../../data/drugs_embedded.json",
-    "symptoms": "../../data/symptoms_embedded.json"
+# Thư mục đầu ra (ma trận .npy + ids.json + meta.json, xem src/utils/vector_artifacts.py)
+OUTPUT_DIRS = {
+    "icd10": "../../data/vectors/icd10",
+    "drugs": "../../data/vectors/drugs",
+    "symptoms": "../../data/vectors/symptoms"
+}
+VECTOR_DTYPE = "float32"  # "float16" để giảm một nửa dung lượng
+# Incremental: so hash text từng node với artifact lần trước, chỉ embedding node mới/thay đổi,
+# giữ nguyên vector của node không đổi (changed_ids.json ghi lại danh sách node mới/thay đổi để tiện theo dõi)
+INCREMENTAL = True
+# ICD-10 được embedding theo từng chương (đọc luồng bằng ijson), ghi ra đĩa sau mỗi chương
+# và lưu checkpoint để chạy lại sẽ tiếp tục từ chương chưa xong
+CHECKPOINT_FILE = "checkpoint.json"
+
+# Các trường vector của từng bộ dữ liệu (Group có thêm code_vector)
+VECTOR_FIELDS = {
+    "icd10": ["name_vector", "desc_vector", "code_vector"],
+    "drugs": ["name_vector", "desc_vector"],
+    "symptoms": ["name_vector", "desc_vector"]
 }
+ICD_LABELS = {"chapter": "Chapter", "group": "Group", "disease": "Disease", "sub_disease": "Disease"}
+
+def normalize_text(text):
+    """Chuẩn hóa text trước khi embedding, trả về None nếu rỗng"""
+    if not text or not isinstance(text, str) or text.strip() == "":
+        return None
+    # Giới hạn độ dài text trước khi tokenize (để tránh lỗi position embedding)
+    return text.strip()[:5000]
+
+def row_hash(texts):
+    """Hash nội dung text (đã chuẩn hóa) của một node, đổi tên/mô tả là đổi hash"""
+    payload = json.dumps({field: normalize_text(text) for field, text in texts.items()},
+                         ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
 
 class EmbeddingGenerator:
-    def __init__(self, model_path):
-        print(f"⚙️ Đang tải model trên thiết bị: {DEVICE}...")
+    def __init__(self, model_path, cache_dir=CACHE_DIR, backend=BACKEND, workers=WORKERS):
+        self.cache = None
+        if cache_dir:
+            self.cache = EmbeddingCache(cache_dir, model_path, pooling="mean", max_length=MAX_LENGTH, backend=backend)
+        self.backend_name = backend
+        self.sharded = None
+        if workers > 1:
+            # Chế độ nhiều tiến trình: model nằm trong các worker, tiến trình chính không nạp model
+            self.sharded = ShardedEncoder(model_path, backend, workers=workers, threads_per_worker=NUM_THREADS)
+            self.dim = self.sharded.dim
+            return
+        device = DEVICE if backend == "torch" else "cpu"
+        print(f"⚙️ Đang tải model ({backend}) trên thiết bị: {device}...")
         self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
-        self.model = AutoModel.from_pretrained(model_path, trust_remote_code=True, torch_dtype=torch.float16 if DEVICE=="cuda" else torch.float32)
-        self.model.to(DEVICE)
-        self.model.eval()
+        self.backend = load_backend(backend, model_path, device=device, num_threads=NUM_THREADS)
+        self.dim = self.backend.dim
+
+    def close(self):
+        if self.sharded is not None:
+            self.sharded.close()
+
+    def embed_texts(self, texts):
+        """
+        Tính vector cho nhiều text cùng lúc:
+        - Bỏ trùng, lấy sẵn từ cache trên đĩa những text đã embedding ở các lần chạy trước
+        - Phần còn lại sắp xếp theo số token để mỗi batch padding ít nhất
+        - Chạy model theo batch BATCH_SIZE + Mean Pooling
+        - Trả về danh sách vector theo đúng thứ tự đầu vào ([] nếu text rỗng)
+        """
+        normalized = [normalize_text(t) for t in texts]
+        unique_texts = list(dict.fromkeys(t for t in normalized if t is not None))
+        if not unique_texts:
+            return [[] for _ in texts]
+
+        vectors = self.cache.get_many(unique_texts) if self.cache is not None else {}
+        pending = [t for t in unique_texts if t not in vectors]
+        if pending:
+            computed = self.encode_batched(pending)
+            vectors.update(computed)
+            if self.cache is not None:
+                self.cache.put_many(computed)
+
+        return [vectors[t] if t is not None else [] for t in normalized]
+
+    def encode_batched(self, unique_texts):
+        """Chạy model trên các text (đã chuẩn hóa, không trùng), trả về {text: vector}"""
+        if self.sharded is not None:
+            # Ghi cache theo từng đoạn đã xong (đúng thứ tự) để crash giữa chừng không mất kết quả
+            def on_ready(start, end, vectors):
+                if self.cache is not None:
+                    self.cache.put_many({unique_texts[start + i]: vectors[i].tolist() for i in range(end - start)})
+            matrix = self.sharded.encode(unique_texts, on_ready=on_ready)
+            return {text: matrix[i].tolist() for i, text in enumerate(unique_texts)}
+
+        matrix = encode_texts(
+            self.backend, self.tokenizer, unique_texts, BATCH_SIZE, MAX_LENGTH,
+            progress=lambda it: tqdm(it, desc="Embedding", leave=False)
+        )
+        return {text: matrix[i].tolist() for i, text in enumerate(unique_texts)}
 
     def get_embedding(self, text):
         """Hàm tính vector cho 1 câu text đơn lẻ"""
-        if not text or not isinstance(text, str) or text.strip() == "":
-            return [] # Trả về mảng rỗng nếu không có text
-        
-        # Giới hạn độ dài text trước khi tokenize (để tránh lỗi position embedding)
-        text = text.strip()[:5000]  # Giới hạn ký tự trước khi tokenize
-        
-        with torch.no_grad():
-            inputs = self.tokenizer(
-                text, 
-                return_tensors="pt", 
-                padding=True, 
-                truncation=True, 
-                max_length=256  # Giảm xuống 256 thay vì 512 để an toàn hơn
-            )
-            inputs = {k: v.to(DEVICE) for k, v in inputs.items()}
-            
-            # Thêm kiểm tra để đảm bảo input_ids không vượt quá giới hạn
-            if inputs['input_ids'].shape[1] > 512:
-                print(f"⚠️ Cảnh báo: Text quá dài ({inputs['input_ids'].shape[1]} tokens), đang cắt bớt...")
-                inputs['input_ids'] = inputs['input_ids'][:, :512]
-                inputs['attention_mask'] = inputs['attention_mask'][:, :512]
-            
-            outputs = self.model(**inputs)
-            
-            # Mean Pooling
-            last_hidden_states = outputs.last_hidden_state
-            attention_mask = inputs['attention_mask'].unsqueeze(-1).expand(last_hidden_states.size()).float()
-            sum_embeddings = torch.sum(last_hidden_states * attention_mask, 1)
-            sum_mask = torch.clamp(attention_mask.sum(1), min=1e-9)
-            mean_embeddings = sum_embeddings / sum_mask
-            
-            return mean_embeddings.cpu().numpy()[0].tolist()
+        return self.embed_texts([text])[0]
 
-    def process_icd10_recursive(self, items):
-        """Duyệt đệ quy cấu trúc cây ICD-10 để thêm vector"""
-        for item in tqdm(items, desc="Xử lý node ICD-10", leave=False):
+    def collect_icd10_rows(self, items, rows, chapter_level=True, start=1):
+        """
+        Duyệt đệ quy cấu trúc cây ICD-10, mỗi node một dòng {id, label, texts}.
+        ID chương là số thứ tự (1, 2, 3...) giống 1_import_neo4j.py, các node khác dùng code.
+        """
+        for index, item in enumerate(items, start=start):
+            node_type = item.get('type')
             # Xử lý vector dựa trên type
-            item['name_vector'] = self.get_embedding(item.get('name', ''))
-            item['desc_vector'] = self.get_embedding(item.get('description', ''))
-            
+            texts = {
+                'name_vector': item.get('name', ''),
+                'desc_vector': item.get('description', '')
+            }
             # Riêng Group có thêm code_vector
-            if item.get('type') == 'group':
-                item['code_vector'] = self.get_embedding(item.get('code', '')) # Dùng code làm ID vector
+            if node_type == 'group':
+                texts['code_vector'] = item.get('code', '') # Dùng code làm ID vector
+
+            rows.append({
+                "id": str(index) if chapter_level else item.get('code'),
+                "label": ICD_LABELS.get(node_type, "Disease"),
+                "texts": texts
+            })
             
             # Đệ quy xuống con (children)
             if 'children' in item and isinstance(item['children'], list):
-                self.process_icd10_recursive(item['children'])
-        return items
+                self.collect_icd10_rows(item['children'], rows, chapter_level=False)
+        return rows
 
-    def process_flat_list(self, items, type_label):
-        """Xử lý danh sách phẳng (Thuốc, Triệu chứng)"""
-        for item in tqdm(items, desc=f"Xử lý {type_label}"):
+    def collect_flat_rows(self, items, type_label, rows):
+        """Gom text cần embedding của danh sách phẳng (Thuốc, Triệu chứng)"""
+        for item in items:
             # Mapping dữ liệu dựa trên loại file
             if type_label == "Drug":
                 # Thuốc
-                item['name_vector'] = self.get_embedding(item.get('tên thuốc', ''))
-                item['desc_vector'] = self.get_embedding(item.get('mô tả', ''))
-            elif type_label == "Symptom":
-                # Triệu chứng
-                item['name_vector'] = self.get_embedding(item.get('tên', ''))
-                item['desc_vector'] = self.get_embedding(item.get('mô tả', '')) # Nếu file gốc không có thì trả về []
-                # Triệu chứng code chưa có nên bỏ qua code_vector
-            
-        return items
+                texts = {'name_vector': item.get('tên thuốc', ''), 'desc_vector': item.get('mô tả', '')}
+            else:
+                # Triệu chứng (nếu file gốc không có mô tả thì vector rỗng, chưa có code nên bỏ qua code_vector)
+                texts = {'name_vector': item.get('tên', ''), 'desc_vector': item.get('mô tả', '')}
+            rows.append({"id": item.get('id'), "label": type_label, "texts": texts})
+        return rows
+
+    def embed_rows(self, rows):
+        """Embedding toàn bộ text đã gom rồi gán vector ngược lại cho dòng sở hữu"""
+        jobs = [(row, field, text) for row in rows for field, text in row["texts"].items()]
+        if not jobs:
+            return
+        print(f"🧮 Đang embedding {len(jobs)} trường text...")
+        vectors = self.embed_texts([text for _, _, text in jobs])
+        for (row, field, _), vector in zip(jobs, vectors):
+            row.setdefault("vectors", {})[field] = vector
+
+    def artifact_meta(self):
+        return {"model": os.path.abspath(MODEL_PATH), "backend": self.backend_name, "pooling": "mean",
+                "normalized": False, "max_length": MAX_LENGTH}
+
+    def load_previous(self, key):
+        """Mở artifact lần trước nếu còn dùng lại được (cùng model/backend/số chiều/dtype/trường và có hash)"""
+        path = OUTPUT_DIRS[key]
+        if not VectorArtifact.exists(path):
+            return None
+        previous = VectorArtifact(path)
+        expected = dict(self.artifact_meta(), dim=self.dim, dtype=VECTOR_DTYPE, fields=VECTOR_FIELDS[key])
+        if previous.hashes is None or any(previous.meta.get(k) != v for k, v in expected.items()):
+            print(f"⚠️ Artifact cũ {path} khác cấu hình, embedding lại toàn bộ")
+            return None
+        return previous
+
+    def previous_keys(self, previous):
+        """{(nhãn, ID): số dòng} của artifact cũ"""
+        if previous is None:
+            return {}
+        return {(label, node_id): row for row, (node_id, label) in enumerate(zip(previous.ids, previous.labels))}
+
+    def match_previous(self, rows, previous, old=None):
+        """Gắn hash cho từng dòng, dòng có hash trùng artifact cũ được đánh dấu prev_row (không cần embedding lại)"""
+        if old is None:
+            old = self.previous_keys(previous)
+        current = set()
+        for row in rows:
+            row["hash"] = row_hash(row["texts"])
+            key = (row["label"], row["id"])
+            current.add(key)
+            prev_row = old.get(key)
+            if prev_row is not None and previous.hashes[prev_row] == row["hash"]:
+                row["prev_row"] = prev_row
+        return [key for key in old if key not in current]
+
+    def open_writer(self, key, ids, labels, hashes, resume=False):
+        """Mở artifact mới trong thư mục tạm (artifact cũ vẫn đang được đọc để chép vector)"""
+        tmp_path = OUTPUT_DIRS[key] + ".tmp"
+        if not resume and os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        return VectorArtifactWriter(
+            tmp_path, ids=ids, labels=labels, fields=VECTOR_FIELDS[key], dim=self.dim,
+            dtype=VECTOR_DTYPE, meta=self.artifact_meta(), hashes=hashes, resume=resume
+        )
+
+    def write_rows(self, writer, rows, offset, previous):
+        """Ghi vector các dòng bắt đầu từ dòng offset, trả về danh sách (nhãn, ID) mới/thay đổi"""
+        changed = []
+        for i, row in enumerate(rows, start=offset):
+            if "prev_row" in row:
+                writer.copy_from(previous, row["prev_row"], i)
+                continue
+            changed.append((row["label"], row["id"]))
+            for field, vector in row.get("vectors", {}).items():
+                writer.write(field, i, vector)
+        return changed
+
+    def finish_artifact(self, key, writer, changed, removed, previous=None):
+        """Đóng artifact tạm (và memmap của artifact cũ đang đọc) rồi thay thế thư mục cũ"""
+        path = OUTPUT_DIRS[key]
+        writer.write_changed(changed, removed)
+        writer.close()
+        if previous is not None:
+            previous.close()
+        checkpoint_path = os.path.join(writer.path, CHECKPOINT_FILE)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(writer.path, path)
+        print(f"✅ Đã xuất {writer.count} dòng vector: {path} "
+              f"({len(changed)} mới/thay đổi, {writer.count - len(changed)} giữ nguyên, {len(removed)} đã xóa)")
+
+    def write_artifact(self, key, rows, previous=None, removed=()):
+        """Ghi vector ra ma trận nhị phân + index ID + metadata"""
+        writer = self.open_writer(key, [row["id"] for row in rows], [row["label"] for row in rows],
+                                  [row["hash"] for row in rows])
+        changed = self.write_rows(writer, rows, 0, previous)
+        self.finish_artifact(key, writer, changed, removed, previous)
+
+    def iter_icd10_chapters(self, file_path):
+        """Đọc luồng từng chương ICD-10, trả về (số thứ tự chương, các dòng của chương)"""
+        with open(file_path, 'rb') as f:
+            for index, chapter in enumerate(ijson.items(f, 'item'), start=1):
+                yield index, self.collect_icd10_rows([chapter], [], start=index)
+
+    def load_checkpoint(self, key, fingerprint):
+        checkpoint_path = os.path.join(OUTPUT_DIRS[key] + ".tmp", CHECKPOINT_FILE)
+        if not os.path.exists(checkpoint_path):
+            return None
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("fingerprint") != fingerprint:
+            print("⚠️ Checkpoint cũ không khớp dữ liệu/cấu hình hiện tại, chạy lại từ đầu")
+            return None
+        return checkpoint
+
+    def save_checkpoint(self, writer, fingerprint, chapters_done, changed):
+        checkpoint_path = os.path.join(writer.path, CHECKPOINT_FILE)
+        with open(checkpoint_path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump({"fingerprint": fingerprint, "chapters_done": chapters_done,
+                       "changed": [list(k) for k in changed]}, f, ensure_ascii=False)
+        os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+    def run_icd10_streaming(self, file_path):
+        """
+        Embedding ICD-10 theo từng chương, bộ nhớ chỉ giữ một chương:
+        - Lượt 1 (ijson): lấy ID/nhãn/hash của mọi node để cấp phát sẵn ma trận memmap
+        - Lượt 2 (ijson): mỗi chương embedding xong thì flush ra đĩa và ghi checkpoint
+        Chạy lại sau khi bị dừng giữa chừng sẽ bỏ qua các chương đã xong.
+        """
+        key = "icd10"
+        previous = self.load_previous(key) if INCREMENTAL else None
+        old = self.previous_keys(previous)
+
+        ids, labels, hashes, ends = [], [], [], []
+        for _, rows in self.iter_icd10_chapters(file_path):
+            for row in rows:
+                ids.append(row["id"])
+                labels.append(row["label"])
+                hashes.append(row_hash(row["texts"]))
+            ends.append(len(ids))
+        current = set(zip(labels, ids))
+        removed = [k for k in old if k not in current]
+
+        fingerprint = hashlib.sha1(json.dumps(
+            [self.artifact_meta(), self.dim, VECTOR_DTYPE, ids, labels, hashes], ensure_ascii=False
+        ).encode('utf-8')).hexdigest()
+        checkpoint = self.load_checkpoint(key, fingerprint)
+        done = checkpoint["chapters_done"] if checkpoint else 0
+        changed = [tuple(k) for k in checkpoint["changed"]] if checkpoint else []
+        if done:
+            print(f"⏩ Tiếp tục từ checkpoint: đã xong {done}/{len(ends)} chương")
+
+        writer = self.open_writer(key, ids, labels, hashes, resume=checkpoint is not None)
+        for index, rows in self.iter_icd10_chapters(file_path):
+            if index <= done:
+                continue
+            self.match_previous(rows, previous, old)
+            self.embed_rows([row for row in rows if "prev_row" not in row])
+            offset = ends[index - 2] if index > 1 else 0
+            changed += self.write_rows(writer, rows, offset, previous)
+            writer.flush()
+            self.save_checkpoint(writer, fingerprint, index, changed)
+            print(f"   ✔️ Xong chương {index}/{len(ends)} ({len(rows)} node)")
+
+        self.finish_artifact(key, writer, changed, removed, previous)
 
     def run(self):
-        # 1. Xử lý ICD-10 (Cấu trúc phân cấp)
-        if os.path.exists(INPUT_FILES['icd10']):
-            print("\n📥 Đang xử lý file ICD-10...")
-            with open(INPUT_FILES['icd10'], 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            # Gọi hàm đệ quy
-            processed_data = self.process_icd10_recursive(data)
-            
-            with open(OUTPUT_FILES['icd10'], 'w', encoding='utf-8') as f:
-                json.dump(processed_data, f, ensure_ascii=False, indent=2)
-            print(f"✅ Đã xuất file: {OUTPUT_FILES['icd10']}")
-
-        # 2. Xử lý Thuốc (Danh sách phẳng)
-        if os.path.exists(INPUT_FILES['drugs']):
-            print("\n📥 Đang xử lý file Thuốc...")
-            with open(INPUT_FILES['drugs'], 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            processed_data = self.process_flat_list(data, "Drug")
-            
-            with open(OUTPUT_FILES['drugs'], 'w', encoding='utf-8') as f:
-                json.dump(processed_data, f, ensure_ascii=False, indent=2)
-            print(f"✅ Đã xuất file: {OUTPUT_FILES['drugs']}")
-
-        # 3. Xử lý Triệu chứng (Danh sách phẳng)
-        if os.path.exists(INPUT_FILES['symptoms']):
-            print("\n📥 Đang xử lý file Triệu chứng...")
-            with open(INPUT_FILES['symptoms'], 'r', encoding='utf-8') as f:
+        # 1. ICD-10 (phân cấp, file lớn nhất): embedding luồng theo chương, có checkpoint
+        if os.path.exists(INPUT_FILES["icd10"]):
+            print("\n📥 Đang đọc file ICD-10 (theo từng chương)...")
+            self.run_icd10_streaming(INPUT_FILES["icd10"])
+
+        # 2. Đọc dữ liệu và gom text của Thuốc, Triệu chứng
+        datasets = {}
+        for key, type_label in (("drugs", "Drug"), ("symptoms", "Symptom")):
+            if not os.path.exists(INPUT_FILES[key]):
+                continue
+            print(f"\n📥 Đang đọc file {type_label}...")
+            with open(INPUT_FILES[key], 'r', encoding='utf-8') as f:
                 data = json.load(f)
-            
-            processed_data = self.process_flat_list(data, "Symptom")
-            
-            with open(OUTPUT_FILES['symptoms'], 'w', encoding='utf-8') as f:
-                json.dump(processed_data, f, ensure_ascii=False, indent=2)
-            print(f"✅ Đã xuất file: {OUTPUT_FILES['symptoms']}")
+            datasets[key] = self.collect_flat_rows(data, type_label, [])
+
+        # 3. Incremental: đối chiếu hash với artifact lần trước
+        previous, removed = {}, {}
+        for key, rows in datasets.items():
+            previous[key] = self.load_previous(key) if INCREMENTAL else None
+            removed[key] = self.match_previous(rows, previous[key])
+
+        # 4. Embedding theo batch cho các node mới/thay đổi
+        pending = [row for rows in datasets.values() for row in rows if "prev_row" not in row]
+        self.embed_rows(pending)
+        if self.cache is not None:
+            print(self.cache.stats())
+
+        # 5. Ghi file kết quả
+        for key, rows in datasets.items():
+            self.write_artifact(key, rows, previous.pop(key), removed[key])
 
 if __name__ == "__main__":
     generator = EmbeddingGenerator(MODEL_PATH)
-    generator.run()
\ No newline at end of file
+    try:
+        generator.run()
+    finally:
+        generator.close()
@@ -0,0 +1,223 @@
+import inspect
+import json
+import os
+import time
+import numpy as np
+import torch
+from transformers import AutoTokenizer, AutoModel
+from embedding_cache import model_revision
+
+# ================= CẤU HÌNH =================
+MODEL_PATH = "../../models/vietnamese-embedding"
+ONNX_DIR = "../../models/vietnamese-embedding-onnx"
+ONNX_FILES = {
+    "onnx": "model.onnx",           # fp32
+    "onnx-int8": "model.int8.onnx"  # dynamic int8 quantization (trọng số Linear)
+}
+# Ghi revision của model đã export cạnh file .onnx; đổi model thì export lại thay vì dùng file cũ
+REVISION_FILE = "revision.json"
+SAMPLE_FILE = "../../data/icd10_data.json"  # Lấy tên/mô tả làm câu mẫu cho parity check + benchmark
+NUM_SAMPLES = 512
+BATCH_SIZE = 32
+MAX_LENGTH = 256
+
+
+def mean_pooling(last_hidden_states, attention_mask):
+    """Mean Pooling trên các token thật (bỏ qua padding) - dùng chung cho mọi backend"""
+    mask = attention_mask.unsqueeze(-1).expand(last_hidden_states.size()).float()
+    sum_embeddings = torch.sum(last_hidden_states.float() * mask, 1)
+    sum_mask = torch.clamp(mask.sum(1), min=1e-9)
+    return sum_embeddings / sum_mask
+
+
+class TorchBackend:
+    """Model PyTorch gốc (fp16 trên GPU, fp32 trên CPU)"""
+    name = "torch"
+
+    def __init__(self, model_path, device="cpu"):
+        self.device = device
+        self.model = AutoModel.from_pretrained(
+            model_path, trust_remote_code=True,
+            torch_dtype=torch.float16 if device == "cuda" else torch.float32
+        )
+        self.model.to(device)
+        self.model.eval()
+        self.dim = self.model.config.hidden_size
+
+    def encode(self, inputs):
+        """inputs: dict tensor đã padding (tokenizer.pad(..., return_tensors="pt")) -> np.ndarray [batch, dim]"""
+        with torch.no_grad():
+            inputs = {k: v.to(self.device) for k, v in inputs.items()}
+            outputs = self.model(**inputs)
+            return mean_pooling(outputs.last_hidden_state, inputs['attention_mask']).cpu().numpy()
+
+
+class OnnxBackend:
+    """Model đã export sang ONNX, chạy bằng ONNX Runtime trên CPU"""
+
+    def __init__(self, onnx_path, num_threads=None, name="onnx"):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.name = name
+        self.session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.dim = self.session.get_outputs()[0].shape[-1]
+
+    def encode(self, inputs):
+        feed = {k: inputs[k].cpu().numpy().astype(np.int64) for k in self.input_names}
+        hidden = self.session.run(["last_hidden_state"], feed)[0]
+        # Pooling dùng đúng hàm của backend PyTorch để vector giống hệt cách tính
+        return mean_pooling(torch.from_numpy(hidden), inputs['attention_mask'].cpu()).numpy()
+
+
+def load_backend(backend, model_path=MODEL_PATH, device="cpu", onnx_dir=ONNX_DIR, num_threads=None):
+    """backend: "torch" | "onnx" | "onnx-int8" (tự export nếu chưa có file .onnx)"""
+    if backend == "torch":
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        return TorchBackend(model_path, device)
+    if backend not in ONNX_FILES:
+        raise ValueError(f"Backend không hợp lệ: {backend}")
+    onnx_path = os.path.join(onnx_dir, ONNX_FILES[backend])
+    if not os.path.exists(onnx_path) or not onnx_is_current(model_path, onnx_dir):
+        export_onnx(model_path, onnx_dir, quantize=(backend == "onnx-int8"))
+    return OnnxBackend(onnx_path, num_threads=num_threads, name=backend)
+
+
+def onnx_is_current(model_path, onnx_dir):
+    """File .onnx trong onnx_dir có được export từ đúng revision hiện tại của model không"""
+    path = os.path.join(onnx_dir, REVISION_FILE)
+    if not os.path.exists(path):
+        return False
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f).get("revision") == model_revision(model_path)
+
+
+def export_onnx(model_path, onnx_dir, quantize=False, opset=17):
+    """Export model sang ONNX (trục batch/seq động), tùy chọn lượng tử hóa int8 động"""
+    os.makedirs(onnx_dir, exist_ok=True)
+    fp32_path = os.path.join(onnx_dir, ONNX_FILES["onnx"])
+
+    if not onnx_is_current(model_path, onnx_dir):
+        # Model đã đổi (hoặc bản export cũ chưa ghi revision) -> bỏ các file .onnx cũ
+        stale = [name for name in ONNX_FILES.values() if os.path.exists(os.path.join(onnx_dir, name))]
+        if stale:
+            print(f"♻️ ONNX trong {onnx_dir} không khớp revision model, export lại: {', '.join(stale)}")
+        for name in stale:
+            os.remove(os.path.join(onnx_dir, name))
+
+    if not os.path.exists(fp32_path):
+        print(f"📦 Đang export ONNX: {model_path} -> {fp32_path}...")
+        tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+        model = AutoModel.from_pretrained(model_path, trust_remote_code=True, torch_dtype=torch.float32)
+        model.eval()
+
+        dummy = tokenizer(["xin chào", "bệnh tả do vi khuẩn"], padding=True, return_tensors="pt")
+        input_names = [k for k in ("input_ids", "attention_mask", "token_type_ids") if k in dummy]
+
+        class HiddenStateWrapper(torch.nn.Module):
+            def __init__(self, inner):
+                super().__init__()
+                self.inner = inner
+
+            def forward(self, *args):
+                return self.inner(**dict(zip(input_names, args))).last_hidden_state
+
+        dynamic_axes = {name: {0: "batch", 1: "seq"} for name in input_names}
+        dynamic_axes["last_hidden_state"] = {0: "batch", 1: "seq"}
+        # torch mới mặc định exporter dynamo (không dùng dynamic_axes) -> ép exporter TorchScript;
+        # torch cũ chưa có tham số dynamo và vốn đã dùng TorchScript
+        extra = {}
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+            extra["dynamo"] = False
+        with torch.no_grad():
+            torch.onnx.export(
+                HiddenStateWrapper(model), tuple(dummy[k] for k in input_names), fp32_path,
+                input_names=input_names, output_names=["last_hidden_state"],
+                dynamic_axes=dynamic_axes, opset_version=opset, **extra
+            )
+        with open(os.path.join(onnx_dir, REVISION_FILE), 'w', encoding='utf-8') as f:
+            json.dump({"model_path": os.path.abspath(model_path), "revision": model_revision(model_path)}, f)
+        print("✅ Đã export ONNX fp32.")
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        int8_path = os.path.join(onnx_dir, ONNX_FILES["onnx-int8"])
+        print(f"📦 Đang lượng tử hóa int8 -> {int8_path}...")
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+        print("✅ Đã lượng tử hóa int8.")
+
+
+def encode_texts(backend, tokenizer, texts, batch_size=BATCH_SIZE, max_length=MAX_LENGTH, progress=None):
+    """
+    Embedding danh sách text (đã chuẩn hóa, không rỗng) theo batch:
+    sắp xếp theo số token để giảm padding, trả về ma trận float32 theo đúng thứ tự đầu vào.
+    """
+    vectors = np.zeros((len(texts), backend.dim), dtype=np.float32)
+    if not texts:
+        return vectors
+    # Tokenize một lần (không padding) để biết độ dài, rồi sắp xếp theo độ dài
+    encodings = tokenizer(texts, truncation=True, max_length=max_length)
+    order = sorted(range(len(texts)), key=lambda i: len(encodings['input_ids'][i]))
+
+    starts = range(0, len(order), batch_size)
+    for start in (progress(starts) if progress else starts):
+        idx = order[start:start + batch_size]
+        features = [{k: encodings[k][i] for k in encodings.keys()} for i in idx]
+        inputs = tokenizer.pad(features, padding=True, return_tensors="pt")
+        vectors[idx] = backend.encode(inputs)
+    return vectors
+
+
+# ================= PARITY CHECK + BENCHMARK =================
+
+def load_sample_texts(file_path, limit):
+    """Lấy tên + mô tả các node ICD-10 làm câu mẫu"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    texts = []
+    stack = list(data)
+    while stack and len(texts) < limit:
+        item = stack.pop(0)
+        for key in ('name', 'description'):
+            text = (item.get(key) or "").strip()[:5000]
+            if text and len(texts) < limit:
+                texts.append(text)
+        stack.extend(item.get('children', []))
+    return texts
+
+
+def cosine_rows(a, b):
+    a_norm = np.linalg.norm(a, axis=1)
+    b_norm = np.linalg.norm(b, axis=1)
+    return np.sum(a * b, axis=1) / np.clip(a_norm * b_norm, 1e-12, None)
+
+
+def parity_and_benchmark(texts, backends, tokenizer):
+    """So sánh cosine với vector PyTorch (backend đầu tiên) và đo tốc độ texts/sec của từng backend"""
+    reference = None
+    print(f"\n📊 {len(texts)} câu mẫu, batch {BATCH_SIZE}")
+    for backend in backends:
+        encode_texts(backend, tokenizer, texts[:BATCH_SIZE])  # warm-up
+        start = time.perf_counter()
+        vectors = encode_texts(backend, tokenizer, texts)
+        elapsed = time.perf_counter() - start
+        line = f"   - {backend.name:<10} {len(texts) / elapsed:8.1f} texts/sec"
+        if reference is None:
+            reference = vectors
+        else:
+            cos = cosine_rows(reference, vectors)
+            line += f" | cosine so với {backends[0].name}: trung bình {cos.mean():.5f}, thấp nhất {cos.min():.5f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
+    export_onnx(MODEL_PATH, ONNX_DIR, quantize=True)
+    backends = [load_backend(name) for name in ("torch", "onnx", "onnx-int8")]
+    parity_and_benchmark(load_sample_texts(SAMPLE_FILE, NUM_SAMPLES), backends, tokenizer)
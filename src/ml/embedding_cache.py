@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+# ================= CACHE EMBEDDING TRÊN ĐĨA =================
+# Mỗi cấu hình (model + revision, kiểu pooling, max_length, backend) có một thư mục riêng:
+#   meta.json     -> thông tin cấu hình + số chiều vector
+#   vectors.f32   -> ma trận float32 [n, dim], ghi nối tiếp, đọc bằng memmap
+#   index.json    -> {sha1(text đã chuẩn hóa): số thứ tự dòng trong ma trận} (bản gộp)
+#   index.jsonl   -> log ghi nối [sha1, dòng] của các vector thêm sau lần gộp gần nhất;
+#                    put_many chỉ append vài dòng thay vì ghi lại cả index, log được gộp vào
+#                    index.json một lần khi mở cache ở lần chạy sau
+
+
+def text_key(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def model_revision(model_path):
+    """
+    Dấu vân tay của model local: nội dung config.json + tên/kích thước các file trọng số.
+    Đổi model (hoặc tải lại bản khác) thì cache cũ không bị dùng nhầm.
+    """
+    h = hashlib.sha1()
+    config_path = os.path.join(model_path, "config.json")
+    if os.path.exists(config_path):
+        with open(config_path, 'rb') as f:
+            h.update(f.read())
+    if os.path.isdir(model_path):
+        for name in sorted(os.listdir(model_path)):
+            if name.endswith((".safetensors", ".bin", ".onnx")):
+                h.update(f"{name}:{os.path.getsize(os.path.join(model_path, name))}".encode('utf-8'))
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, cache_root, model_path, pooling="mean", max_length=256, backend="torch"):
+        self.config = {
+            "model_path": os.path.abspath(model_path),
+            "revision": model_revision(model_path),
+            "pooling": pooling,
+            "max_length": max_length
+        }
+        # Backend ONNX/int8 cho vector hơi khác PyTorch nên tách cache riêng (giữ nguyên key cũ cho torch)
+        if backend != "torch":
+            self.config["backend"] = backend
+        config_key = hashlib.sha1(json.dumps(self.config, sort_keys=True).encode('utf-8')).hexdigest()
+        self.cache_dir = os.path.join(cache_root, config_key[:16])
+        self.meta_path = os.path.join(self.cache_dir, "meta.json")
+        self.matrix_path = os.path.join(self.cache_dir, "vectors.f32")
+        self.index_path = os.path.join(self.cache_dir, "index.json")
+        self.log_path = os.path.join(self.cache_dir, "index.jsonl")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.dim = None
+        self.index = {}
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                self.dim = json.load(f)["dim"]
+            if os.path.exists(self.index_path):
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self.index = json.load(f)
+            if self.replay_log():
+                self.compact()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def _matrix(self):
+        rows = os.path.getsize(self.matrix_path) // (4 * self.dim)
+        return np.memmap(self.matrix_path, dtype=np.float32, mode='r', shape=(rows, self.dim))
+
+    def get_many(self, texts):
+        """Trả về {text: vector} cho các text đã có trong cache"""
+        found = {}
+        if self.dim is None or not self.index:
+            self.misses += len(texts)
+            return found
+        matrix = self._matrix()
+        for text in texts:
+            row = self.index.get(text_key(text))
+            if row is None:
+                self.misses += 1
+            else:
+                found[text] = matrix[row].tolist()
+                self.hits += 1
+        return found
+
+    def replay_log(self):
+        """Áp các dòng của index.jsonl lên index, trả về số dòng đã áp (dòng ghi dở do crash bị bỏ qua)"""
+        if not os.path.exists(self.log_path):
+            return 0
+        rows = self._rows()
+        applied = 0
+        with open(self.log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    key, row = json.loads(line)
+                except ValueError:
+                    continue
+                if row < rows:
+                    self.index[key] = row
+                    applied += 1
+        return applied
+
+    def compact(self):
+        """Gộp log vào index.json (ghi file tạm rồi os.replace) và xóa log"""
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+        os.remove(self.log_path)
+
+    def _rows(self):
+        if self.dim is None or not os.path.exists(self.matrix_path):
+            return 0
+        return os.path.getsize(self.matrix_path) // (4 * self.dim)
+
+    def put_many(self, vectors):
+        """
+        Ghi nối tiếp {text: vector} vào ma trận rồi append [key, dòng] vào index.jsonl
+        (log ghi sau ma trận để an toàn khi crash). Chi phí tỉ lệ với số vector mới, không phải kích thước cache.
+        """
+        vectors = {text: v for text, v in vectors.items() if v and text_key(text) not in self.index}
+        if not vectors:
+            return
+        if self.dim is None:
+            self.dim = len(next(iter(vectors.values())))
+            with open(self.meta_path, 'w', encoding='utf-8') as f:
+                json.dump(dict(self.config, dim=self.dim), f, ensure_ascii=False, indent=2)
+
+        start = self._rows()
+        texts = list(vectors.keys())
+        matrix = np.asarray([vectors[t] for t in texts], dtype=np.float32)
+        with open(self.matrix_path, 'ab') as f:
+            # Bỏ phần dòng ghi dở (nếu lần trước crash giữa chừng) để các dòng mới thẳng hàng
+            f.truncate(start * 4 * self.dim)
+            f.write(matrix.tobytes())
+        lines = []
+        for offset, text in enumerate(texts):
+            key = text_key(text)
+            self.index[key] = start + offset
+            lines.append(json.dumps([key, start + offset]) + "\n")
+        with open(self.log_path, 'a', encoding='utf-8') as f:
+            f.writelines(lines)
+
+    def stats(self):
+        return f"💾 Cache: {self.hits} hit | {self.misses} miss | {len(self.index)} vector trên đĩa"
@@ -0,0 +1,217 @@
+import os
+import queue
+import time
+import traceback
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+from embedding_backends import load_backend, encode_texts, load_sample_texts, MODEL_PATH, ONNX_DIR, SAMPLE_FILE
+
+# ================= CẤU HÌNH =================
+BACKEND = "torch"           # "torch" | "onnx" | "onnx-int8"
+SHARD_SIZE = 1024           # Số text mỗi shard gửi cho một worker
+BATCH_SIZE = 32
+MAX_LENGTH = 256
+NUM_SAMPLES = 4096          # Số câu mẫu cho báo cáo scaling
+WORKER_COUNTS = [1, 2, 4, 8, 16, 32, 64]
+POLL_SECONDS = 5            # Chu kỳ kiểm tra worker còn sống khi chờ kết quả
+RESULT_TIMEOUT = 600        # Quá số giây này không có shard nào xong -> coi như treo, báo lỗi
+
+# ================= EMBEDDING NHIỀU TIẾN TRÌNH =================
+# Mỗi worker là một tiến trình riêng (spawn), nạp model MỘT lần với số luồng cố định
+# (tổng luồng = số CPU). Text chia thành các shard liên tiếp theo thứ tự đầu vào;
+# worker ghi vector thẳng vào ma trận shared memory [n, dim] rồi chỉ báo lại số shard,
+# tiến trình chính phát lại các đoạn đã xong theo đúng thứ tự (ordered writer).
+# Mọi task/kết quả mang mã lần gọi encode (call_id): kết quả của lần gọi cũ bị bỏ qua.
+# Khi có lỗi (worker lỗi, chết, treo), toàn bộ worker bị dừng TRƯỚC khi giải phóng shared memory
+# và pool được khởi động lại ở lần encode sau -> không còn task cũ trong hàng đợi.
+
+
+def _worker_main(model_path, backend, num_threads, onnx_dir, tasks, results):
+    try:
+        import torch
+        torch.set_num_threads(num_threads)
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+        model = load_backend(backend, model_path, device="cpu", onnx_dir=onnx_dir, num_threads=num_threads)
+    except Exception:
+        results.put((0, "error", None, traceback.format_exc()))
+        return
+    results.put((0, "ready", os.getpid(), model.dim))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        call_id, shm_name, total, shard_id, start, texts = task
+        try:
+            shm = shared_memory.SharedMemory(name=shm_name)
+            out = np.ndarray((total, model.dim), dtype=np.float32, buffer=shm.buf)
+            out[start:start + len(texts)] = encode_texts(model, tokenizer, texts, BATCH_SIZE, MAX_LENGTH)
+            del out
+            shm.close()
+            results.put((call_id, "done", shard_id, None))
+        except Exception:
+            results.put((call_id, "error", shard_id, traceback.format_exc()))
+
+
+class ShardedEncoder:
+    """Pool tiến trình embedding, dùng như context manager (with ShardedEncoder(...) as encoder)"""
+
+    def __init__(self, model_path=MODEL_PATH, backend=BACKEND, workers=None, threads_per_worker=None,
+                 onnx_dir=ONNX_DIR, shard_size=SHARD_SIZE):
+        self.workers = workers or os.cpu_count()
+        self.threads_per_worker = threads_per_worker or max(1, os.cpu_count() // self.workers)
+        self.shard_size = shard_size
+        self.backend_name = backend
+        self.model_path = model_path
+        self.onnx_dir = onnx_dir
+        self.call_id = 0
+        self.processes = []
+        self.dim = None
+
+        if backend != "torch":
+            # Export một lần ở tiến trình chính để các worker không export chồng lên nhau
+            load_backend(backend, model_path, device="cpu", onnx_dir=onnx_dir, num_threads=1)
+        self.start()
+        print(f"⚙️ Đã khởi động {self.workers} worker ({backend}) x {self.threads_per_worker} luồng")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        """Tạo hàng đợi mới và khởi động worker, chờ tất cả nạp xong model"""
+        ctx = mp.get_context("spawn")
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.processes = [
+            ctx.Process(target=_worker_main, daemon=True,
+                        args=(self.model_path, self.backend_name, self.threads_per_worker, self.onnx_dir,
+                              self.tasks, self.results))
+            for _ in range(self.workers)
+        ]
+        for p in self.processes:
+            p.start()
+        try:
+            for _ in self.processes:
+                _, kind, _, payload = self.get_result()
+                if kind == "error":
+                    raise RuntimeError(f"Worker embedding không khởi động được:\n{payload}")
+                self.dim = payload
+        except BaseException:
+            self.terminate()
+            raise
+
+    def terminate(self):
+        """Dừng ngay mọi worker (bỏ các task còn trong hàng đợi), dùng khi có lỗi"""
+        for p in self.processes:
+            if p.is_alive():
+                p.terminate()
+        for p in self.processes:
+            p.join()
+        self.processes = []
+        for q in (self.tasks, self.results):
+            q.cancel_join_thread()
+            q.close()
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for p in self.processes:
+            p.join(timeout=30)
+            if p.is_alive():
+                p.terminate()
+        self.processes = []
+
+    def get_result(self):
+        """
+        Đợi một kết quả từ worker. Cứ POLL_SECONDS kiểm tra worker còn sống
+        (worker bị kill / OOM không bao giờ gửi kết quả), quá RESULT_TIMEOUT thì báo treo.
+        """
+        deadline = time.monotonic() + RESULT_TIMEOUT
+        while True:
+            try:
+                return self.results.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                dead = [p for p in self.processes if not p.is_alive()]
+                if dead:
+                    codes = ", ".join(str(p.exitcode) for p in dead)
+                    raise RuntimeError(f"{len(dead)} worker embedding đã dừng đột ngột (exit code {codes})")
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Không có kết quả embedding nào sau {RESULT_TIMEOUT}s")
+
+    def encode(self, texts, on_ready=None):
+        """
+        Embedding danh sách text (đã chuẩn hóa, không rỗng), trả về ma trận float32 theo thứ tự đầu vào.
+        on_ready(start, end, vectors): gọi lần lượt theo thứ tự cho từng đoạn liên tiếp đã xong
+        (ví dụ để ghi cache dần, crash giữa chừng không mất phần đã tính).
+        """
+        total = len(texts)
+        if total == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        if not self.processes:
+            # Pool đã bị dừng do lỗi ở lần gọi trước
+            self.start()
+
+        self.call_id += 1
+        call_id = self.call_id
+        shm = shared_memory.SharedMemory(create=True, size=total * self.dim * 4)
+        matrix = None
+        try:
+            matrix = np.ndarray((total, self.dim), dtype=np.float32, buffer=shm.buf)
+            starts = list(range(0, total, self.shard_size))
+            for shard_id, start in enumerate(starts):
+                self.tasks.put((call_id, shm.name, total, shard_id, start, texts[start:start + self.shard_size]))
+
+            finished = set()
+            next_shard = 0
+            while next_shard < len(starts):
+                result_call, kind, shard_id, payload = self.get_result()
+                if result_call != call_id:
+                    continue  # Kết quả sót lại của lần gọi trước
+                if kind == "error":
+                    raise RuntimeError(f"Worker embedding lỗi ở shard {shard_id}:\n{payload}")
+                finished.add(shard_id)
+                # Ordered writer: chỉ phát đoạn khi mọi shard phía trước đã xong
+                while next_shard in finished:
+                    start = starts[next_shard]
+                    end = min(start + self.shard_size, total)
+                    if on_ready is not None:
+                        on_ready(start, end, matrix[start:end])
+                    next_shard += 1
+            return np.array(matrix)
+        except BaseException:
+            # Worker khác có thể vẫn đang ghi vào shm -> dừng hẳn trước khi unlink
+            self.terminate()
+            raise
+        finally:
+            matrix = None  # Bỏ tham chiếu tới shm.buf, nếu không shm.close() báo BufferError
+            shm.close()
+            shm.unlink()
+
+
+# ================= BÁO CÁO SCALING =================
+
+def scaling_report(texts, worker_counts=WORKER_COUNTS, backend=BACKEND, model_path=MODEL_PATH):
+    """Đo texts/sec theo số worker (luồng mỗi worker = số CPU / số worker)"""
+    cpus = os.cpu_count()
+    print(f"\n📊 Scaling: {len(texts)} câu, {cpus} CPU, backend {backend}, shard {SHARD_SIZE}")
+    baseline = None
+    for workers in [w for w in worker_counts if w <= cpus] or [1]:
+        with ShardedEncoder(model_path, backend, workers=workers) as encoder:
+            encoder.encode(texts[:SHARD_SIZE])  # warm-up
+            start = time.perf_counter()
+            encoder.encode(texts)
+            elapsed = time.perf_counter() - start
+        throughput = len(texts) / elapsed
+        baseline = baseline or throughput
+        print(f"   - {workers:>3} worker x {max(1, cpus // workers):>3} luồng: "
+              f"{throughput:8.1f} texts/sec (x{throughput / baseline:.2f})")
+
+
+if __name__ == "__main__":
+    sample = load_sample_texts(SAMPLE_FILE, NUM_SAMPLES)
+    scaling_report(sample)
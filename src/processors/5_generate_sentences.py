@@ -1,17 +1,26 @@
-import pandas as pd
 from neo4j import GraphDatabase
 import random
 from tqdm import tqdm
 import time
 import os
 import re
+import copy
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from graph_snapshot import GraphSnapshot, SnapshotPathEngine, sample_ids
+from sentence_store import SentenceWriter
+from negative_sampling import NegativeSampler
+from sentence_dedup import SentenceDeduplicator, open_store, merge_stats, print_report, saturated
 
 # ================= CẤU HÌNH =================
 URI = "bolt://20.249.211.169:7687"
 AUTH = ("neo4j", "neo4j123")
 OUTPUT_DIR = "../../data/raw_sentences"
 OUTPUT_PREFIX = "raw_sentences"
-SENTENCES_PER_FILE = 3000
+OUTPUT_FORMAT = "jsonl"     # "jsonl" | "parquet" -> xáo toàn cục + chia shard bằng sentence_store.py
+SENTENCES_PER_FILE = 50000
 
 # MỤC TIÊU SỐ LƯỢNG (90k triplets)
 TOTAL_TARGET = 90000
@@ -27,24 +36,187 @@ MAX_PATHS_PER_DISEASE = {
     "3-hop": 3
 }
 
+# Số bệnh gửi trong một truy vấn (UNWIND $ids), giới hạn số path mỗi bệnh vẫn áp dụng phía server
+DISEASE_BATCH = 200
+
+# Chạy offline từ snapshot (python graph_snapshot.py để tạo), None -> truy vấn Neo4j trực tiếp
+SNAPSHOT_DIR = None  # "../../data/graph_snapshot"
+
+# Lập kế hoạch lấy mẫu theo bậc của từng bệnh (1 truy vấn tổng hợp): chỉ truy vấn hop ở những bệnh
+# có path tương ứng, chọn vừa đủ bệnh để đạt chỉ tiêu (cộng biên PLAN_MARGIN). Ước lượng hụt thì shard
+# lấy bù từ các bệnh có path còn lại (cùng thứ tự đã xáo) đến khi đủ chỉ tiêu
+USE_PLANNER = True
+PLAN_MARGIN = 1.2
+# Số câu tối đa mỗi bệnh cho từng loại hop (tránh một bệnh bậc cao chiếm phần lớn dữ liệu)
+MAX_SENTENCES_PER_DISEASE = {
+    "1-hop": 10,
+    "2-hop": 12,
+    "3-hop": 4
+}
+
+# ================= CHẠY SONG SONG THEO SHARD =================
+# ID bệnh được băm vào NUM_SHARDS shard cố định (không phụ thuộc số worker). Mỗi shard có seed riêng
+# (suy ra từ SEED), chỉ tiêu riêng do coordinator chia trước (phần thiếu chia lại sau mỗi vòng) và ghi file riêng
+# (<OUTPUT_PREFIX>_shardXX_partYYY.jsonl) -> cùng SEED cho dữ liệu giống hệt nhau từng byte,
+# dù chạy với bao nhiêu worker. SEED = None: ngẫu nhiên như cũ (ORDER BY rand() phía server).
+SEED = 42
+NUM_SHARDS = 8
+# Worker là luồng: tăng tốc khi chạy với Neo4j (phần lớn thời gian chờ truy vấn). Chế độ snapshot là
+# Python thuần, bị GIL giới hạn -> nhiều worker không nhanh hơn 1 worker (kết quả vẫn giống hệt).
+WORKERS = 4                 # Số shard chạy đồng thời (mỗi worker một session Neo4j)
+# Khi có SEED: server trả toàn bộ ID láng giềng của mỗi quan hệ, client lấy mẫu MAX_PATHS_PER_DISEASE ID
+# bằng RNG của shard (đều trên mọi láng giềng) rồi đọc thuộc tính của các ID đã chọn (1 truy vấn mỗi nhãn mỗi lô)
+
+# Chế độ có SEED: {hop: {danh sách: (nhãn node, dạng phần tử như truy vấn ORDER BY rand() trả về)}}
+SAMPLED_LISTS = {
+    "1-hop": {"symptoms": ("Symptom", "name"), "drugs": ("Drug", "item")},
+    "2-hop": {"drugs": ("Drug", "item"), "symptoms": ("Symptom", "name"), "subs": ("Disease", "item")},
+    "3-hop": {"drugs": ("Drug", "name")}
+}
+PROPERTY_QUERY = """
+UNWIND $ids AS id
+MATCH (n:%s {ID: id})
+RETURN n.ID AS id, n.name AS name, n.description AS desc
+"""
+
+# Sinh câu sai (label False) ngay khi sinh câu đúng: thay 1 thực thể bằng thực thể cùng loại không liên kết
+# với bệnh (xem negative_sampling.py). Số câu sai tối đa = NEGATIVES_PER_POSITIVE x số câu đúng của bệnh, 0 -> tắt.
+# Cần toàn bộ graph trong RAM: dùng snapshot (SNAPSHOT_DIR) nếu có, không thì mỗi lần chạy phải đọc toàn bộ
+# node + quan hệ từ Neo4j (GraphSnapshot.export) -> mặc định tắt, nên bật cùng SNAPSHOT_DIR.
+# HARD_NEGATIVES: một phần thực thể thay thế lấy từ láng giềng gần nhất theo vector (cần data/vectors)
+NEGATIVES_PER_POSITIVE = 0
+HARD_NEGATIVES = False
+
+# Lọc câu trùng (chuẩn hóa + băm) trước khi tính chỉ tiêu, nhớ qua các lần chạy (xem sentence_dedup.py).
+# Mỗi shard một tập hash riêng <DEDUP_DIR>/shardXX: bệnh luôn thuộc cùng shard nên câu của một bệnh ở
+# các lần chạy sau vẫn gặp đúng tập hash đó, các worker không tranh khóa, kết quả vẫn xác định.
+# Khi bật, part mới được đánh số tiếp sau part cũ. Trùng giữa các bệnh khác shard: lọc offline bằng sentence_dedup.py.
+# Mặc định tắt: chạy lại với CÙNG SEED sinh lại đúng các câu cũ -> gần như mọi câu bị lọc và chỉ tiêu không đạt.
+# Chỉ bật để bổ sung dữ liệu qua nhiều lần chạy, mỗi lần một SEED mới (hoặc xóa DEDUP_DIR để bắt đầu lại).
+DEDUP = None                # "bloom" | "sqlite" | None
+DEDUP_DIR = "../../data/dedup"
+DEDUP_CAPACITY = 50_000_000 # Tổng số câu dự kiến qua mọi lần chạy (chia đều cho các shard)
+DEDUP_FP_RATE = 0.001
+DEDUP_WARN_RATIO = 0.5      # Cảnh báo khi tỉ lệ câu bị lọc vượt ngưỡng này
+
+DEGREE_QUERY = """
+MATCH (d:Disease)
+RETURN d.ID AS id,
+       COUNT { (d)-[:HAS_SYMPTOM]->(:Symptom) } AS symptoms,
+       COUNT { (:Drug)-[:TREATS]->(d) } AS drugs,
+       COUNT { (:Disease)-[:IS_A]->(d) } AS subs,
+       EXISTS { (d)-[:BELONGS_TO]->(:Group) } AS has_group,
+       EXISTS { (d)-[:BELONGS_TO]->(:Group)-[:BELONGS_TO]->(:Chapter) } AS has_chapter,
+       coalesce(d.description, '') <> '' AS has_desc
+"""
+
+def shard_of(disease_id, num_shards=NUM_SHARDS):
+    """Shard cố định của một bệnh (băm ID, không phụ thuộc thứ tự hay số worker)"""
+    digest = hashlib.sha1(str(disease_id).encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % num_shards
+
+
+def shard_seed(seed, shard_id):
+    if seed is None:
+        return None
+    return int(hashlib.sha1(f"{seed}:{shard_id}".encode('utf-8')).hexdigest()[:8], 16)
+
+
+def split_quota(total, weights):
+    """Chia chỉ tiêu theo tỉ lệ trọng số (phần dư lớn nhất, hòa thì shard nhỏ hơn trước) -> xác định"""
+    weight_sum = sum(weights)
+    if weight_sum <= 0:
+        return [0] * len(weights)
+    exact = [total * w / weight_sum for w in weights]
+    shares = [int(x) for x in exact]
+    order = sorted(range(len(weights)), key=lambda i: (-(exact[i] - shares[i]), i))
+    for i in order[:total - sum(shares)]:
+        shares[i] += 1
+    return shares
+
+
+class QuotaCoordinator:
+    """Sổ chỉ tiêu dùng chung giữa các worker: tổng câu đã sinh theo hop + thanh tiến độ"""
+
+    def __init__(self, quotas):
+        self.lock = threading.Lock()
+        self.quotas = quotas            # [{hop: chỉ tiêu}] theo shard
+        self.totals = {hop: 0 for hop in QUOTA}
+        self.pbar = tqdm(total=sum(sum(q.values()) for q in quotas))
+
+    def update(self, hop_type):
+        with self.lock:
+            self.totals[hop_type] += 1
+            self.pbar.update(1)
+
+    def close(self):
+        self.pbar.close()
+
+
 class AdvancedDataGenerator:
-    def __init__(self, uri, auth):
-        self.driver = GraphDatabase.driver(uri, auth=auth)
-        self.collected_data = []
+    def __init__(self, uri, auth, snapshot_dir=SNAPSHOT_DIR, seed=SEED):
+        self.driver = None
+        self.engine = None
+        if snapshot_dir:
+            print(f"📸 Đang nạp snapshot graph: {snapshot_dir}...")
+            self.engine = SnapshotPathEngine(GraphSnapshot.load(snapshot_dir), seed=seed)
+        else:
+            self.driver = GraphDatabase.driver(uri, auth=auth)
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.quota = dict(QUOTA)
+        self.output_prefix = OUTPUT_PREFIX
+        self.writer = None
+        self.negatives = None
+        self.dedup = None
         self.counters = {"1-hop": 0, "2-hop": 0, "3-hop": 0}
-        self.file_counter = 1
+        self.visited = {hop: set() for hop in QUOTA}
+        self.negative_count = 0
+
+    def shard(self, shard_id, quota):
+        """Bản sao cho một shard: dùng chung driver/snapshot, RNG + chỉ tiêu + bộ đếm + file riêng"""
+        worker = copy.copy(self)
+        seed = shard_seed(self.seed, shard_id)
+        worker.rng = random.Random(seed)
+        if self.engine is not None:
+            worker.engine = SnapshotPathEngine(self.engine.g, seed=seed)
+        worker.quota = quota
+        worker.output_prefix = f"{OUTPUT_PREFIX}_shard{shard_id:02d}"
+        if self.negatives is not None:
+            worker.negatives = self.negatives.fork(seed)
+        if DEDUP:
+            store = open_store(os.path.join(DEDUP_DIR, f"shard{shard_id:02d}"), DEDUP,
+                               capacity=max(1, DEDUP_CAPACITY // NUM_SHARDS), fp_rate=DEDUP_FP_RATE)
+            worker.dedup = SentenceDeduplicator(store)
+        # Mở writer ngay cả khi shard không sinh câu nào -> part cũ của shard từ lần chạy trước vẫn bị xóa
+        worker.writer = SentenceWriter(OUTPUT_DIR, worker.output_prefix, OUTPUT_FORMAT, SENTENCES_PER_FILE,
+                                       append=bool(DEDUP))
+        worker.counters = {"1-hop": 0, "2-hop": 0, "3-hop": 0}
+        worker.visited = {hop: set() for hop in QUOTA}
+        worker.negative_count = 0
+        return worker
 
     def close(self):
-        self.driver.close()
+        if self.driver is not None:
+            self.driver.close()
+
+    def session(self):
+        """Session Neo4j, hoặc context rỗng khi chạy từ snapshot"""
+        return nullcontext() if self.engine is not None else self.driver.session()
 
     def get_all_diseases(self):
         """Lấy danh sách ID tất cả các bệnh"""
         print("📋 Đang lấy danh sách Index các bệnh...")
-        query = "MATCH (d:Disease) RETURN d.ID as id, d.name as name"
-        with self.driver.session() as session:
-            result = session.run(query).data()
-            random.shuffle(result)
-            return result
+        if self.engine is not None:
+            result = self.engine.diseases()
+        else:
+            query = "MATCH (d:Disease) RETURN d.ID as id, d.name as name"
+            with self.driver.session() as session:
+                result = session.run(query).data()
+        # Sắp theo ID trước khi xáo -> cùng seed cho cùng thứ tự dù server trả về thứ tự nào
+        result.sort(key=lambda d: str(d['id']))
+        self.rng.shuffle(result)
+        return result
 
     # ================= HÀM HỖ TRỢ XỬ LÝ TEXT =================
     def clean_text(self, text):
@@ -69,78 +241,197 @@ class AdvancedDataGenerator:
         return first_sentence.strip()
 
     # ================= QUERY BUILDERS (ĐÃ CẬP NHẬT DESCRIPTION) =================
-    
-    def query_1_hop(self, disease_id, limit):
+    # Mỗi truy vấn chạy cho cả lô bệnh: UNWIND $ids rồi MATCH bệnh theo ID, mỗi dòng trả về có cột disease_id.
+    # Mỗi quan hệ lấy mẫu ngẫu nhiên phía server (ORDER BY rand() LIMIT $limit) trong subquery riêng
+    # (LIMIT trong subquery -> giới hạn theo từng bệnh) rồi COLLECT -> mỗi bệnh trả về đúng 1 dòng,
+    # chi phí tuyến tính theo bậc thay vì tích Descartes triệu chứng x thuốc x nhóm.
+    # Record phẳng cho template được ghép lại ở compose_records.
+
+    def sampled(self, pattern, var, projection, alias):
+        """
+        Subquery lấy mẫu một quan hệ của d. Không có SEED: ORDER BY rand() LIMIT $limit phía server.
+        Có SEED: trả toàn bộ ID láng giềng, client lấy mẫu rồi mới đọc thuộc tính (xem sample_rows).
+        """
+        if self.seed is None:
+            body = f"""WITH {var} ORDER BY rand() LIMIT $limit
+            RETURN collect({projection}) AS {alias}"""
+        else:
+            body = f"RETURN collect({var}.ID) AS {alias}"
+        return f"""
+        CALL {{
+            WITH d
+            MATCH {pattern}
+            {body}
+        }}"""
+
+    def query_1_hop(self):
         """
         1-Hop: Lấy thêm mô tả của Bệnh, Thuốc, Nhóm
         """
         query = """
-        MATCH (d:Disease {ID: $id})
-        
-        OPTIONAL MATCH (d)-[:HAS_SYMPTOM]->(s:Symptom)
-        OPTIONAL MATCH (dr:Drug)-[:TREATS]->(d)
-        OPTIONAL MATCH (d)-[:BELONGS_TO]->(g:Group)
-        
+        UNWIND $ids AS disease_id
+        MATCH (d:Disease {ID: disease_id})""" + self.sampled(
+            "(d)-[:HAS_SYMPTOM]->(s:Symptom)", "s", "s.name", "symptoms") + self.sampled(
+            "(dr:Drug)-[:TREATS]->(d)", "dr", "{name: dr.name, desc: dr.description}", "drugs") + """
+        CALL {
+            WITH d
+            OPTIONAL MATCH (d)-[:BELONGS_TO]->(g:Group)
+            RETURN g.name AS group_name, g.description AS group_desc
+            ORDER BY g.ID LIMIT 1
+        }
         RETURN 
+            disease_id,
             d.name as disease,
             d.description as disease_desc,      // <--- Thêm mô tả bệnh
-            s.name as symptom,
-            dr.name as drug,
-            dr.description as drug_desc,        // <--- Thêm mô tả thuốc
-            g.name as group_name,
-            g.description as group_desc         // <--- Thêm mô tả nhóm
-        LIMIT $limit
+            symptoms,
+            drugs,                              // <--- Kèm mô tả thuốc
+            group_name,
+            group_desc                          // <--- Thêm mô tả nhóm
         """
         return query
 
-    def query_2_hop(self, disease_id, limit):
+    def query_2_hop(self):
         """
         2-Hop: Lấy mô tả thuốc, bệnh cha, bệnh con
         """
         query = """
-        MATCH (d:Disease {ID: $id})
+        UNWIND $ids AS disease_id
+        MATCH (d:Disease {ID: disease_id})
         
-        // Path 1: Thuốc -> Bệnh -> Triệu chứng
-        OPTIONAL MATCH (dr:Drug)-[:TREATS]->(d)-[:HAS_SYMPTOM]->(s:Symptom)
+        // Path 1: Thuốc -> Bệnh -> Triệu chứng""" + self.sampled(
+            "(dr:Drug)-[:TREATS]->(d)", "dr", "{name: dr.name, desc: dr.description}", "drugs") + self.sampled(
+            "(d)-[:HAS_SYMPTOM]->(s:Symptom)", "s", "s.name", "symptoms") + """
         
-        // Path 2: Bệnh con -> Bệnh cha -> Nhóm
-        OPTIONAL MATCH (sub:Disease)-[:IS_A]->(d)-[:BELONGS_TO]->(g:Group)
-        
-        WITH d, dr, s, sub, g
-        WHERE dr IS NOT NULL OR sub IS NOT NULL 
+        // Path 2: Bệnh con -> Bệnh cha -> Nhóm""" + self.sampled(
+            "(sub:Disease)-[:IS_A]->(d)", "sub", "{name: sub.name, desc: sub.description}", "subs") + """
+        CALL {
+            WITH d
+            OPTIONAL MATCH (d)-[:BELONGS_TO]->(g:Group)
+            RETURN g.name AS group_name
+            ORDER BY g.ID LIMIT 1
+        }
 
         RETURN 
+            disease_id,
             d.name as disease,
             d.description as disease_desc,      // <---
-            dr.name as drug,
-            dr.description as drug_desc,        // <---
-            s.name as symptom,
-            sub.name as sub_disease,
-            sub.description as sub_desc,        // <---
-            g.name as group_name
-        LIMIT $limit
+            drugs,                              // <---
+            symptoms,
+            subs,                               // <---
+            group_name
         """
         return query
 
-    def query_3_hop(self, disease_id, limit):
+    def query_3_hop(self):
         """
         3-Hop: Lấy mô tả Nhóm và Chương
         """
         query = """
-        MATCH (d:Disease {ID: $id})
-        MATCH (dr:Drug)-[:TREATS]->(d)-[:BELONGS_TO]->(g:Group)-[:BELONGS_TO]->(c:Chapter)
+        UNWIND $ids AS disease_id
+        MATCH (d:Disease {ID: disease_id})
+        // Một cặp Nhóm/Chương mỗi bệnh (subquery -> LIMIT theo từng bệnh, bệnh không có path bị loại)
+        CALL {
+            WITH d
+            MATCH (d)-[:BELONGS_TO]->(g:Group)-[:BELONGS_TO]->(c:Chapter)
+            RETURN g, c ORDER BY g.ID, c.ID LIMIT 1
+        }""" + self.sampled("(dr:Drug)-[:TREATS]->(d)", "dr", "dr.name", "drugs") + """
+        WITH disease_id, d, g, c, drugs WHERE size(drugs) > 0
         
         RETURN 
+            disease_id,
             d.name as disease,
-            dr.name as drug,
+            drugs,
             g.name as group_name,
             g.description as group_desc,        // <---
             c.name as chapter_name,
             c.description as chapter_desc       // <---
-        LIMIT $limit
         """
         return query
 
+    def compose_records(self, hop_type, row, limit):
+        """
+        Ghép các danh sách đã lấy mẫu của một bệnh thành record phẳng (cùng cột như trước)
+        cho process_result_to_text: dòng thứ i lấy phần tử thứ i của mỗi danh sách.
+        """
+        d = {"disease": row["disease"], "disease_desc": row.get("disease_desc")}
+
+        if hop_type == "1-hop":
+            symptoms, drugs = row["symptoms"], row["drugs"]
+            n = min(limit, max(len(symptoms), len(drugs), 1))
+            return [dict(d,
+                         symptom=symptoms[i] if i < len(symptoms) else None,
+                         drug=drugs[i]["name"] if i < len(drugs) else None,
+                         drug_desc=drugs[i]["desc"] if i < len(drugs) else None,
+                         group_name=row["group_name"], group_desc=row["group_desc"])
+                    for i in range(n)]
+
+        if hop_type == "2-hop":
+            drugs, symptoms, subs = row["drugs"], row["symptoms"], row["subs"]
+            # Path Thuốc -> Bệnh -> Triệu chứng cần cả 2 đầu; danh sách ngắn hơn được dùng vòng lại
+            n_pairs = max(len(drugs), len(symptoms)) if drugs and symptoms else 0
+            n_subs = len(subs) if row["group_name"] else 0
+            records = []
+            for i in range(min(limit, max(n_pairs, n_subs))):
+                drug = drugs[i % len(drugs)] if i < n_pairs else {}
+                sub = subs[i] if i < n_subs else {}
+                records.append(dict(d,
+                                    drug=drug.get("name"), drug_desc=drug.get("desc"),
+                                    symptom=symptoms[i % len(symptoms)] if i < n_pairs else None,
+                                    sub_disease=sub.get("name"), sub_desc=sub.get("desc"),
+                                    group_name=row["group_name"] if sub else None))
+            return records
+
+        return [{"disease": row["disease"], "drug": drug,
+                 "group_name": row["group_name"], "group_desc": row["group_desc"],
+                 "chapter_name": row["chapter_name"], "chapter_desc": row["chapter_desc"]}
+                for drug in row["drugs"][:limit]]
+
+    def sample_rows(self, session, hop_type, rows, limit):
+        """
+        Chế độ có SEED: lấy mẫu tối đa limit ID mỗi danh sách bằng RNG của shard (duyệt bệnh và ID theo thứ tự
+        xác định), rồi đọc thuộc tính của mọi ID đã chọn bằng 1 truy vấn mỗi nhãn -> cùng dạng như ORDER BY rand().
+        """
+        lists = SAMPLED_LISTS[hop_type]
+        rows.sort(key=lambda row: str(row["disease_id"]))
+        wanted = {}
+        for row in rows:
+            for key, (label, _) in lists.items():
+                ids = sample_ids(self.rng, row[key], limit)
+                row[key] = ids
+                wanted.setdefault(label, set()).update(ids)
+
+        props = {}
+        for label, ids in wanted.items():
+            records = session.run(PROPERTY_QUERY % label, ids=sorted(ids, key=str)).data()
+            props[label] = {record["id"]: record for record in records}
+        for row in rows:
+            for key, (label, shape) in lists.items():
+                found = [props[label][i] for i in row[key] if i in props[label]]
+                if shape == "name":
+                    row[key] = [item["name"] for item in found]
+                else:
+                    row[key] = [{"name": item["name"], "desc": item["desc"]} for item in found]
+        return rows
+
+    def fetch_hop_batch(self, session, hop_type, disease_ids):
+        """Chạy truy vấn hop cho cả lô bệnh, trả về {disease_id: [record, ...]}"""
+        limit = MAX_PATHS_PER_DISEASE[hop_type]
+        if self.engine is not None:
+            rows = self.engine.fetch_hop_batch(hop_type, disease_ids, limit)
+        else:
+            builders = {"1-hop": self.query_1_hop, "2-hop": self.query_2_hop, "3-hop": self.query_3_hop}
+            query = builders[hop_type]()
+            if self.seed is None:
+                rows = session.run(query, ids=disease_ids, limit=limit).data()
+            else:
+                rows = self.sample_rows(session, hop_type, session.run(query, ids=disease_ids).data(), limit)
+        grouped = {}
+        for row in rows:
+            records = self.compose_records(hop_type, row, limit)
+            if records:
+                grouped.setdefault(row["disease_id"], []).extend(records)
+        return grouped
+
     # ================= TEMPLATE APPLIER (ĐÃ NÂNG CẤP) =================
     
     def process_result_to_text(self, record, hop_type):
@@ -224,83 +515,270 @@ class AdvancedDataGenerator:
         return items
 
     # ================= FILE SAVING =================
-    
-    def save_batch(self):
-        if not self.collected_data: return
-        os.makedirs(OUTPUT_DIR, exist_ok=True)
-        filename = f"{OUTPUT_PREFIX}_part{self.file_counter:03d}.csv"
-        filepath = os.path.join(OUTPUT_DIR, filename)
-        
-        df = pd.DataFrame(self.collected_data)
-        df = df.sample(frac=1).reset_index(drop=True)
-        df['label'] = True
-        
-        df.to_csv(filepath, index=False, encoding='utf-8-sig')
-        print(f"💾 Đã lưu {len(self.collected_data)} câu vào: {filename}")
-        
-        self.collected_data = []
-        self.file_counter += 1
+
+    def write(self, record):
+        """Ghi nối 1 câu vào part của shard (writer mở sẵn trong shard(), part đầu tạo ở câu đầu tiên)"""
+        self.writer.write(record)
+
+    def close_writer(self):
+        """Đóng part đang ghi, trả về số part của shard"""
+        return self.writer.close() if self.writer is not None else 0
 
     # ================= MAIN GENERATOR =================
 
+    # ================= LẬP KẾ HOẠCH LẤY MẪU =================
+
+    def get_degree_stats(self):
+        """Bậc của mọi bệnh (triệu chứng, thuốc, bệnh con, có nhóm/chương, có mô tả) bằng 1 truy vấn"""
+        print("📐 Đang tính bậc của các bệnh...")
+        if self.engine is not None:
+            stats = self.engine.degree_stats()
+        else:
+            with self.driver.session() as session:
+                stats = session.run(DEGREE_QUERY).data()
+        stats.sort(key=lambda st: str(st["id"]))
+        self.rng.shuffle(stats)
+        return stats
+
+    def expected_yield(self, hop_type, st):
+        """Ước lượng số câu một bệnh sinh ra cho loại hop (theo compose_records + template)"""
+        limit = MAX_PATHS_PER_DISEASE[hop_type]
+        if hop_type == "1-hop":
+            # Câu về nhóm / mô tả bệnh giống nhau ở mọi dòng -> chỉ tính 1 lần (consume bỏ câu lặp trong bệnh)
+            rows = min(limit, max(st["symptoms"], st["drugs"], 1))
+            n = min(rows, st["drugs"]) + min(rows, st["symptoms"])
+            n += 1 if st["has_group"] else 0
+            n += 2 if st["has_desc"] else 0
+        elif hop_type == "2-hop":
+            pairs = max(st["drugs"], st["symptoms"]) if st["drugs"] and st["symptoms"] else 0
+            subs = st["subs"] if st["has_group"] else 0
+            n = min(limit, pairs) + min(limit, subs)
+        else:
+            n = min(limit, st["drugs"]) if st["has_chapter"] else 0
+        return min(n, MAX_SENTENCES_PER_DISEASE[hop_type])
+
+    def build_plan(self, stats):
+        """
+        Chọn bệnh cho từng loại hop: bỏ bệnh không có path (vd 3-hop khi không có thuốc/chương),
+        lấy lần lượt theo thứ tự ngẫu nhiên đến khi tổng câu dự kiến đạt chỉ tiêu x PLAN_MARGIN.
+        Trả về (thứ tự bệnh, {hop: tập ID bệnh cần truy vấn}, {hop: [ID bệnh có path còn lại, để lấy bù]}).
+        """
+        plan, reserve = {}, {}
+        print("🗺️ Kế hoạch lấy mẫu:")
+        for hop in QUOTA:
+            target = QUOTA[hop] * PLAN_MARGIN
+            chosen, rest, expected = set(), [], 0
+            for st in stats:
+                n = self.expected_yield(hop, st)
+                if n <= 0:
+                    continue
+                if expected < target:
+                    chosen.add(st["id"])
+                    expected += n
+                else:
+                    rest.append(st["id"])
+            plan[hop] = chosen
+            reserve[hop] = rest
+            print(f"   - {hop}: {len(chosen)}/{len(chosen) + len(rest)} bệnh có path, dự kiến {expected} câu "
+                  f"(chỉ tiêu {QUOTA[hop]}), {-(-len(chosen) // DISEASE_BATCH)} truy vấn, {len(rest)} bệnh dự phòng")
+        order = [{"id": st["id"]} for st in stats if any(st["id"] in ids for ids in plan.values())]
+        return order, plan, reserve
+
+    def consume(self, records, hop_type, d_id, coordinator):
+        """Sinh câu từ các record của một bệnh và cộng vào chỉ tiêu (tối đa MAX_SENTENCES_PER_DISEASE)"""
+        # Câu lặp giữa các dòng của cùng bệnh (vd câu về nhóm, mô tả bệnh ở 1-hop) chỉ giữ 1 lần
+        sentences = list(dict.fromkeys(s for r in records for s in self.process_result_to_text(r, hop_type)))
+        cap = MAX_SENTENCES_PER_DISEASE[hop_type] if USE_PLANNER else None
+        if self.dedup is not None:
+            sentences = self.dedup.filter(sentences, hop_type, cap)
+        sentences = sentences[:cap]
+        for s in sentences:
+            self.write({"text": s, "hop": hop_type, "source_id": d_id, "label": True, "corrupted": None})
+            self.counters[hop_type] += 1
+            coordinator.update(hop_type)
+
+        if self.negatives is not None and sentences:
+            limit = len(sentences) * NEGATIVES_PER_POSITIVE
+            negatives = [(s, slot) for r, slot in self.negatives.corrupt(records, hop_type, d_id, limit)
+                         for s in self.process_result_to_text(r, hop_type)]
+            if self.dedup is not None:
+                kept = self.dedup.select([s for s, _ in negatives], f"{hop_type} (sai)", limit)
+                negatives = [negatives[i] for i in kept]
+            for s, slot in negatives[:limit]:
+                self.write({"text": s, "hop": hop_type, "source_id": d_id, "label": False, "corrupted": slot})
+                self.negative_count += 1
+
+    def done(self):
+        return all(self.counters[k] >= self.quota[k] for k in self.quota)
+
+    def sample_chunk(self, session, ids, hop_ids, coordinator):
+        """Mỗi lô bệnh chỉ 1 truy vấn cho mỗi loại hop còn thiếu chỉ tiêu, rồi sinh câu theo thứ tự bệnh"""
+        results = {}
+        for hop, selected in hop_ids.items():
+            if self.counters[hop] < self.quota[hop] and selected:
+                results[hop] = (set(selected), self.fetch_hop_batch(session, hop, selected))
+
+        for d_id in ids:
+            if self.done():
+                break
+            # 1-HOP, 2-HOP, 3-HOP (giữ nguyên thứ tự và cách tính chỉ tiêu như khi truy vấn từng bệnh)
+            for hop, (selected, grouped) in results.items():
+                if self.counters[hop] < self.quota[hop] and d_id in selected:
+                    self.consume(grouped.get(d_id, []), hop, d_id, coordinator)
+                    self.visited[hop].add(d_id)
+
+    def sample(self, session, diseases, plan, coordinator, reserve=None):
+        """
+        Vòng lấy mẫu của một shard: duyệt bệnh theo lô DISEASE_BATCH đến khi đủ chỉ tiêu của shard.
+        Hết bệnh trong kế hoạch mà hop nào còn thiếu -> lấy bù từ reserve[hop] (bệnh có path của shard, cùng thứ tự).
+        Bệnh đã duyệt ở vòng trước (self.visited) được bỏ qua -> gọi lại sau khi tăng chỉ tiêu để lấy tiếp.
+        """
+        for start in range(0, len(diseases), DISEASE_BATCH):
+            if self.done():
+                break
+            ids = [d['id'] for d in diseases[start:start + DISEASE_BATCH]]
+            hop_ids = {hop: [i for i in ids if (plan is None or i in plan[hop]) and i not in self.visited[hop]]
+                       for hop in self.quota}
+            self.sample_chunk(session, ids, hop_ids, coordinator)
+
+        for hop, ids in (reserve or {}).items():
+            ids = [i for i in ids if i not in self.visited[hop]]
+            for start in range(0, len(ids), DISEASE_BATCH):
+                if self.counters[hop] >= self.quota[hop]:
+                    break
+                chunk = ids[start:start + DISEASE_BATCH]
+                self.sample_chunk(session, chunk, {hop: chunk}, coordinator)
+
+    def pending(self, hop, diseases, plan, reserve=None):
+        """Số bệnh có thể lấy cho hop mà shard chưa duyệt (kế hoạch + dự phòng)"""
+        ids = [d['id'] for d in diseases if plan is None or d['id'] in plan[hop]] + (reserve or {}).get(hop, [])
+        return sum(1 for i in ids if i not in self.visited[hop])
+
+    def finish(self):
+        """Đóng tập hash + part đang ghi sau vòng cuối, trả về (bộ đếm, số câu sai, số part, thống kê lọc trùng)"""
+        stats = self.dedup.close() if self.dedup is not None else {}
+        return self.counters, self.negative_count, self.close_writer(), stats
+
+    def split_shards(self, diseases, plan, stats, reserve=None):
+        """
+        Coordinator chia trước: bệnh -> shard theo băm ID (giữ thứ tự đã xáo), chỉ tiêu từng hop chia
+        theo số câu dự kiến của shard (planner) hoặc số bệnh của shard -> không phụ thuộc tốc độ worker.
+        Bệnh dự phòng của planner cũng chia theo shard (giữ thứ tự). Shard hết bệnh mà chưa đủ chỉ tiêu thì
+        phần thiếu được rebalance() chia lại cho các shard còn bệnh.
+        """
+        shards = [[] for _ in range(NUM_SHARDS)]
+        for d in diseases:
+            shards[shard_of(d['id'])].append(d)
+        reserves = [{hop: [] for hop in QUOTA} for _ in range(NUM_SHARDS)]
+        for hop, ids in (reserve or {}).items():
+            for d_id in ids:
+                reserves[shard_of(d_id)][hop].append(d_id)
+        by_id = {st["id"]: st for st in stats} if stats is not None else {}
+        quotas = [{} for _ in range(NUM_SHARDS)]
+        for hop in QUOTA:
+            if plan is None:
+                weights = [len(part) for part in shards]
+            else:
+                weights = [sum(self.expected_yield(hop, by_id[d['id']]) for d in part if d['id'] in plan[hop])
+                           for part in shards]
+            for shard_id, share in enumerate(split_quota(QUOTA[hop], weights)):
+                quotas[shard_id][hop] = share
+        return shards, quotas, reserves
+
+    def run_shard(self, worker, diseases, plan, coordinator, reserve=None):
+        with worker.session() as session:
+            worker.sample(session, diseases, plan, coordinator, reserve)
+
+    def rebalance(self, workers, shards, plan, reserves):
+        """
+        Sau mỗi vòng: phần chỉ tiêu còn thiếu của từng hop (do shard hết bệnh) chia lại cho các shard còn bệnh
+        chưa duyệt, theo số bệnh còn lại (split_quota). Chỉ phụ thuộc kết quả vòng trước -> vẫn xác định,
+        không phụ thuộc số worker. Tăng chỉ tiêu của shard tại chỗ, trả về danh sách shard cần chạy tiếp.
+        """
+        active = set()
+        for hop in QUOTA:
+            shortfall = QUOTA[hop] - sum(w.counters[hop] for w in workers)
+            if shortfall <= 0:
+                continue
+            weights = [w.pending(hop, shards[i], plan, reserves[i]) for i, w in enumerate(workers)]
+            shares = split_quota(shortfall, weights)
+            if not any(shares):
+                continue
+            print(f"🔄 Chia lại {shortfall} câu {hop} còn thiếu cho {sum(1 for n in shares if n)} shard còn bệnh")
+            for i, extra in enumerate(shares):
+                if extra:
+                    # Shard có thể đã vượt chỉ tiêu cũ (bệnh cuối sinh dư câu) -> cộng thêm từ số câu đã có
+                    workers[i].quota[hop] = max(workers[i].quota[hop], workers[i].counters[hop]) + extra
+                    active.add(i)
+        return sorted(active)
+
     def generate(self):
-        all_diseases = self.get_all_diseases()
+        plan, stats, reserve = None, None, None
+        if USE_PLANNER:
+            stats = self.get_degree_stats()
+            all_diseases, plan, reserve = self.build_plan(stats)
+        else:
+            all_diseases = self.get_all_diseases()
         total_diseases = len(all_diseases)
         print(f"✅ Tìm thấy {total_diseases} bệnh. Bắt đầu sampling...")
 
-        with self.driver.session() as session:
-            pbar = tqdm(total=TOTAL_TARGET)
-            
-            for idx, disease_info in enumerate(all_diseases):
-                d_id = disease_info['id']
-                if all(self.counters[k] >= QUOTA[k] for k in QUOTA):
-                    print("\n🎉 Đã đạt đủ chỉ tiêu số lượng!")
-                    break
+        if NEGATIVES_PER_POSITIVE > 0:
+            if self.engine is not None:
+                snapshot = self.engine.g
+            else:
+                print(f"📸 NEGATIVES_PER_POSITIVE = {NEGATIVES_PER_POSITIVE} nhưng không có SNAPSHOT_DIR -> đang đọc "
+                      "TOÀN BỘ node + quan hệ từ Neo4j cho negative sampling (chậm với graph lớn). Tạo snapshot một "
+                      "lần bằng python graph_snapshot.py rồi đặt SNAPSHOT_DIR để bỏ qua bước này...")
+                snapshot = GraphSnapshot.export(self.driver)
+            self.negatives = NegativeSampler(snapshot, hard=HARD_NEGATIVES)
+
+        shards, quotas, reserves = self.split_shards(all_diseases, plan, stats, reserve)
+        coordinator = QuotaCoordinator(quotas)
+        print(f"🧩 {NUM_SHARDS} shard (seed {self.seed}), {WORKERS} worker song song")
+        workers = [self.shard(shard_id, quotas[shard_id]) for shard_id in range(NUM_SHARDS)]
+        try:
+            with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+                # Vòng đầu chạy mọi shard, các vòng sau chỉ chạy shard được chia thêm phần chỉ tiêu còn thiếu
+                active = list(range(NUM_SHARDS))
+                while active:
+                    futures = [pool.submit(self.run_shard, workers[shard_id], shards[shard_id], plan, coordinator,
+                                           reserves[shard_id])
+                               for shard_id in active]
+                    for f in futures:
+                        f.result()
+                    active = self.rebalance(workers, shards, plan, reserves)
+        finally:
+            results = [worker.finish() for worker in workers]
+            coordinator.close()
 
-                # 1-HOP
-                if self.counters["1-hop"] < QUOTA["1-hop"]:
-                    res = session.run(self.query_1_hop(d_id, MAX_PATHS_PER_DISEASE["1-hop"]), id=d_id, limit=MAX_PATHS_PER_DISEASE["1-hop"]).data()
-                    for r in res:
-                        sentences = self.process_result_to_text(r, "1-hop")
-                        for s in sentences:
-                            self.collected_data.append({"text": s, "hop": "1-hop", "source_id": d_id})
-                            self.counters["1-hop"] += 1
-                            pbar.update(1)
-                            if len(self.collected_data) >= SENTENCES_PER_FILE: self.save_batch()
-
-                # 2-HOP
-                if self.counters["2-hop"] < QUOTA["2-hop"]:
-                    res = session.run(self.query_2_hop(d_id, MAX_PATHS_PER_DISEASE["2-hop"]), id=d_id, limit=MAX_PATHS_PER_DISEASE["2-hop"]).data()
-                    for r in res:
-                        sentences = self.process_result_to_text(r, "2-hop")
-                        for s in sentences:
-                            self.collected_data.append({"text": s, "hop": "2-hop", "source_id": d_id})
-                            self.counters["2-hop"] += 1
-                            pbar.update(1)
-                            if len(self.collected_data) >= SENTENCES_PER_FILE: self.save_batch()
-
-                # 3-HOP
-                if self.counters["3-hop"] < QUOTA["3-hop"]:
-                    res = session.run(self.query_3_hop(d_id, MAX_PATHS_PER_DISEASE["3-hop"]), id=d_id, limit=MAX_PATHS_PER_DISEASE["3-hop"]).data()
-                    for r in res:
-                        sentences = self.process_result_to_text(r, "3-hop")
-                        for s in sentences:
-                            self.collected_data.append({"text": s, "hop": "3-hop", "source_id": d_id})
-                            self.counters["3-hop"] += 1
-                            pbar.update(1)
-                            if len(self.collected_data) >= SENTENCES_PER_FILE: self.save_batch()
-
-            pbar.close()
-
-        if self.collected_data:
-            self.save_batch()
+        if all(coordinator.totals[k] >= QUOTA[k] for k in QUOTA):
+            print("\n🎉 Đã đạt đủ chỉ tiêu số lượng!")
+        for shard_id, (counters, _, files, _) in enumerate(results):
+            missing = {k: quotas[shard_id][k] - counters[k] for k in QUOTA if counters[k] < quotas[shard_id][k]}
+            note = f" ⚠️ thiếu {missing}" if missing else ""
+            print(f"   - shard {shard_id:02d}: {len(shards[shard_id])} bệnh, {counters} câu, {files} file{note}")
+        self.counters = coordinator.totals
+        self.negative_count = sum(result[1] for result in results)
+        total_files = sum(result[2] for result in results)
 
         print("\n📊 Thống kê kết quả:")
         print(f"   - 1-hop: {self.counters['1-hop']} câu")
         print(f"   - 2-hop: {self.counters['2-hop']} câu")
         print(f"   - 3-hop: {self.counters['3-hop']} câu")
-        print(f"   - Tổng số file: {self.file_counter - 1} files")
+        print(f"   - Câu sai (label False): {self.negative_count} câu")
+        print(f"   - Tổng số file: {total_files} files")
+        if DEDUP:
+            dedup_stats = merge_stats(result[3] for result in results)
+            print_report(dedup_stats)
+            keys = saturated(dedup_stats, DEDUP_WARN_RATIO)
+            if keys:
+                print("\n" + "!" * 70)
+                print(f"⚠️ CẢNH BÁO: hơn {DEDUP_WARN_RATIO:.0%} câu ứng viên bị lọc trùng ở: {', '.join(keys)}")
+                print(f"   Tập hash {DEDUP_DIR} đã chứa câu của các lần chạy trước. Chạy lại cùng SEED ({self.seed})")
+                print("   sẽ sinh lại đúng các câu đó -> đổi SEED, xóa DEDUP_DIR hoặc đặt DEDUP = None.")
+                print("!" * 70)
         print(f"✅ Các file đã được lưu tại thư mục: {OUTPUT_DIR}")
+        print("👉 Xáo toàn cục + chia shard huấn luyện: python sentence_store.py")
 
 if __name__ == "__main__":
     generator = AdvancedDataGenerator(URI, AUTH)
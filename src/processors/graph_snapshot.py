@@ -0,0 +1,244 @@
+import json
+import os
+import random
+import numpy as np
+from neo4j import GraphDatabase
+
+# ================= CẤU HÌNH =================
+URI = "bolt://20.249.211.169:7687"
+AUTH = ("neo4j", "neo4j123")
+SNAPSHOT_DIR = "../../data/graph_snapshot"
+
+# Thuộc tính node cần cho bước sinh câu (không lấy vector)
+NODE_PROPERTIES = {
+    "Chapter": ["ID", "name", "description"],
+    "Group": ["ID", "name", "description"],
+    "Disease": ["ID", "name", "description"],
+    "Drug": ["ID", "name", "description"],
+    "Symptom": ["ID", "name"]
+}
+
+# (quan hệ, nhãn nguồn, nhãn đích)
+RELATIONS = [
+    ("BELONGS_TO", "Disease", "Group"),
+    ("BELONGS_TO", "Group", "Chapter"),
+    ("IS_A", "Disease", "Disease"),
+    ("TREATS", "Drug", "Disease"),
+    ("HAS_SYMPTOM", "Disease", "Symptom")
+]
+
+NODES_FILE = "nodes.json"
+ADJACENCY_FILE = "adjacency.npz"
+
+# ================= ĐỊNH DẠNG SNAPSHOT =================
+# Thư mục snapshot:
+#   nodes.json      -> {nhãn: {thuộc tính: [giá trị theo chỉ số node]}} (chỉ số node riêng cho từng nhãn)
+#   adjacency.npz   -> mỗi quan hệ (rel, nguồn, đích) 2 ma trận CSR: chiều đi (out) và chiều về (in)
+#                      <key>.out_indptr / <key>.out_indices / <key>.in_indptr / <key>.in_indices
+# Key quan hệ dạng "BELONGS_TO:Disease->Group".
+
+
+def sample_ids(rng, ids, limit, key=str):
+    """
+    Lấy mẫu tối đa limit phần tử theo thứ tự xác định: sắp xếp theo key (mặc định str của ID), chỉ gọi
+    rng.sample khi vượt limit. Dùng chung cho chế độ snapshot và online để cùng SEED cho cùng cách chọn.
+    """
+    ids = sorted(ids, key=key)
+    if len(ids) > limit:
+        ids = rng.sample(ids, limit)
+    return ids
+
+
+def relation_key(rel, src, dst):
+    return f"{rel}:{src}->{dst}"
+
+
+def build_csr(sources, targets, num_nodes):
+    """Danh sách cạnh -> (indptr, indices), láng giềng của mỗi node giữ thứ tự tăng dần"""
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    order = np.lexsort((targets, sources))
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.add.at(indptr, sources + 1, 1)
+    return np.cumsum(indptr), targets[order].astype(np.int32)
+
+
+class GraphSnapshot:
+    """Ảnh chụp graph trong bộ nhớ: thuộc tính node + ma trận kề CSR theo từng quan hệ"""
+
+    def __init__(self, nodes, adjacency):
+        self.nodes = nodes
+        self.adjacency = adjacency
+        self.index = {label: {node_id: i for i, node_id in enumerate(props["ID"])}
+                      for label, props in nodes.items()}
+
+    @classmethod
+    def from_records(cls, nodes, edges):
+        """
+        nodes: {nhãn: [{"ID", "name", ...}, ...]}, edges: {(rel, nguồn, đích): [(ID nguồn, ID đích), ...]}
+        Dùng cho export từ Neo4j và để dựng snapshot nhỏ tổng hợp khi thử nghiệm.
+        """
+        columns = {}
+        for label, props in NODE_PROPERTIES.items():
+            items = sorted(nodes.get(label, []), key=lambda item: str(item["ID"]))
+            columns[label] = {prop: [item.get(prop) for item in items] for prop in props}
+        index = {label: {node_id: i for i, node_id in enumerate(props["ID"])} for label, props in columns.items()}
+
+        adjacency = {}
+        for rel, src, dst in RELATIONS:
+            key = relation_key(rel, src, dst)
+            pairs = [(index[src][a], index[dst][b]) for a, b in edges.get((rel, src, dst), [])
+                     if a in index[src] and b in index[dst]]
+            s = [a for a, _ in pairs]
+            t = [b for _, b in pairs]
+            adjacency[f"{key}.out_indptr"], adjacency[f"{key}.out_indices"] = build_csr(s, t, len(index[src]))
+            adjacency[f"{key}.in_indptr"], adjacency[f"{key}.in_indices"] = build_csr(t, s, len(index[dst]))
+        return cls(columns, adjacency)
+
+    @classmethod
+    def export(cls, driver):
+        """Đọc node + quan hệ cần thiết từ Neo4j (mỗi nhãn / quan hệ một truy vấn)"""
+        nodes, edges = {}, {}
+        with driver.session() as session:
+            for label, props in NODE_PROPERTIES.items():
+                fields = ", ".join(f"n.{p} AS {p}" for p in props)
+                nodes[label] = session.run(f"MATCH (n:{label}) RETURN {fields}").data()
+                print(f"   ↳ {label}: {len(nodes[label])} node")
+            for rel, src, dst in RELATIONS:
+                query = f"MATCH (a:{src})-[:{rel}]->(b:{dst}) RETURN a.ID AS src, b.ID AS dst"
+                edges[(rel, src, dst)] = [(r["src"], r["dst"]) for r in session.run(query)]
+                print(f"   ↳ {relation_key(rel, src, dst)}: {len(edges[(rel, src, dst)])} cạnh")
+        return cls.from_records(nodes, edges)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, NODES_FILE), 'w', encoding='utf-8') as f:
+            json.dump(self.nodes, f, ensure_ascii=False)
+        np.savez_compressed(os.path.join(path, ADJACENCY_FILE), **self.adjacency)
+        print(f"💾 Đã lưu snapshot: {path}")
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, NODES_FILE), 'r', encoding='utf-8') as f:
+            nodes = json.load(f)
+        with np.load(os.path.join(path, ADJACENCY_FILE)) as data:
+            adjacency = {key: data[key] for key in data.files}
+        return cls(nodes, adjacency)
+
+    def prop(self, label, i, name):
+        values = self.nodes[label].get(name)
+        return values[i] if values is not None else None
+
+    def out(self, rel, src, dst, i):
+        """Chỉ số các node đích của (i:src)-[rel]->(:dst)"""
+        key = relation_key(rel, src, dst)
+        indptr = self.adjacency[f"{key}.out_indptr"]
+        return self.adjacency[f"{key}.out_indices"][indptr[i]:indptr[i + 1]].tolist()
+
+    def inn(self, rel, src, dst, i):
+        """Chỉ số các node nguồn của (:src)-[rel]->(i:dst)"""
+        key = relation_key(rel, src, dst)
+        indptr = self.adjacency[f"{key}.in_indptr"]
+        return self.adjacency[f"{key}.in_indices"][indptr[i]:indptr[i + 1]].tolist()
+
+
+class SnapshotPathEngine:
+    """
+    Trả về cùng dòng (mỗi bệnh 1 dòng, các quan hệ đã lấy mẫu ngẫu nhiên tối đa limit phần tử)
+    như query_1_hop / query_2_hop / query_3_hop của 5_generate_sentences.py, không cần Neo4j.
+    """
+
+    def __init__(self, snapshot, seed=None):
+        self.g = snapshot
+        self.rng = random.Random(seed)
+
+    def diseases(self):
+        names = self.g.nodes["Disease"]["name"]
+        return [{"id": node_id, "name": names[i]} for i, node_id in enumerate(self.g.nodes["Disease"]["ID"])]
+
+    def degree_stats(self):
+        """Cùng cột với DEGREE_QUERY của 5_generate_sentences.py, tính trực tiếp từ indptr của CSR"""
+        g = self.g
+        degree = lambda key, direction: np.diff(g.adjacency[f"{key}.{direction}_indptr"])
+        disease_group = relation_key("BELONGS_TO", "Disease", "Group")
+        groups = degree(disease_group, "out")
+        group_has_chapter = degree(relation_key("BELONGS_TO", "Group", "Chapter"), "out") > 0
+        # Bệnh có chương nếu ít nhất một nhóm của nó có chương
+        reach = np.zeros(len(groups), dtype=np.int64)
+        np.add.at(reach, np.repeat(np.arange(len(groups)), groups),
+                  group_has_chapter[g.adjacency[f"{disease_group}.out_indices"]])
+        symptoms = degree(relation_key("HAS_SYMPTOM", "Disease", "Symptom"), "out")
+        drugs = degree(relation_key("TREATS", "Drug", "Disease"), "in")
+        subs = degree(relation_key("IS_A", "Disease", "Disease"), "in")
+        descriptions = g.nodes["Disease"]["description"]
+        return [{"id": node_id, "symptoms": int(symptoms[i]), "drugs": int(drugs[i]), "subs": int(subs[i]),
+                 "has_group": bool(groups[i] > 0), "has_chapter": bool(reach[i] > 0),
+                 "has_desc": bool(descriptions[i])}
+                for i, node_id in enumerate(g.nodes["Disease"]["ID"])]
+
+    def sample(self, label, indices, limit):
+        """Tương đương ORDER BY rand() LIMIT $limit (sắp theo ID như chế độ online, xem sample_ids)"""
+        return sample_ids(self.rng, indices, limit, key=lambda i: str(self.g.prop(label, i, "ID")))
+
+    def _disease(self, d):
+        return {"disease": self.g.prop("Disease", d, "name"), "disease_desc": self.g.prop("Disease", d, "description")}
+
+    def _drugs(self, d, limit):
+        return [{"name": self.g.prop("Drug", i, "name"), "desc": self.g.prop("Drug", i, "description")}
+                for i in self.sample("Drug", self.g.inn("TREATS", "Drug", "Disease", d), limit)]
+
+    def _symptoms(self, d, limit):
+        return [self.g.prop("Symptom", i, "name")
+                for i in self.sample("Symptom", self.g.out("HAS_SYMPTOM", "Disease", "Symptom", d), limit)]
+
+    def _group(self, d):
+        groups = self.g.out("BELONGS_TO", "Disease", "Group", d)
+        return groups[0] if groups else None
+
+    def hop_1(self, d, limit):
+        grp = self._group(d)
+        return dict(self._disease(d), symptoms=self._symptoms(d, limit), drugs=self._drugs(d, limit),
+                    group_name=self.g.prop("Group", grp, "name") if grp is not None else None,
+                    group_desc=self.g.prop("Group", grp, "description") if grp is not None else None)
+
+    def hop_2(self, d, limit):
+        grp = self._group(d)
+        subs = [{"name": self.g.prop("Disease", i, "name"), "desc": self.g.prop("Disease", i, "description")}
+                for i in self.sample("Disease", self.g.inn("IS_A", "Disease", "Disease", d), limit)]
+        return dict(self._disease(d), drugs=self._drugs(d, limit), symptoms=self._symptoms(d, limit), subs=subs,
+                    group_name=self.g.prop("Group", grp, "name") if grp is not None else None)
+
+    def hop_3(self, d, limit):
+        for grp in self.g.out("BELONGS_TO", "Disease", "Group", d):
+            for c in self.g.out("BELONGS_TO", "Group", "Chapter", grp):
+                drugs = [drug["name"] for drug in self._drugs(d, limit)]
+                if not drugs:
+                    return None
+                return {"disease": self.g.prop("Disease", d, "name"), "drugs": drugs,
+                        "group_name": self.g.prop("Group", grp, "name"),
+                        "group_desc": self.g.prop("Group", grp, "description"),
+                        "chapter_name": self.g.prop("Chapter", c, "name"),
+                        "chapter_desc": self.g.prop("Chapter", c, "description")}
+        return None
+
+    def fetch_hop_batch(self, hop_type, disease_ids, limit):
+        """Giống truy vấn batch trên Neo4j: danh sách dòng có cột disease_id"""
+        builders = {"1-hop": self.hop_1, "2-hop": self.hop_2, "3-hop": self.hop_3}
+        rows = []
+        for disease_id in disease_ids:
+            d = self.g.index["Disease"].get(disease_id)
+            if d is None:
+                continue
+            row = builders[hop_type](d, limit)
+            if row is not None:
+                rows.append(dict(row, disease_id=disease_id))
+        return rows
+
+
+if __name__ == "__main__":
+    driver = GraphDatabase.driver(URI, auth=AUTH)
+    try:
+        print(f"📸 Đang chụp snapshot graph từ {URI}...")
+        GraphSnapshot.export(driver).save(SNAPSHOT_DIR)
+    finally:
+        driver.close()
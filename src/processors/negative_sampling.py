@@ -0,0 +1,210 @@
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+from vector_artifacts import VectorArtifact
+
+# ================= CẤU HÌNH =================
+# Vector do 3_embeding.py xuất ra, dùng cho chế độ hard negative (láng giềng gần nhất cùng loại)
+VECTOR_DIRS = {
+    "icd10": "../../data/vectors/icd10",
+    "drugs": "../../data/vectors/drugs",
+    "symptoms": "../../data/vectors/symptoms"
+}
+VECTOR_FIELD = "name_vector"
+HARD_K = 20                 # Số láng giềng gần nhất giữ cho mỗi thực thể
+HARD_RATIO = 0.5            # Tỉ lệ negative lấy từ láng giềng gần nhất (phần còn lại lấy ngẫu nhiên)
+TRIES = 16                  # Số ứng viên rút một lần cho mỗi yêu cầu (loại bỏ ứng viên đúng sự thật)
+BLOCK = 1024                # Số dòng mỗi khối khi tính top-k cosine
+
+# ================= SINH MẪU SAI (NEGATIVE SAMPLING) =================
+# Làm hỏng một record đúng bằng cách thay MỘT thực thể (thuốc / triệu chứng / nhóm / chương / bệnh con)
+# bằng thực thể khác cùng loại KHÔNG liên kết với bệnh trong graph, rồi sinh câu lại bằng cùng template
+# -> câu sai cùng phân phối với câu đúng. Pool thực thể theo loại + quan hệ thật lấy từ snapshot
+# (graph_snapshot.py) nên không có truy vấn Neo4j nào cho từng mẫu.
+
+# Slot của record (compose_records) -> (nhãn node, {trường record: thuộc tính node})
+SLOTS = {
+    "drug": ("Drug", {"drug": "name", "drug_desc": "description"}),
+    "symptom": ("Symptom", {"symptom": "name"}),
+    "group_name": ("Group", {"group_name": "name", "group_desc": "description"}),
+    "chapter_name": ("Chapter", {"chapter_name": "name", "chapter_desc": "description"}),
+    "sub_disease": ("Disease", {"sub_disease": "name", "sub_desc": "description"})
+}
+
+# Mỗi hop: các path (nhóm slot tạo ra cùng một câu) và các trường của bệnh được giữ lại.
+# Chỉ giữ đúng path bị làm hỏng -> không sinh lại các câu đúng khác của record (mô tả bệnh, ...).
+PATHS = {
+    "1-hop": [("drug",), ("group_name",), ("symptom",)],
+    "2-hop": [("drug", "symptom"), ("sub_disease", "group_name")],
+    "3-hop": [("drug", "group_name", "chapter_name")]
+}
+KEEP_FIELDS = {"1-hop": ["disease"], "2-hop": ["disease", "disease_desc"], "3-hop": ["disease"]}
+
+
+def top_k_neighbors(vectors, k, block=BLOCK):
+    """Top-k cosine của từng dòng (không tính chính nó), trả về chỉ số dòng [n, k]"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit = vectors / np.maximum(norms, 1e-12)
+    k = min(k, len(unit) - 1)
+    result = np.empty((len(unit), max(k, 0)), dtype=np.int64)
+    if k <= 0:
+        return result
+    for start in range(0, len(unit), block):
+        sims = unit[start:start + block] @ unit.T
+        np.fill_diagonal(sims[:, start:start + block], -np.inf)
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(sims, top, axis=1), axis=1)
+        result[start:start + block] = np.take_along_axis(top, order, axis=1)
+    return result
+
+
+class NegativeSampler:
+    """
+    Pool thực thể theo loại từ GraphSnapshot + (tùy chọn) bảng láng giềng gần nhất từ vector đã lưu.
+    Mỗi shard dùng fork(seed) để có RNG riêng (pool và bảng láng giềng dùng chung, chỉ đọc).
+    """
+
+    def __init__(self, snapshot, hard=False, vector_dirs=VECTOR_DIRS, seed=None):
+        self.g = snapshot
+        self.rng = np.random.default_rng(seed)
+        self.pools, self.by_name = {}, {}
+        for label, _ in SLOTS.values():
+            names = snapshot.nodes[label]["name"]
+            self.pools[label] = np.array([i for i, name in enumerate(names) if name], dtype=np.int64)
+            by_name = {}
+            for i, name in enumerate(names):
+                by_name.setdefault(name, i)
+            self.by_name[label] = by_name
+        self.neighbors = self.load_neighbors(vector_dirs) if hard else {}
+
+    def fork(self, seed):
+        sampler = object.__new__(NegativeSampler)
+        sampler.__dict__.update(self.__dict__)
+        sampler.rng = np.random.default_rng(seed)
+        return sampler
+
+    def load_neighbors(self, vector_dirs):
+        """{nhãn: (mảng [số node, HARD_K] chỉ số snapshot, -1 nếu không có)} từ VECTOR_FIELD của artifact"""
+        print("🧲 Đang tính láng giềng gần nhất cho hard negative...")
+        rows = {}
+        for path in vector_dirs.values():
+            if not VectorArtifact.exists(path):
+                print(f"   ⚠️ Không tìm thấy vector {path}")
+                continue
+            artifact = VectorArtifact(path)
+            if VECTOR_FIELD not in artifact.fields:
+                continue
+            mask = artifact.mask(VECTOR_FIELD)
+            for row, (node_id, label) in enumerate(zip(artifact.ids, artifact.labels)):
+                i = self.g.index.get(label, {}).get(node_id)
+                if i is not None and mask[row]:
+                    rows.setdefault(label, ([], [], artifact))
+                    rows[label][0].append(i)
+                    rows[label][1].append(row)
+
+        neighbors = {}
+        for label, (nodes, artifact_rows, artifact) in rows.items():
+            vectors = np.asarray(artifact.matrix(VECTOR_FIELD)[np.array(artifact_rows)], dtype=np.float32)
+            top = top_k_neighbors(vectors, HARD_K)
+            table = np.full((len(self.g.nodes[label]["ID"]), top.shape[1]), -1, dtype=np.int64)
+            table[np.array(nodes)] = np.array(nodes)[top]
+            neighbors[label] = table
+            print(f"   ↳ {label}: {len(nodes)} node có vector")
+        return neighbors
+
+    def truth(self, label, d):
+        """Tập chỉ số thực thể loại label thật sự liên kết với bệnh d"""
+        g = self.g
+        if label == "Drug":
+            return set(g.inn("TREATS", "Drug", "Disease", d))
+        if label == "Symptom":
+            return set(g.out("HAS_SYMPTOM", "Disease", "Symptom", d))
+        groups = g.out("BELONGS_TO", "Disease", "Group", d)
+        if label == "Group":
+            return set(groups)
+        if label == "Chapter":
+            return {c for grp in groups for c in g.out("BELONGS_TO", "Group", "Chapter", grp)}
+        return set(g.inn("IS_A", "Disease", "Disease", d)) | {d}
+
+    def truth_names(self, label, d):
+        """
+        Tên các thực thể thật sự liên kết với bệnh d (không được dùng làm mẫu sai).
+        Loại trừ theo tên chứ không theo chỉ số: node khác trùng tên (vd 2 node "Aspirin") vẫn sinh ra câu đúng.
+        """
+        names = self.g.nodes[label]["name"]
+        return {names[i] for i in self.truth(label, d)}
+
+    def draw(self, label, requests):
+        """
+        requests: [(chỉ số thực thể gốc hoặc None, tập tên loại trừ)] cùng loại.
+        Rút ứng viên cho cả lô bằng numpy, mỗi yêu cầu lấy ứng viên hợp lệ đầu tiên (None nếu không có).
+        """
+        pool = self.pools[label]
+        if len(pool) == 0:
+            return [None] * len(requests)
+        names = self.g.nodes[label]["name"]
+        candidates = pool[self.rng.integers(0, len(pool), size=(len(requests), TRIES))]
+        table = self.neighbors.get(label)
+        if table is not None and table.shape[1] > 0:
+            # Hard negative: xáo thứ tự láng giềng của từng dòng, đặt trước các ứng viên ngẫu nhiên
+            originals = np.array([-1 if o is None else o for o, _ in requests])
+            hard = (originals >= 0) & (self.rng.random(len(requests)) < HARD_RATIO)
+            near = table[np.maximum(originals, 0)]
+            near = np.take_along_axis(near, self.rng.random(near.shape).argsort(axis=1), axis=1)
+            near[~hard] = -1
+            candidates = np.concatenate([near, candidates], axis=1)
+
+        picked = []
+        for (original, excluded), row in zip(requests, candidates.tolist()):
+            original_name = names[original] if original is not None else None
+            choice = None
+            for c in row:
+                if c >= 0 and names[c] not in excluded and names[c] != original_name:
+                    choice = c
+                    break
+            picked.append(choice)
+        return picked
+
+    def corrupt(self, records, hop_type, disease_id, limit):
+        """
+        Sinh tối đa limit record sai từ các record đúng của một bệnh.
+        Trả về [(record sai, slot bị thay)]; record chỉ giữ path bị làm hỏng.
+        """
+        d = self.g.index["Disease"].get(disease_id)
+        if d is None or limit <= 0:
+            return []
+        jobs = []
+        for record in records:
+            for path in PATHS[hop_type]:
+                if all(record.get(slot) for slot in path):
+                    jobs.append((record, path, path[self.rng.integers(len(path))]))
+        if not jobs:
+            return []
+        jobs = [jobs[i] for i in self.rng.permutation(len(jobs))[:limit]]
+
+        by_label = {}
+        for n, (record, _, slot) in enumerate(jobs):
+            label = SLOTS[slot][0]
+            by_label.setdefault(label, []).append(n)
+        choices = {}
+        for label, positions in by_label.items():
+            excluded = self.truth_names(label, d)
+            requests = [(self.by_name[label].get(jobs[n][0][jobs[n][2]]), excluded) for n in positions]
+            for n, choice in zip(positions, self.draw(label, requests)):
+                choices[n] = choice
+
+        negatives = []
+        for n, (record, path, slot) in enumerate(jobs):
+            if choices[n] is None:
+                continue
+            corrupted = {key: record.get(key) for key in KEEP_FIELDS[hop_type]}
+            for kept in path:
+                for field in SLOTS[kept][1]:
+                    corrupted[field] = record.get(field)
+            label, fields = SLOTS[slot]
+            for field, prop in fields.items():
+                corrupted[field] = self.g.prop(label, choices[n], prop)
+            negatives.append((corrupted, slot))
+        return negatives
@@ -0,0 +1,243 @@
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import sqlite3
+import unicodedata
+import numpy as np
+from sentence_store import SentenceWriter, list_parts, iter_lines
+
+# ================= CẤU HÌNH =================
+INPUT_DIR = "../../data/raw_sentences"
+OUTPUT_DIR = "../../data/dedup_sentences"
+STORE_KIND = "bloom"        # "bloom" (bộ nhớ cố định, có dương tính giả) | "sqlite" (chính xác, trên đĩa)
+CAPACITY = 50_000_000       # Số câu dự kiến tối đa cho Bloom filter
+FP_RATE = 0.001             # Tỉ lệ dương tính giả mong muốn (câu mới bị coi là trùng)
+SQLITE_CHUNK = 500          # Số hash mỗi câu lệnh IN (...)
+
+# ================= CHUẨN HÓA + BĂM =================
+# Câu được chuẩn hóa (Unicode NFC, chữ thường, gộp khoảng trắng, bỏ dấu câu ở cuối) rồi băm
+# blake2b 64 bit -> bộ nhớ tính theo số câu đã thấy (Bloom: vài bit/câu, SQLite: trên đĩa), không giữ text.
+
+
+def normalize(text):
+    text = unicodedata.normalize("NFC", str(text)).lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip(" .;,!?")
+
+
+def text_hash(text):
+    digest = hashlib.blake2b(normalize(text).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def batch_duplicates(hashes):
+    """Đánh dấu các lần xuất hiện lặp lại trong cùng một lô (giữ lần đầu)"""
+    repeated = np.ones(len(hashes), dtype=bool)
+    if len(hashes):
+        _, first = np.unique(hashes, return_index=True)
+        repeated[first] = False
+    return repeated
+
+
+class BloomFilter:
+    """
+    Bloom filter trên file (numpy memmap, <path>.bloom + <path>.bloom.json).
+    Số bit m và số hàm băm k tính từ CAPACITY + FP_RATE ở lần tạo đầu tiên, các lần sau dùng lại file.
+    """
+
+    def __init__(self, path, capacity=CAPACITY, fp_rate=FP_RATE):
+        self.path = path + ".bloom"
+        self.meta_path = self.path + ".json"
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                self.meta = json.load(f)
+        else:
+            bits = math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2)
+            self.meta = {"capacity": capacity, "fp_rate": fp_rate, "bits": bits,
+                         "hashes": max(1, round(bits / capacity * math.log(2))), "count": 0}
+        self.m = self.meta["bits"]
+        self.k = self.meta["hashes"]
+        mode = 'r+' if os.path.exists(self.path) else 'w+'
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.bits = np.memmap(self.path, dtype=np.uint8, mode=mode, shape=((self.m + 7) // 8,))
+
+    def positions(self, hashes):
+        """Double hashing: vị trí thứ i = h1 + i * h2 (mod m), h1/h2 là 2 nửa của hash 64 bit"""
+        h1 = hashes & np.uint64(0xFFFFFFFF)
+        h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+        steps = np.arange(self.k, dtype=np.uint64)
+        return (h1[:, None] + steps[None, :] * h2[:, None]) % np.uint64(self.m)
+
+    def _bits(self, hashes):
+        pos = self.positions(np.asarray(hashes, dtype=np.uint64))
+        return pos >> np.uint64(3), (pos & np.uint64(7)).astype(np.uint8)
+
+    def contains_many(self, hashes):
+        """Mảng bool: True nếu hash (có thể) đã có"""
+        byte, bit = self._bits(hashes)
+        return (((self.bits[byte] >> bit) & 1) == 1).all(axis=1)
+
+    def add_many(self, hashes):
+        """Thêm các hash, trả về mảng bool: True nếu hash (có thể) đã có trước đó"""
+        byte, bit = self._bits(hashes)
+        seen = (((self.bits[byte] >> bit) & 1) == 1).all(axis=1) | batch_duplicates(np.asarray(hashes, dtype=np.uint64))
+        new = ~seen
+        np.bitwise_or.at(self.bits, byte[new].ravel(), (np.uint8(1) << bit[new]).ravel())
+        self.meta["count"] += int(new.sum())
+        return seen
+
+    def flush(self):
+        self.bits.flush()
+        with open(self.meta_path, 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f)
+        if self.meta["count"] > self.meta["capacity"]:
+            print(f"⚠️ Bloom filter {self.path} vượt dung lượng ({self.meta['count']}/{self.meta['capacity']}), "
+                  f"tỉ lệ dương tính giả sẽ tăng")
+
+    def close(self):
+        self.flush()
+        del self.bits
+
+
+class SqliteHashSet:
+    """Tập hash chính xác trong SQLite (<path>.sqlite), bộ nhớ không phụ thuộc số câu"""
+
+    def __init__(self, path):
+        self.path = path + ".sqlite"
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # Mở ở luồng chính, dùng ở luồng worker (mỗi lúc chỉ một luồng dùng một tập) -> tắt kiểm tra cùng luồng
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS hashes (h INTEGER PRIMARY KEY) WITHOUT ROWID")
+
+    @staticmethod
+    def _signed(hashes):
+        # SQLite INTEGER là số có dấu 64 bit
+        return [h - (1 << 64) if h >= (1 << 63) else h for h in (int(h) for h in hashes)]
+
+    def _existing(self, signed):
+        existing = set()
+        for start in range(0, len(signed), SQLITE_CHUNK):
+            chunk = signed[start:start + SQLITE_CHUNK]
+            marks = ",".join("?" * len(chunk))
+            existing.update(r[0] for r in self.conn.execute(f"SELECT h FROM hashes WHERE h IN ({marks})", chunk))
+        return existing
+
+    def contains_many(self, hashes):
+        signed = self._signed(hashes)
+        existing = self._existing(signed)
+        return np.array([h in existing for h in signed], dtype=bool)
+
+    def add_many(self, hashes):
+        signed = self._signed(hashes)
+        existing = self._existing(signed)
+        seen = np.array([h in existing for h in signed], dtype=bool) | batch_duplicates(np.array(signed, dtype=np.int64))
+        self.conn.executemany("INSERT OR IGNORE INTO hashes (h) VALUES (?)", [(h,) for h, s in zip(signed, seen) if not s])
+        return seen
+
+    def flush(self):
+        self.conn.commit()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def open_store(path, kind=STORE_KIND, capacity=CAPACITY, fp_rate=FP_RATE):
+    if kind == "bloom":
+        return BloomFilter(path, capacity, fp_rate)
+    if kind == "sqlite":
+        return SqliteHashSet(path)
+    raise ValueError(f"Loại tập hash không hỗ trợ: {kind}")
+
+
+class SentenceDeduplicator:
+    """Lọc câu trùng (kể cả với các lần chạy trước) và đếm tỉ lệ trùng theo từng khóa (vd loại hop)"""
+
+    def __init__(self, store):
+        self.store = store
+        self.stats = {}     # {khóa: [số câu kiểm tra, số câu trùng]}
+
+    def select(self, texts, key, limit=None):
+        """
+        Chỉ số các câu chưa từng thấy (thứ tự giữ nguyên, tối đa limit câu).
+        Chỉ các câu được chọn mới được ghi vào tập hash -> câu bị cắt bởi limit vẫn dùng được ở lần sau.
+        """
+        if not texts:
+            return []
+        hashes = np.array([text_hash(t) for t in texts], dtype=np.uint64)
+        seen = self.store.contains_many(hashes) | batch_duplicates(hashes)
+        stat = self.stats.setdefault(key, [0, 0])
+        stat[0] += len(texts)
+        stat[1] += int(seen.sum())
+        kept = np.flatnonzero(~seen)[:limit].tolist()
+        self.store.add_many(hashes[kept])
+        return kept
+
+    def filter(self, texts, key, limit=None):
+        return [texts[i] for i in self.select(texts, key, limit)]
+
+    def close(self):
+        self.store.close()
+        return self.stats
+
+
+def merge_stats(all_stats):
+    merged = {}
+    for stats in all_stats:
+        for key, (checked, dup) in stats.items():
+            total = merged.setdefault(key, [0, 0])
+            total[0] += checked
+            total[1] += dup
+    return merged
+
+
+def saturated(stats, ratio):
+    """Các khóa có tỉ lệ câu bị lọc trùng vượt ratio (tập hash đã chứa gần hết câu ứng viên)"""
+    return sorted(key for key, (checked, dup) in stats.items() if checked and dup / checked > ratio)
+
+
+def print_report(stats):
+    print("🧹 Tỉ lệ câu trùng:")
+    for key in sorted(stats):
+        checked, dup = stats[key]
+        print(f"   - {key}: {dup}/{checked} câu trùng ({dup / max(checked, 1):.1%})")
+
+
+def dedup_parts(paths, output_dir, kind=STORE_KIND, batch=10000):
+    """
+    Lọc offline các part đã sinh (vd câu trùng giữa các shard, các part cũ chưa qua lọc):
+    giữ lần xuất hiện đầu tiên theo thứ tự part, ghi ra output_dir, khóa thống kê = hop (+ "sai" nếu label False).
+    Tập hash tạm tạo mới mỗi lần chạy trong output_dir/_hashes.
+    """
+    store_dir = os.path.join(output_dir, "_hashes")
+    shutil.rmtree(store_dir, ignore_errors=True)
+    dedup = SentenceDeduplicator(open_store(os.path.join(store_dir, "all"), kind))
+    with SentenceWriter(output_dir, "dedup", verbose=False) as writer:
+        for path in paths:
+            records = [json.loads(line) for line in iter_lines(path)]
+            for start in range(0, len(records), batch):
+                chunk = records[start:start + batch]
+                keys = [f"{r.get('hop')}{'' if r.get('label', True) else ' (sai)'}" for r in chunk]
+                seen = dedup.store.add_many([text_hash(r["text"]) for r in chunk])
+                for r, key, s in zip(chunk, keys, seen):
+                    stat = dedup.stats.setdefault(key, [0, 0])
+                    stat[0] += 1
+                    stat[1] += int(s)
+                    if not s:
+                        writer.write(r)
+    stats = dedup.close()
+    shutil.rmtree(store_dir, ignore_errors=True)
+    print(f"✅ Giữ {writer.rows} câu -> {len(writer.parts)} part tại {output_dir}")
+    print_report(stats)
+    return stats
+
+
+if __name__ == "__main__":
+    parts = list_parts(INPUT_DIR)
+    if not parts:
+        print(f"⚠️ Không có part nào trong {INPUT_DIR}")
+    else:
+        dedup_parts(parts, OUTPUT_DIR)
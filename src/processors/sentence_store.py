@@ -0,0 +1,232 @@
+import glob
+import json
+import math
+import os
+import random
+import shutil
+from tqdm import tqdm
+
+# ================= CẤU HÌNH =================
+INPUT_DIR = "../../data/raw_sentences"        # Các part do 5_generate_sentences.py ghi
+OUTPUT_DIR = "../../data/train_sentences"     # Shard đã xáo toàn cục, sẵn sàng cho huấn luyện
+OUTPUT_FORMAT = "jsonl"                       # "jsonl" | "parquet" (cần pyarrow)
+ROWS_PER_SHARD = 50000
+SEED = 42
+MAX_BUCKET_MB = 256         # Dung lượng tối đa một bucket nạp vào RAM ở lượt 2
+PARQUET_ROW_GROUP = 10000
+MANIFEST_FILE = "manifest.json"
+
+# ================= GHI CÂU (APPEND-ONLY) =================
+# Mỗi câu ghi thẳng ra file ngay khi sinh (1 dòng JSON hoặc 1 dòng trong row group Parquet),
+# tự sang part mới sau rows_per_part câu. Không dựng DataFrame, không xáo cục bộ:
+# xáo toàn cục là việc của external_shuffle bên dưới.
+
+EXTENSIONS = {"jsonl": ".jsonl", "parquet": ".parquet"}
+
+
+def parquet_schema():
+    """Schema cố định cho mọi part Parquet: không suy từ từng row group (câu đúng không có slot bị thay)"""
+    import pyarrow as pa
+    return pa.schema([
+        ("text", pa.string()),
+        ("hop", pa.string()),
+        ("source_id", pa.string()),
+        ("label", pa.bool_()),
+        ("corrupted", pa.string()),     # Slot bị thay ở câu sai, null ở câu đúng
+    ])
+
+
+class SentenceWriter:
+    """Ghi record {text, hop, source_id, label, corrupted} ra <prefix>_partXXX.jsonl|.parquet, dùng như context manager"""
+
+    def __init__(self, output_dir, prefix, fmt=OUTPUT_FORMAT, rows_per_part=ROWS_PER_SHARD, verbose=True,
+                 append=False):
+        if fmt not in EXTENSIONS:
+            raise ValueError(f"Định dạng không hỗ trợ: {fmt}")
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.fmt = fmt
+        self.rows_per_part = rows_per_part
+        self.verbose = verbose
+        self.parts = []             # [(tên file, số dòng)]
+        self.rows = 0               # Tổng số dòng đã ghi
+        self._file = None
+        self._parquet = None
+        self._buffer = []
+        self._part_rows = 0
+        os.makedirs(output_dir, exist_ok=True)
+        # append=True: đánh số tiếp sau các part đã có của prefix (không ghi đè dữ liệu các lần chạy trước)
+        # append=False: xóa các part cũ của prefix (lần chạy trước nhiều part hơn sẽ để lại part thừa)
+        self.start = len(list_parts(output_dir, f"{prefix}_part*")) if append else 0
+        if not append:
+            for stale in list_parts(output_dir, f"{prefix}_part*"):
+                os.remove(stale)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open_part(self):
+        filename = f"{self.prefix}_part{self.start + len(self.parts) + 1:03d}{EXTENSIONS[self.fmt]}"
+        path = os.path.join(self.output_dir, filename)
+        if self.fmt == "jsonl":
+            self._file = open(path, 'w', encoding='utf-8')
+        self.parts.append([filename, 0])
+        self._part_rows = 0
+
+    def _flush_parquet(self):
+        if not self._buffer:
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = parquet_schema()
+        table = pa.Table.from_pylist(self._buffer, schema=schema)
+        if self._parquet is None:
+            path = os.path.join(self.output_dir, self.parts[-1][0])
+            self._parquet = pq.ParquetWriter(path, schema)
+        self._parquet.write_table(table)
+        self._buffer = []
+
+    def _close_part(self):
+        if self.fmt == "jsonl":
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        else:
+            self._flush_parquet()
+            if self._parquet is not None:
+                self._parquet.close()
+                self._parquet = None
+        if self.parts:
+            self.parts[-1][1] = self._part_rows
+            if self.verbose:
+                print(f"💾 Đã lưu {self._part_rows} câu vào: {self.parts[-1][0]}")
+
+    def _next_row(self):
+        if not self.parts or self._part_rows >= self.rows_per_part:
+            self._close_part()
+            self._open_part()
+        self._part_rows += 1
+        self.rows += 1
+
+    def write(self, record):
+        self._next_row()
+        if self.fmt == "jsonl":
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        else:
+            self._buffer.append(record)
+            if len(self._buffer) >= PARQUET_ROW_GROUP:
+                self._flush_parquet()
+
+    def write_line(self, line):
+        """Ghi nguyên dòng JSON đã serialize (tránh parse lại khi xáo JSONL -> JSONL)"""
+        if self.fmt != "jsonl":
+            self.write(json.loads(line))
+            return
+        self._next_row()
+        self._file.write(line if line.endswith("\n") else line + "\n")
+
+    def close(self):
+        """Đóng part đang ghi, trả về số part đã tạo"""
+        if self._file is not None or self._parquet is not None or self._buffer:
+            self._close_part()
+        return len(self.parts)
+
+
+def list_parts(input_dir, pattern="*"):
+    """Các part JSONL/Parquet trong thư mục (sắp theo tên -> thứ tự xác định)"""
+    paths = []
+    for ext in EXTENSIONS.values():
+        paths.extend(glob.glob(os.path.join(input_dir, pattern + ext)))
+    return sorted(paths)
+
+
+def iter_lines(path):
+    """Từng dòng JSON của một part (Parquet được đọc theo batch rồi serialize lại)"""
+    if path.endswith(EXTENSIONS["parquet"]):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches():
+            for record in batch.to_pylist():
+                yield json.dumps(record, ensure_ascii=False) + "\n"
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield line if line.endswith("\n") else line + "\n"
+
+
+# ================= XÁO TOÀN CỤC NGOÀI BỘ NHỚ =================
+# Lượt 1: đọc tuần tự mọi part, gửi mỗi dòng vào một bucket ngẫu nhiên (file tạm trên đĩa).
+# Lượt 2: lần lượt nạp từng bucket (<= MAX_BUCKET_MB), xáo trong RAM rồi ghi nối vào shard đầu ra.
+# Gán bucket ngẫu nhiên độc lập + hoán vị đều trong bucket = hoán vị đều trên toàn bộ dữ liệu,
+# với bộ nhớ chỉ cỡ một bucket dù có bao nhiêu part. Cùng seed + cùng đầu vào -> cùng đầu ra.
+
+def estimate_buckets(paths, max_bucket_bytes):
+    total = 0
+    for path in paths:
+        size = os.path.getsize(path)
+        # Parquet nén: dạng JSON trong RAM lớn hơn nhiều so với trên đĩa
+        total += size * 4 if path.endswith(EXTENSIONS["parquet"]) else size
+    return max(1, math.ceil(total / max_bucket_bytes))
+
+
+def external_shuffle(paths, output_dir, seed=SEED, rows_per_shard=ROWS_PER_SHARD, fmt=OUTPUT_FORMAT,
+                     max_bucket_mb=MAX_BUCKET_MB, prefix="train"):
+    """Xáo toàn cục các part, ghi <prefix>_partXXX + manifest.json vào output_dir. Trả về manifest."""
+    rng = random.Random(seed)
+    num_buckets = estimate_buckets(paths, max_bucket_mb * 1024 * 1024)
+    tmp_dir = os.path.join(output_dir, "_buckets")
+    os.makedirs(tmp_dir, exist_ok=True)
+    print(f"🔀 Xáo {len(paths)} part qua {num_buckets} bucket (seed {seed})...")
+
+    hops, labels = {}, {}
+    try:
+        # Lượt 1: phân tán vào bucket
+        buckets = [open(os.path.join(tmp_dir, f"bucket_{i:05d}.jsonl"), 'w', encoding='utf-8')
+                   for i in range(num_buckets)]
+        total = 0
+        try:
+            for path in tqdm(paths, desc="Phân bucket"):
+                for line in iter_lines(path):
+                    buckets[rng.randrange(num_buckets)].write(line)
+                    total += 1
+        finally:
+            for f in buckets:
+                f.close()
+
+        # Lượt 2: xáo từng bucket trong RAM và ghi shard
+        with SentenceWriter(output_dir, prefix, fmt, rows_per_shard, verbose=False) as writer:
+            for i in tqdm(range(num_buckets), desc="Xáo bucket"):
+                bucket_path = os.path.join(tmp_dir, f"bucket_{i:05d}.jsonl")
+                with open(bucket_path, 'r', encoding='utf-8') as f:
+                    lines = f.readlines()
+                os.remove(bucket_path)
+                rng.shuffle(lines)
+                for line in lines:
+                    record = json.loads(line)
+                    hops[record.get("hop")] = hops.get(record.get("hop"), 0) + 1
+                    key = str(record.get("label"))
+                    labels[key] = labels.get(key, 0) + 1
+                    writer.write_line(line)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    manifest = {"seed": seed, "format": fmt, "total": total, "buckets": num_buckets,
+                "inputs": [os.path.basename(p) for p in paths],
+                "shards": [{"file": name, "rows": rows} for name, rows in writer.parts],
+                "hops": hops, "labels": labels}
+    with open(os.path.join(output_dir, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    print(f"✅ Đã xáo {total} câu -> {len(writer.parts)} shard tại {output_dir}")
+    print(f"   - Theo hop: {hops}")
+    return manifest
+
+
+if __name__ == "__main__":
+    parts = list_parts(INPUT_DIR)
+    if not parts:
+        print(f"⚠️ Không có part nào trong {INPUT_DIR}")
+    else:
+        external_shuffle(parts, OUTPUT_DIR)
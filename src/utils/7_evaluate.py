@@ -1,10 +1,20 @@
+import copy
+import os
+import sys
 import torch
 import pandas as pd
 import torch.nn.functional as F
 from tqdm import tqdm
 from transformers import AutoTokenizer, AutoModelForCausalLM
+try:
+    from transformers import DynamicCache
+except ImportError:  # transformers < 4.36
+    DynamicCache = None
 from peft import PeftModel
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ml"))
+from finetune_slm import build_messages
+
 # ================= CẤU HÌNH =================
 # Đường dẫn folder chứa Adapter (kết quả sau khi train xong)
 ADAPTER_PATH = "../../models/qwen3_slm_batch6/checkpoint-3800" 
@@ -14,6 +24,13 @@ BASE_MODEL_PATH = "../../models/qwen3-0.6b/models--Qwen--Qwen3-0.6B"
 INPUT_FILE = "../../data/data_test_normalize.csv"
 OUTPUT_FILE = "../../data/Result_Vector_Injection.xlsx"
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+# Số câu mỗi forward pass (câu được sắp theo độ dài token + pad trái -> ít padding thừa)
+BATCH_SIZE = 32
+# "raw": prompt thô "Ngữ cảnh/Mệnh đề/Câu trả lời:" như trước.
+# "chat": đúng chat template lúc train (build_messages + apply_chat_template của finetune_slm.py);
+# system turn cố định được tính KV cache MỘT lần khi nạp model, mỗi câu chỉ chạy phần user turn.
+PROMPT_MODE = "raw"
+PREFIX_SENTINEL = "<<NGU_CANH>>"    # Giá trị giả để tìm ranh giới system turn / user turn trong template
 
 # ================= CORE LOGIC =================
 class VectorInference:
@@ -53,67 +70,180 @@ class VectorInference:
         
         print(f"ℹ️ Token Map: 'Đúng' -> ID {self.true_token_id} | 'Sai' -> ID {self.false_token_id}")
 
+        # 5. KV cache cho phần prefix cố định của chat template (chỉ ở chế độ "chat")
+        self.prefix_text = None
+        self.prefix_cache = None
+        if PROMPT_MODE == "chat":
+            self.init_prefix_cache()
+
     def get_single_token_id(self, word):
         """Hàm helper để lấy ID của 1 từ đơn"""
         ids = self.tokenizer.encode(word, add_special_tokens=False)
         return ids[-1] if ids else -1
 
-    def predict_from_vector(self, context, statement):
-        """
-        Quy trình Vector Injection:
-        Text -> Token IDs -> Embeddings Layer (Base Model) -> Vectors -> Transformer Layers -> Logits
-        """
-        
-        # Format Prompt: PHẢI GIỐNG HỆT LÚC TRAIN để đạt hiệu quả cao nhất
+    def build_prompt(self, context, statement):
+        """Format Prompt: PHẢI GIỐNG HỆT LÚC TRAIN để đạt hiệu quả cao nhất"""
         display_context = context if pd.notna(context) and str(context).strip() else statement
         display_statement = statement if pd.notna(statement) and str(statement).strip() else display_context
         
-        prompt_text = (
+        return (
             f"Ngữ cảnh: {display_context}\n"
             f"Mệnh đề: {display_statement}\n"
             "Hãy phân loại mệnh đề trên là 'Đúng' hoặc 'Sai'. "
             "Chỉ trả lời đúng một từ: Đúng hoặc Sai.\n"
             "Câu trả lời:" # Thêm gợi ý để model điền tiếp
         )
-        
-        # B1: Tokenize
-        inputs = self.tokenizer(prompt_text, return_tensors="pt").to(self.model.device)
-        input_ids = inputs.input_ids
-        
-        # B2: VECTOR EMBEDDING (Đây là bước bạn yêu cầu)
-        # Lấy lớp Embedding đầu tiên của model gốc
-        # Qwen/Llama thường có thuộc tính .model.embed_tokens hoặc .get_input_embeddings()
+
+    # ================= CHAT TEMPLATE + PREFIX KV CACHE =================
+
+    def chat_prompt(self, context, statement):
+        """Prompt giống hệt tokenize_example lúc train: messages[:-1] + add_generation_prompt"""
+        context = "" if pd.isna(context) else str(context)
+        statement = "" if pd.isna(statement) else str(statement)
+        messages = build_messages(context, statement, "")
+        return self.tokenizer.apply_chat_template(messages[:-1], tokenize=False, add_generation_prompt=True)
+
+    def init_prefix_cache(self):
+        """
+        Tách prompt tại đầu nội dung user turn (dùng PREFIX_SENTINEL): phần trước (system turn + mở đầu user turn)
+        giống nhau cho mọi câu -> forward một lần, giữ past_key_values để dùng lại cho mọi batch.
+        """
+        messages = build_messages(PREFIX_SENTINEL, PREFIX_SENTINEL, "")
+        template = self.chat_prompt(PREFIX_SENTINEL, PREFIX_SENTINEL)
+        prefix_text = template[:template.index(messages[1]["content"])]
+        prefix_ids = self.tokenizer(prefix_text)["input_ids"]
+        suffix_ids = self.tokenizer(template[len(prefix_text):], add_special_tokens=False)["input_ids"]
+        if prefix_ids + suffix_ids != self.tokenizer(template)["input_ids"]:
+            # Token hóa tách rời khác token hóa cả câu -> không cache được mà vẫn giữ đúng template
+            print("⚠️ Ranh giới prefix không trùng ranh giới token, chạy chat template không dùng cache")
+            return
+
         with torch.no_grad():
-            # Biến đổi Token IDs (số nguyên) thành Vectors (số thực float16)
-            # input_vectors shape: [1, seq_len, hidden_size]
-            input_vectors = self.model.get_input_embeddings()(input_ids)
-        
-        # B3: FORWARD PASS BẰNG VECTOR
+            input_ids = torch.tensor([prefix_ids], device=self.model.device)
+            outputs = self.model(inputs_embeds=self.model.get_input_embeddings()(input_ids), use_cache=True)
+        cache = outputs.past_key_values
+        if isinstance(cache, tuple) and hasattr(DynamicCache, "from_legacy_cache"):
+            # Một số bản transformers trả cache dạng tuple (legacy) khi không truyền Cache vào
+            cache = DynamicCache.from_legacy_cache(cache)
+        if not hasattr(cache, "batch_repeat_interleave"):
+            print("⚠️ transformers chưa có DynamicCache.batch_repeat_interleave (cần >= 4.42), "
+                  "chạy chat template không dùng cache")
+            return
+        self.prefix_text = prefix_text
+        self.prefix_len = len(prefix_ids)
+        self.prefix_cache = cache
+        print(f"⚡ Đã cache {self.prefix_len} token prefix của chat template")
+
+    def encode(self, context, statement):
+        """Token IDs của phần cần chạy cho một câu (chỉ phần sau prefix nếu có cache)"""
+        if PROMPT_MODE != "chat":
+            return self.tokenizer(self.build_prompt(context, statement))["input_ids"]
+        prompt = self.chat_prompt(context, statement)
+        if self.prefix_cache is None:
+            return self.tokenizer(prompt)["input_ids"]
+        return self.tokenizer(prompt[len(self.prefix_text):], add_special_tokens=False)["input_ids"]
+
+    def forward_with_prefix(self, encoded):
+        """
+        Forward phần user turn của cả batch trên prefix đã cache: cache được nhân bản theo batch,
+        pad PHẢI phần user turn (prefix chung nằm liền trước mọi dòng), attention_mask = [1 x prefix | mask],
+        position_ids bắt đầu từ độ dài prefix.
+        """
+        padding_side = self.tokenizer.padding_side
+        self.tokenizer.padding_side = "right"
+        try:
+            batch = self.tokenizer.pad({"input_ids": encoded}, padding=True, return_tensors="pt")
+        finally:
+            self.tokenizer.padding_side = padding_side
+        input_ids = batch["input_ids"].to(self.model.device)
+        suffix_mask = batch["attention_mask"].to(self.model.device)
+        rows = len(encoded)
+
+        cache = copy.deepcopy(self.prefix_cache)
+        cache.batch_repeat_interleave(rows)
+        prefix_mask = torch.ones(rows, self.prefix_len, dtype=suffix_mask.dtype, device=suffix_mask.device)
+        attention_mask = torch.cat([prefix_mask, suffix_mask], dim=1)
+        position_ids = self.prefix_len + (suffix_mask.long().cumsum(-1) - 1).clamp(min=0)
+
         with torch.no_grad():
-            # Thay vì truyền input_ids, ta truyền inputs_embeds
             outputs = self.model(
-                inputs_embeds=input_vectors,
-                # Vẫn cần attention_mask để model biết đâu là padding
-                attention_mask=inputs.attention_mask 
+                inputs_embeds=self.model.get_input_embeddings()(input_ids),
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=cache,
+                use_cache=True
             )
+            last = suffix_mask.long().sum(-1) - 1
+            next_token_logits = outputs.logits[torch.arange(rows, device=last.device), last]
+            return self.label_probs(next_token_logits)
+
+    def label_probs(self, next_token_logits):
+        """So sánh điểm số (Logits) giữa token "Đúng" và "Sai", softmax cục bộ giữa 2 token này"""
+        scores = next_token_logits[:, [self.true_token_id, self.false_token_id]].float()
+        return F.softmax(scores, dim=-1).cpu()
+
+    def predict_from_vector(self, context, statement):
+        """
+        Quy trình Vector Injection:
+        Text -> Token IDs -> Embeddings Layer (Base Model) -> Vectors -> Transformer Layers -> Logits
+        """
+        return self.predict_batch([context], [statement])[0]
+
+    def forward_batch(self, encoded):
+        """
+        Một forward pass cho danh sách câu đã tokenize (list input_ids).
+        Pad TRÁI -> token cuối của mọi dòng nằm cùng cột; position_ids tính từ attention_mask
+        nên mỗi dòng vẫn bắt đầu từ vị trí 0 như khi chạy từng câu.
+        """
+        if self.prefix_cache is not None:
+            return self.forward_with_prefix(encoded)
+        padding_side = self.tokenizer.padding_side
+        self.tokenizer.padding_side = "left"
+        try:
+            batch = self.tokenizer.pad({"input_ids": encoded}, padding=True, return_tensors="pt")
+        finally:
+            self.tokenizer.padding_side = padding_side
+        input_ids = batch["input_ids"].to(self.model.device)
+        attention_mask = batch["attention_mask"].to(self.model.device)
+        position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+
+        with torch.no_grad():
+            # B2: VECTOR EMBEDDING - Token IDs (số nguyên) -> Vectors [batch, seq_len, hidden_size]
+            input_vectors = self.model.get_input_embeddings()(input_ids)
             
-            # Lấy Logits của token cuối cùng (token dự đoán tiếp theo)
-            next_token_logits = outputs.logits[0, -1, :]
-            
-            # So sánh điểm số (Logits) giữa token "Đúng" và "Sai"
-            score_true = next_token_logits[self.true_token_id].item()
-            score_false = next_token_logits[self.false_token_id].item()
+            # B3: FORWARD PASS BẰNG VECTOR (attention_mask để model bỏ qua padding)
+            outputs = self.model(
+                inputs_embeds=input_vectors,
+                attention_mask=attention_mask,
+                position_ids=position_ids
+            )
             
-            # Chuyển sang xác suất (Softmax cục bộ giữa 2 token này)
-            probs = F.softmax(torch.tensor([score_true, score_false], dtype=torch.float32), dim=0)
-            prob_true = probs[0].item()
-            prob_false = probs[1].item()
-
-        # Kết luận
-        if prob_true > prob_false:
-            return "Đúng", prob_true
-        else:
-            return "Sai", prob_false
+            # Logits của token thật cuối cùng mỗi dòng (vị trí số 1 cuối cùng trong attention_mask)
+            last = attention_mask.shape[1] - 1 - attention_mask.flip(-1).argmax(-1)
+            next_token_logits = outputs.logits[torch.arange(len(encoded), device=last.device), last]
+            return self.label_probs(next_token_logits)
+
+    def predict_batch(self, contexts, statements, batch_size=BATCH_SIZE, progress=False):
+        """
+        Dự đoán cho nhiều câu: tokenize hết, sắp theo độ dài, chạy từng batch rồi trả kết quả
+        [(nhãn, độ tin cậy)] theo ĐÚNG thứ tự đầu vào.
+        """
+        # B1: Tokenize
+        encoded = [self.encode(c, s) for c, s in zip(contexts, statements)]
+        order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]))
+        results = [None] * len(encoded)
+
+        starts = range(0, len(order), batch_size)
+        for start in (tqdm(starts, total=len(starts)) if progress else starts):
+            rows = order[start:start + batch_size]
+            probs = self.forward_batch([encoded[i] for i in rows])
+            for i, (prob_true, prob_false) in zip(rows, probs.tolist()):
+                # Kết luận
+                if prob_true > prob_false:
+                    results[i] = ("Đúng", prob_true)
+                else:
+                    results[i] = ("Sai", prob_false)
+        return results
 
 # ================= MAIN =================
 def run():
@@ -139,17 +269,15 @@ def run():
     col_stmt = next((c for c in df.columns if "statement" in c.lower() or "mệnh đề" in c.lower()), "statement")
     col_ctx = next((c for c in df.columns if "context" in c.lower() or "ngữ cảnh" in c.lower()), "context")
     
-    results = []
-    print(f"▶️ Bắt đầu chạy Inference trên {len(df)} dòng...")
+    statements = df[col_stmt].tolist() if col_stmt in df.columns else [""] * len(df)
+    contexts = df[col_ctx].tolist() if col_ctx in df.columns else [""] * len(df)
+    print(f"▶️ Bắt đầu chạy Inference trên {len(df)} dòng (batch {BATCH_SIZE})...")
     
-    # Dùng tqdm để hiện thanh tiến trình
-    for idx, row in tqdm(df.iterrows(), total=len(df)):
-        stmt = row.get(col_stmt, "")
-        ctx = row.get(col_ctx, "")
-        
-        # Gọi hàm xử lý vector
-        decision, confidence = engine.predict_from_vector(ctx, stmt)
-        
+    # Gọi hàm xử lý vector theo batch (tqdm hiện tiến trình theo batch)
+    predictions = engine.predict_batch(contexts, statements, progress=True)
+    
+    results = []
+    for ctx, stmt, (decision, confidence) in zip(contexts, statements, predictions):
         results.append({
             "Context": ctx,
             "Statement": stmt,
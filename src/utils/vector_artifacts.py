@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+# ================= ĐỊNH DẠNG FILE VECTOR =================
+# Mỗi bộ dữ liệu (icd10 / drugs / symptoms) là một thư mục:
+#   meta.json           -> model, số chiều, dtype, pooling, chuẩn hóa, danh sách trường, số dòng
+#   ids.json            -> {"ids": [...], "labels": [...]} theo đúng thứ tự dòng của ma trận
+#   <field>.npy         -> ma trận [count, dim] (float32 hoặc float16), đọc bằng memmap
+#   <field>.mask.npy    -> bool [count], False nếu node không có vector cho trường đó (text rỗng)
+#   changed_ids.json    -> {"changed": [[label, id], ...], "removed": [...]} so với lần embedding trước
+#                          (chỉ để báo cáo; 4_import_vector.py so vector_hash lưu trên node, xem VectorArtifact.vector_hash)
+# Dùng chung cho bước embedding (src/ml/3_embeding.py) và import (src/importers/4_import_vector.py).
+
+META_FILE = "meta.json"
+IDS_FILE = "ids.json"
+CHANGED_FILE = "changed_ids.json"
+
+
+class VectorArtifactWriter:
+    """
+    Cấp phát sẵn ma trận memmap cho từng trường rồi ghi vector theo chỉ số dòng.
+    resume=True: mở lại ma trận + mask đã flush của lần ghi bị dừng giữa chừng (cùng ids/trường/dim).
+    """
+
+    def __init__(self, path, ids, labels, fields, dim, dtype="float32", meta=None, hashes=None, resume=False):
+        self.path = path
+        self.fields = list(fields)
+        self.count = len(ids)
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        os.makedirs(path, exist_ok=True)
+
+        with open(os.path.join(path, IDS_FILE), 'w', encoding='utf-8') as f:
+            index = {"ids": list(ids), "labels": list(labels)}
+            if hashes is not None:
+                index["hashes"] = list(hashes)  # Hash text của từng dòng, dùng cho chế độ incremental
+            json.dump(index, f, ensure_ascii=False)
+
+        self.meta = dict(meta or {})
+        self.meta.update({"dim": dim, "dtype": self.dtype.name, "fields": self.fields, "count": self.count})
+
+        self.matrices = {}
+        self.masks = {}
+        for field in self.fields:
+            matrix_path = os.path.join(path, f"{field}.npy")
+            mask_path = os.path.join(path, f"{field}.mask.npy")
+            if resume:
+                self.matrices[field] = np.lib.format.open_memmap(matrix_path, mode='r+')
+                self.masks[field] = np.load(mask_path)
+                continue
+            self.matrices[field] = np.lib.format.open_memmap(
+                matrix_path, mode='w+', dtype=self.dtype, shape=(self.count, dim)
+            )
+            self.masks[field] = np.zeros(self.count, dtype=bool)
+
+    def write(self, field, row, vector):
+        if vector is None or len(vector) == 0:
+            return
+        self.matrices[field][row] = np.asarray(vector, dtype=np.float32)
+        self.masks[field][row] = True
+
+    def copy_from(self, artifact, src_row, row):
+        """Chép nguyên vector (kể cả mask) của một dòng từ artifact cũ sang"""
+        for field in self.fields:
+            if field in artifact.fields and artifact.mask(field)[src_row]:
+                self.matrices[field][row] = artifact.matrix(field)[src_row]
+                self.masks[field][row] = True
+
+    def write_changed(self, changed, removed):
+        with open(os.path.join(self.path, CHANGED_FILE), 'w', encoding='utf-8') as f:
+            json.dump({"changed": [list(k) for k in changed], "removed": [list(k) for k in removed]},
+                      f, ensure_ascii=False)
+
+    def flush(self):
+        for field in self.fields:
+            self.matrices[field].flush()
+            np.save(os.path.join(self.path, f"{field}.mask.npy"), self.masks[field])
+
+    def close(self):
+        self.flush()
+        with open(os.path.join(self.path, META_FILE), 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f, ensure_ascii=False, indent=2)
+        self.matrices = {}
+
+
+class VectorArtifact:
+    """Đọc thư mục vector (memmap, không nạp cả ma trận vào RAM)"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(path, IDS_FILE), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        self.ids = index["ids"]
+        self.labels = index["labels"]
+        self.hashes = index.get("hashes")
+        self.fields = self.meta["fields"]
+        self.dim = self.meta["dim"]
+        self._matrices = {}
+        self._masks = {}
+        self._rows = None
+        self._config_key = None
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, META_FILE))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def matrix(self, field):
+        if field not in self._matrices:
+            self._matrices[field] = np.load(os.path.join(self.path, f"{field}.npy"), mmap_mode='r')
+        return self._matrices[field]
+
+    def mask(self, field):
+        if field not in self._masks:
+            self._masks[field] = np.load(os.path.join(self.path, f"{field}.mask.npy"))
+        return self._masks[field]
+
+    def close(self):
+        """Bỏ tham chiếu tới các memmap để file được đóng (cần trước khi xóa/thay thư mục, nhất là trên Windows)"""
+        self._matrices = {}
+        self._masks = {}
+
+    def row_of(self, label, node_id):
+        """Chỉ số dòng của node theo (nhãn, ID), None nếu không có"""
+        if self._rows is None:
+            self._rows = {(lb, i): row for row, (lb, i) in enumerate(zip(self.labels, self.ids))}
+        return self._rows.get((label, node_id))
+
+    def vector_hash(self, row):
+        """
+        Dấu vân tay vector của một dòng = hash text của dòng + cấu hình embedding (model, backend, dim, ...).
+        Lưu trên node khi import: đổi text hoặc đổi model đều đổi hash. None nếu artifact không có hash.
+        """
+        if self.hashes is None:
+            return None
+        if self._config_key is None:
+            config = {k: v for k, v in self.meta.items() if k != "count"}
+            self._config_key = json.dumps(config, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha1((self._config_key + self.hashes[row]).encode('utf-8')).hexdigest()
+
+    def vector(self, field, row):
+        """Vector dạng list float ([] nếu node không có vector cho trường này)"""
+        if field not in self.fields or not self.mask(field)[row]:
+            return []
+        return self.matrix(field)[row].astype(np.float32).tolist()
+
+    def iter_batches(self, fields, batch_size, labels=None, rows=None):
+        """Duyệt theo batch: mỗi phần tử là {"id", "label", "vector_hash", <field>: list float} (rows: chỉ lấy các dòng này)"""
+        batch = []
+        for row, (node_id, label) in enumerate(zip(self.ids, self.labels)):
+            if labels is not None and label not in labels:
+                continue
+            if rows is not None and row not in rows:
+                continue
+            item = {"id": node_id, "label": label, "vector_hash": self.vector_hash(row)}
+            for field in fields:
+                item[field] = self.vector(field, row)
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
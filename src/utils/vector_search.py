@@ -0,0 +1,148 @@
+import os
+import sys
+from neo4j import GraphDatabase
+
+# ================= CẤU HÌNH =================
+URI = "neo4j://127.0.0.1:7687"
+AUTH = ("neo4j", "neo4j123")
+MODEL_PATH = "../../models/vietnamese-embedding"  # Cùng model với 3_embeding.py
+BACKEND = "torch"
+SIMILARITY = "cosine"
+TOP_K = 10
+NEIGHBOR_LIMIT = 20  # Số node láng giềng tối đa khi mở rộng 1 bước
+
+# Các trường vector theo nhãn (giống 4_import_vector.py)
+VECTOR_PROPERTIES = {
+    "Chapter": ["name_vector", "desc_vector"],
+    "Group": ["name_vector", "desc_vector", "code_vector"],
+    "Disease": ["name_vector", "desc_vector"],
+    "Drug": ["name_vector", "desc_vector"],
+    "Symptom": ["name_vector", "desc_vector"]
+}
+
+# ================= VECTOR INDEX (Neo4j 5.13+) =================
+# Mỗi cặp (nhãn, trường) một vector index, ví dụ disease_name_vector.
+# Node có vector rỗng [] (text rỗng) không được index nên không xuất hiện trong kết quả.
+
+
+def index_name(label, prop):
+    return f"{label.lower()}_{prop}"
+
+
+def create_vector_indexes(driver, dim, labels=None, similarity=SIMILARITY):
+    """Tạo vector index cho mọi (nhãn, trường) rồi chờ index ONLINE"""
+    with driver.session() as session:
+        for label, props in VECTOR_PROPERTIES.items():
+            if labels is not None and label not in labels:
+                continue
+            for prop in props:
+                session.run(f"""
+                CREATE VECTOR INDEX {index_name(label, prop)} IF NOT EXISTS
+                FOR (n:{label}) ON (n.{prop})
+                OPTIONS {{indexConfig: {{
+                    `vector.dimensions`: {int(dim)},
+                    `vector.similarity_function`: '{similarity}'
+                }}}}
+                """)
+        session.run("CALL db.awaitIndexes(300)")
+    print(f"✅ Đã tạo vector index ({dim} chiều, {similarity}).")
+
+
+def native_vector_query(label, fields):
+    """
+    UNWIND $batch + MATCH theo nhãn, ghi vector bằng db.create.setNodeVectorProperty
+    (kiểm tra kiểu + lưu dạng float đúng cho vector index). Vector rỗng vẫn ghi [] như cũ.
+    Ghi kèm vector_hash để lần import sau bỏ qua node đã có đúng vector.
+    """
+    calls = "\n".join(f"""CALL {{
+    WITH n, row
+    WITH n, row WHERE size(row.{field}) > 0
+    CALL db.create.setNodeVectorProperty(n, '{field}', row.{field})
+}}
+CALL {{
+    WITH n, row
+    WITH n, row WHERE size(row.{field}) = 0
+    SET n.{field} = []
+}}""" for field in fields)
+    return f"""
+UNWIND $batch AS row
+MATCH (n:{label} {{ID: row.id}})
+{calls}
+SET n.vector_hash = row.vector_hash
+"""
+
+
+# ================= API TÌM KIẾM kNN =================
+
+class TextEmbedder:
+    """Embedding câu truy vấn bằng đúng model/pooling đã dùng để tạo vector của graph"""
+
+    def __init__(self, model_path=MODEL_PATH, backend=BACKEND):
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ml"))
+        from transformers import AutoTokenizer
+        from embedding_backends import load_backend, encode_texts
+
+        self._encode_texts = encode_texts
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+        self.backend = load_backend(backend, model_path)
+
+    def __call__(self, text):
+        return self._encode_texts(self.backend, self.tokenizer, [text.strip()[:5000]])[0].tolist()
+
+
+class GraphVectorSearch:
+    """
+    Tìm top-k node gần nhất theo từng nhãn ngay trên server (db.index.vector.queryNodes),
+    không cần kéo vector về client. Có thể lọc nhãn và mở rộng láng giềng 1 bước.
+    """
+
+    def __init__(self, uri=URI, auth=AUTH, embedder=None):
+        self.driver = GraphDatabase.driver(uri, auth=auth)
+        self.embedder = embedder
+
+    def close(self):
+        self.driver.close()
+
+    def to_vector(self, query):
+        if isinstance(query, str):
+            if self.embedder is None:
+                self.embedder = TextEmbedder()
+            return self.embedder(query)
+        return [float(x) for x in query]
+
+    def search(self, query, k=TOP_K, labels=None, prop="name_vector", expand=False, min_score=None):
+        """
+        query: câu text hoặc vector. Trả về {nhãn: [{id, name, score, neighbors?}, ...]} (mỗi nhãn top-k).
+        labels: chỉ tìm trong các nhãn này; expand=True: kèm danh sách láng giềng trực tiếp.
+        """
+        vector = self.to_vector(query)
+        neighbors = """,
+               [(node)-[r]-(nb) | {rel: type(r), direction: CASE WHEN startNode(r) = node THEN 'out' ELSE 'in' END,
+                                   label: labels(nb)[0], id: nb.ID, name: nb.name}][..$neighbor_limit] AS neighbors"""
+        cypher = f"""
+        CALL db.index.vector.queryNodes($index, $k, $vector) YIELD node, score
+        WITH node, score WHERE $min_score IS NULL OR score >= $min_score
+        RETURN node.ID AS id, node.name AS name, score{neighbors if expand else ""}
+        ORDER BY score DESC
+        """
+        results = {}
+        with self.driver.session() as session:
+            for label, props in VECTOR_PROPERTIES.items():
+                if (labels is not None and label not in labels) or prop not in props:
+                    continue
+                records = session.run(cypher, index=index_name(label, prop), k=k, vector=vector,
+                                      min_score=min_score, neighbor_limit=NEIGHBOR_LIMIT)
+                results[label] = records.data()
+        return results
+
+
+if __name__ == "__main__":
+    searcher = GraphVectorSearch(URI, AUTH)
+    try:
+        query = " ".join(sys.argv[1:]) or "sốt cao kèm phát ban"
+        for label, hits in searcher.search(query, k=5, expand=True).items():
+            print(f"\n🔎 {label}:")
+            for hit in hits:
+                print(f"   - [{hit['score']:.4f}] {hit['id']} | {hit['name']} ({len(hit['neighbors'])} láng giềng)")
+    finally:
+        searcher.close()
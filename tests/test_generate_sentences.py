@@ -0,0 +1,69 @@
+import importlib.util
+import os
+import sys
+
+PROCESSORS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "processors")
+sys.path.append(PROCESSORS_DIR)
+
+# 5_generate_sentences.py bắt đầu bằng số nên không import trực tiếp được
+spec = importlib.util.spec_from_file_location("generate_sentences", os.path.join(PROCESSORS_DIR, "5_generate_sentences.py"))
+generator = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(generator)
+
+
+def test_split_quota_is_proportional_and_exact():
+    assert generator.split_quota(10, [1, 1, 1]) == [4, 3, 3]        # Hòa phần dư -> shard nhỏ hơn trước
+    assert generator.split_quota(100, [3, 0, 1]) == [75, 0, 25]
+    assert generator.split_quota(7, [0, 0]) == [0, 0]
+    for total in (0, 1, 13, 31500):
+        weights = [5, 0, 17, 3, 9, 1, 0, 2]
+        shares = generator.split_quota(total, weights)
+        assert sum(shares) == total
+        assert all(share == 0 for share, w in zip(shares, weights) if w == 0)
+        # Sai lệch so với tỉ lệ chính xác không quá 1 câu mỗi shard
+        assert all(abs(share - total * w / sum(weights)) < 1 for share, w in zip(shares, weights))
+
+
+class StubShard:
+    def __init__(self, quota, counters, pending):
+        self.quota = quota
+        self.counters = counters
+        self._pending = pending
+
+    def pending(self, hop, diseases, plan, reserve=None):
+        return self._pending[hop]
+
+
+def test_rebalance_moves_shortfall_to_shards_with_diseases_left():
+    original = generator.QUOTA
+    generator.QUOTA = {"1-hop": 30, "2-hop": 10, "3-hop": 5}
+    try:
+        workers = [
+            # Hết bệnh, thiếu 6 câu 1-hop
+            StubShard({"1-hop": 10, "2-hop": 4, "3-hop": 2}, {"1-hop": 4, "2-hop": 4, "3-hop": 2},
+                      {"1-hop": 0, "2-hop": 0, "3-hop": 0}),
+            # Đủ chỉ tiêu, vượt 1 câu 1-hop, còn 3 bệnh
+            StubShard({"1-hop": 10, "2-hop": 3, "3-hop": 2}, {"1-hop": 11, "2-hop": 3, "3-hop": 2},
+                      {"1-hop": 3, "2-hop": 5, "3-hop": 0}),
+            # Đủ chỉ tiêu, còn 1 bệnh
+            StubShard({"1-hop": 10, "2-hop": 3, "3-hop": 1}, {"1-hop": 10, "2-hop": 3, "3-hop": 1},
+                      {"1-hop": 1, "2-hop": 0, "3-hop": 4}),
+        ]
+        instance = generator.AdvancedDataGenerator.__new__(generator.AdvancedDataGenerator)
+        active = instance.rebalance(workers, [[], [], []], None, [{}, {}, {}])
+        # Thiếu 30 - 25 = 5 câu 1-hop chia 3:1 theo số bệnh còn lại; 2-hop, 3-hop đã đủ
+        assert active == [1, 2]
+        assert [w.quota["1-hop"] for w in workers] == [10, 11 + 4, 10 + 1]
+        assert [w.quota["2-hop"] for w in workers] == [4, 3, 3]
+        # Không shard nào còn bệnh -> không chạy thêm vòng nào
+        for w in workers:
+            w._pending = {"1-hop": 0, "2-hop": 0, "3-hop": 0}
+        assert instance.rebalance(workers, [[], [], []], None, [{}, {}, {}]) == []
+    finally:
+        generator.QUOTA = original
+
+
+if __name__ == "__main__":
+    test_split_quota_is_proportional_and_exact()
+    test_rebalance_moves_shortfall_to_shards_with_diseases_left()
+    print("✅ Chia chỉ tiêu theo tỉ lệ và chia lại phần thiếu cho shard còn bệnh")
@@ -0,0 +1,86 @@
+import glob
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+
+PROCESSORS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "processors")
+sys.path.append(PROCESSORS_DIR)
+from graph_snapshot import GraphSnapshot, SnapshotPathEngine, sample_ids
+
+
+def load_generator():
+    """Nạp 5_generate_sentences.py (tên file bắt đầu bằng số nên không import trực tiếp được)"""
+    spec = importlib.util.spec_from_file_location("generate_sentences", os.path.join(PROCESSORS_DIR, "5_generate_sentences.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_snapshot():
+    """Snapshot đủ 5 nhãn: 2 chương, 4 nhóm, 24 bệnh (có bệnh con), 30 thuốc, 20 triệu chứng, bậc vượt MAX_PATHS"""
+    chapters = [{"ID": str(c), "name": f"Chương {c}", "description": f"Mô tả chương {c}"} for c in (1, 2)]
+    groups = [{"ID": f"G{g}", "name": f"Nhóm {g}", "description": f"Mô tả nhóm {g}"} for g in range(4)]
+    diseases = [{"ID": f"D{d:02d}", "name": f"Bệnh {d}", "description": f"Bệnh {d} là bệnh mạn tính thường gặp ở người lớn"}
+                for d in range(24)]
+    drugs = [{"ID": f"M{m:02d}", "name": f"Thuốc {m}", "description": f"Thuốc {m} dùng đường uống"} for m in range(30)]
+    symptoms = [{"ID": f"S{s:02d}", "name": f"Triệu chứng {s}"} for s in range(20)]
+    edges = {
+        ("BELONGS_TO", "Group", "Chapter"): [(f"G{g}", str(g % 2 + 1)) for g in range(4)],
+        ("BELONGS_TO", "Disease", "Group"): [(f"D{d:02d}", f"G{d % 4}") for d in range(24)],
+        ("IS_A", "Disease", "Disease"): [(f"D{d:02d}", f"D{d % 4:02d}") for d in range(4, 24)],
+        ("TREATS", "Drug", "Disease"): [(f"M{m:02d}", f"D{d:02d}") for d in range(24) for m in range(30)
+                                        if (m + d) % 3 == 0],
+        ("HAS_SYMPTOM", "Disease", "Symptom"): [(f"D{d:02d}", f"S{s:02d}") for d in range(24) for s in range(20)
+                                                if (s * d) % 4 == 1 or s == d % 20],
+    }
+    return GraphSnapshot.from_records({"Chapter": chapters, "Group": groups, "Disease": diseases,
+                                       "Drug": drugs, "Symptom": symptoms}, edges)
+
+
+def run_generator(snapshot_dir, output_dir, workers):
+    generator = load_generator()
+    generator.QUOTA = {"1-hop": 60, "2-hop": 80, "3-hop": 20}
+    generator.OUTPUT_DIR = output_dir
+    generator.SENTENCES_PER_FILE = 25
+    generator.WORKERS = workers
+    generator.DEDUP = None
+    generator.NEGATIVES_PER_POSITIVE = 1
+    instance = generator.AdvancedDataGenerator(None, None, snapshot_dir=snapshot_dir, seed=7)
+    instance.generate()
+    files = sorted(glob.glob(os.path.join(output_dir, "*")))
+    return {os.path.basename(path): open(path, 'rb').read() for path in files}, instance.counters
+
+
+def test_sample_ids_sorts_and_samples_only_over_limit():
+    # Không vượt limit: trả đủ ID theo thứ tự đã sắp, không tiêu thụ RNG (giống sample_rows của chế độ online)
+    rng = random.Random(1)
+    state = rng.getstate()
+    assert sample_ids(rng, ["M10", "M02", "M07"], limit=5) == ["M02", "M07", "M10"]
+    assert rng.getstate() == state
+    # Vượt limit: kết quả chỉ phụ thuộc tập ID, không phụ thuộc thứ tự đầu vào
+    ids = [f"M{m:02d}" for m in range(30)]
+    assert sample_ids(random.Random(3), ids, 5) == sample_ids(random.Random(3), list(reversed(ids)), 5)
+    engine = SnapshotPathEngine(build_snapshot(), seed=3)
+    drugs = engine.g.inn("TREATS", "Drug", "Disease", engine.g.index["Disease"]["D00"])
+    picked = [engine.g.prop("Drug", i, "ID") for i in engine.sample("Drug", list(reversed(drugs)), 5)]
+    expected = sample_ids(random.Random(3), [engine.g.prop("Drug", i, "ID") for i in drugs], 5)
+    assert picked == expected, (picked, expected)
+
+
+def test_snapshot_output_does_not_depend_on_workers():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        snapshot_dir = os.path.join(tmp_dir, "snapshot")
+        build_snapshot().save(snapshot_dir)
+        single, counters = run_generator(snapshot_dir, os.path.join(tmp_dir, "w1"), workers=1)
+        parallel, _ = run_generator(snapshot_dir, os.path.join(tmp_dir, "w4"), workers=4)
+    assert single, "không sinh được file nào"
+    assert sum(counters.values()) > 0, counters
+    assert single == parallel, sorted(set(single) ^ set(parallel))
+
+
+if __name__ == "__main__":
+    test_sample_ids_sorts_and_samples_only_over_limit()
+    test_snapshot_output_does_not_depend_on_workers()
+    print("✅ Cùng SEED, snapshot cho kết quả giống hệt nhau với 1 và 4 worker")
@@ -0,0 +1,44 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "processors"))
+from graph_snapshot import GraphSnapshot
+from negative_sampling import NegativeSampler
+
+
+def build_snapshot():
+    """Snapshot nhỏ: D1 được điều trị bởi Paracetamol (A1) và Aspirin (A2); A3 là node khác cũng tên "Aspirin" """
+    nodes = {
+        "Disease": [{"ID": "D1", "name": "Bệnh 1"}, {"ID": "D2", "name": "Bệnh 2"}],
+        "Drug": [
+            {"ID": "A1", "name": "Paracetamol"},
+            {"ID": "A2", "name": "Aspirin"},
+            {"ID": "A3", "name": "Aspirin"},
+            {"ID": "A4", "name": "Ibuprofen"},
+            {"ID": "A5", "name": "Amoxicillin"},
+        ],
+    }
+    edges = {
+        ("TREATS", "Drug", "Disease"): [("A1", "D1"), ("A2", "D1"), ("A3", "D2")],
+    }
+    return GraphSnapshot.from_records(nodes, edges)
+
+
+def test_same_name_entity_is_never_a_negative():
+    # Thay "Paracetamol" không bao giờ được ra "Aspirin" (dù A3 không nối với D1, tên vẫn trùng thuốc thật A2)
+    snapshot = build_snapshot()
+    records = [{"disease": "Bệnh 1", "drug": "Paracetamol"}]
+    produced = set()
+    for seed in range(200):
+        sampler = NegativeSampler(snapshot, seed=seed)
+        for record, slot in sampler.corrupt(records, "1-hop", "D1", limit=1):
+            assert slot == "drug"
+            produced.add(record["drug"])
+    assert "Aspirin" not in produced, produced
+    assert "Paracetamol" not in produced, produced
+    assert produced == {"Ibuprofen", "Amoxicillin"}, produced
+
+
+if __name__ == "__main__":
+    test_same_name_entity_is_never_a_negative()
+    print("✅ Không sinh câu sai trùng tên với thuốc thật của bệnh")
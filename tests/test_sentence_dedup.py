@@ -0,0 +1,49 @@
+import os
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "processors"))
+from sentence_dedup import SentenceDeduplicator, open_store, saturated
+
+TEXTS = ["Bệnh A có triệu chứng sốt.", "bệnh a   có triệu chứng sốt", "Thuốc B điều trị bệnh A.", "Bệnh C thuộc nhóm D."]
+
+
+def check_store(kind):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "shard00")
+        dedup = SentenceDeduplicator(open_store(path, kind, capacity=1000, fp_rate=0.001))
+        # Câu thứ 2 chỉ khác hoa/thường, khoảng trắng, dấu chấm cuối -> trùng câu 1 trong cùng lô
+        assert dedup.select(TEXTS, "1-hop") == [0, 2, 3]
+        # Câu bị cắt bởi limit không được ghi vào tập hash -> lần sau vẫn dùng được
+        assert dedup.filter(["Câu mới 1.", "Câu mới 2.", "Câu mới 3."], "2-hop", limit=1) == ["Câu mới 1."]
+        assert dedup.filter(["Câu mới 1.", "Câu mới 2."], "2-hop") == ["Câu mới 2."]
+        assert dedup.close() == {"1-hop": [4, 1], "2-hop": [5, 1]}
+
+        # Mở lại tập hash (lần chạy sau): câu cũ bị lọc hết, chỉ câu mới được giữ
+        dedup = SentenceDeduplicator(open_store(path, kind, capacity=1000, fp_rate=0.001))
+        assert dedup.filter(TEXTS + ["Bệnh E chưa gặp."], "1-hop") == ["Bệnh E chưa gặp."]
+        assert dedup.filter(["Câu mới 3."], "2-hop") == ["Câu mới 3."]
+        stats = dedup.close()
+        assert stats == {"1-hop": [5, 4], "2-hop": [1, 0]}
+        # Cảnh báo bão hòa: 1-hop bị lọc 80% > 50%, 2-hop không bị lọc câu nào
+        assert saturated(stats, 0.5) == ["1-hop"]
+        assert saturated(stats, 0.9) == []
+
+
+def test_bloom_filter_select_and_filter():
+    check_store("bloom")
+
+
+def test_sqlite_hash_set_select_and_filter():
+    check_store("sqlite")
+
+
+def test_saturated_ignores_unchecked_keys():
+    assert saturated({"1-hop": [0, 0], "2-hop": [10, 6], "3-hop (sai)": [10, 5]}, 0.5) == ["2-hop"]
+
+
+if __name__ == "__main__":
+    test_bloom_filter_select_and_filter()
+    test_sqlite_hash_set_select_and_filter()
+    test_saturated_ignores_unchecked_keys()
+    print("✅ Lọc trùng Bloom/SQLite nhớ qua các lần chạy, cảnh báo khi tỉ lệ trùng vượt ngưỡng")
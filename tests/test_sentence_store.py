@@ -0,0 +1,58 @@
+import json
+import os
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "processors"))
+from sentence_store import SentenceWriter, external_shuffle, iter_lines, list_parts
+
+
+def write_rows(output_dir, n, append=False, rows_per_part=10):
+    with SentenceWriter(output_dir, "raw", "jsonl", rows_per_part, verbose=False, append=append) as writer:
+        for i in range(n):
+            writer.write({"text": f"Câu {i}", "hop": "1-hop", "source_id": f"D{i}", "label": True, "corrupted": None})
+    return [os.path.basename(path) for path in list_parts(output_dir, "raw_part*")]
+
+
+def test_writer_removes_stale_parts_unless_appending():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        assert len(write_rows(tmp_dir, 50)) == 5
+        # Lần chạy sau ít part hơn: không còn part thừa của lần trước
+        assert write_rows(tmp_dir, 15) == ["raw_part001.jsonl", "raw_part002.jsonl"]
+        # append=True: giữ part cũ, đánh số tiếp
+        assert write_rows(tmp_dir, 5, append=True) == ["raw_part001.jsonl", "raw_part002.jsonl", "raw_part003.jsonl"]
+
+
+def read_shards(output_dir, prefix):
+    return [line for path in list_parts(output_dir, f"{prefix}_part*") for line in iter_lines(path)]
+
+
+def test_external_shuffle_is_deterministic():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_dir = os.path.join(tmp_dir, "raw")
+        write_rows(input_dir, 200, rows_per_part=30)
+        inputs = list_parts(input_dir)
+        original = sorted(line for path in inputs for line in iter_lines(path))
+
+        # Bucket nhỏ (~1KB) -> nhiều bucket, kiểm tra cả lượt chia bucket lẫn lượt xáo trong bucket
+        shuffled = {}
+        for name, seed in (("a", 7), ("b", 7), ("c", 8)):
+            manifest = external_shuffle(inputs, os.path.join(tmp_dir, name), seed=seed, rows_per_shard=50,
+                                        fmt="jsonl", max_bucket_mb=0.001, prefix="train")
+            assert manifest["total"] == 200 and manifest["buckets"] > 1, manifest
+            shuffled[name] = read_shards(os.path.join(tmp_dir, name), "train")
+
+        assert shuffled["a"] == shuffled["b"]
+        assert shuffled["a"] != shuffled["c"]
+        assert shuffled["a"] != [line for path in inputs for line in iter_lines(path)]
+        # Chỉ đổi thứ tự: không mất, không lặp câu nào
+        for lines in shuffled.values():
+            assert sorted(lines) == original
+        with open(os.path.join(tmp_dir, "a", "manifest.json"), 'r', encoding='utf-8') as f:
+            assert [shard["rows"] for shard in json.load(f)["shards"]] == [50, 50, 50, 50]
+
+
+if __name__ == "__main__":
+    test_writer_removes_stale_parts_unless_appending()
+    test_external_shuffle_is_deterministic()
+    print("✅ SentenceWriter xóa part cũ khi không ghi nối, external_shuffle xác định theo seed")